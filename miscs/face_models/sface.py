@@ -8,10 +8,13 @@ import numpy as np
 import cv2 as cv
 
 class SFace:
-    def __init__(self, modelPath, disType=0, backendId=0, targetId=0):
+    def __init__(self, modelPath, disType=0, backendId=0, targetId=0, batchSize=32):
         self._modelPath = modelPath
         self._backendId = backendId
         self._targetId = targetId
+        self._batchSize = batchSize # max faces per forward pass in inferBatch
+        self._net = None # cv.dnn net for batched inference, loaded on first use
+        self._batchSupported = True
         self._model = cv.FaceRecognizerSF.create(
             model=self._modelPath,
             config="",
@@ -28,6 +31,11 @@ class SFace:
     def name(self):
         return self.__class__.__name__
 
+    @property
+    def cosineThreshold(self):
+        # Same-identity threshold on the cosine similarity of two embeddings
+        return self._threshold_cosine
+
     def setBackendAndTarget(self, backendId, targetId):
         self._backendId = backendId
         self._targetId = targetId
@@ -36,6 +44,7 @@ class SFace:
             config="",
             backend_id=self._backendId,
             target_id=self._targetId)
+        self._net = None
 
     def _preprocess(self, image, bbox):
         if bbox is None:
@@ -51,6 +60,40 @@ class SFace:
         features = self._model.feature(inputBlob)
         return features
 
+    def alignCrops(self, image, bboxes):
+        return [self._model.alignCrop(image, bbox) for bbox in bboxes]
+
+    def _getNet(self):
+        if self._net is None:
+            self._net = cv.dnn.readNet(self._modelPath)
+            self._net.setPreferableBackend(self._backendId)
+            self._net.setPreferableTarget(self._targetId)
+        return self._net
+
+    def inferCrops(self, crops, batchSize=None):
+        # Embed aligned 112x112 crops with one forward pass per batch; same preprocessing as
+        # FaceRecognizerSF::feature (scale 1, no mean, swapRB). Returns (N, 128)
+        if len(crops) == 0:
+            return np.empty((0, 128), dtype=np.float32)
+        batchSize = batchSize or self._batchSize
+        if self._batchSupported and len(crops) > 1:
+            try:
+                features = []
+                for start in range(0, len(crops), batchSize):
+                    blob = cv.dnn.blobFromImages(crops[start:start + batchSize], 1.0, (112, 112), (0, 0, 0), swapRB=True, crop=False)
+                    net = self._getNet()
+                    net.setInput(blob)
+                    features.append(net.forward().reshape(len(blob), -1))
+                return np.concatenate(features).astype(np.float32)
+            except cv.error:
+                # Model exported with a fixed batch dimension: fall back to one face per call
+                self._batchSupported = False
+        return np.concatenate([self._model.feature(crop).reshape(1, -1) for crop in crops]).astype(np.float32)
+
+    def inferBatch(self, image, bboxes, batchSize=None):
+        # Align every face of one image, then embed them together
+        return self.inferCrops(self.alignCrops(image, bboxes), batchSize)
+
     def match_f(self, face1, face2):
         if self._disType == 0: # COSINE
             cosine_score = self._model.match(face1, face2, self._disType)
@@ -0,0 +1,263 @@
+# Benchmark cho Instance Search: tạo các biến thể của ảnh trong database (xoay, scale, crop, nén
+# JPEG, đổi độ sáng) với ground truth là ảnh gốc, rồi đo
+#   - chất lượng: mAP, recall@1/5/10 (tổng và theo từng biến thể)
+#   - độ trễ từng bước: decode, extract (SIFT/ORB), assignment, scoring, rerank (mean/p50/p95, ms)
+#   - throughput của bước scoring khi database được nhân lên nhiều kích thước
+# Kết quả ghi ra JSON (kèm commit git) để so sánh giữa các lần chạy.
+#
+#   python -m my_utils.bovw_benchmark --index bovw_index --images_dir DTS --output bench.json
+#   python -m my_utils.bovw_benchmark --index bovw_index --verify_top 20 --sizes 1000 10000 100000
+#   python -m my_utils.bovw_benchmark --index bovw_index bovw_index_orb     # so sánh SIFT với ORB
+import os
+import copy
+import json
+import time
+import argparse
+import subprocess
+
+import cv2
+import numpy as np
+
+from my_utils.bovw_builder import list_images
+from my_utils.bovw_searcher import BOVWSearcher
+from my_utils.bovw_verify import select_keypoints
+
+STAGES = ('decode', 'extract', 'assignment', 'scoring', 'rerank')
+RECALL_AT = (1, 5, 10)
+
+
+def _rotate(image, angle):
+  h, w = image.shape[:2]
+  matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+  return cv2.warpAffine(image, matrix, (w, h), borderMode=cv2.BORDER_REFLECT)
+
+
+def _crop(image, ratio):
+  h, w = image.shape[:2]
+  ch, cw = int(h * ratio), int(w * ratio)
+  y, x = (h - ch) // 2, (w - cw) // 2
+  return image[y:y + ch, x:x + cw]
+
+
+def _scale(image, factor):
+  return cv2.resize(image, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+
+
+# Mỗi biến thể trả về (ảnh, chất lượng JPEG khi mã hóa thành file upload)
+VARIANTS = {
+  'original': lambda image: (image, 95),
+  'rotate_15': lambda image: (_rotate(image, 15), 95),
+  'rotate_90': lambda image: (np.ascontiguousarray(np.rot90(image)), 95),
+  'scale_0.5': lambda image: (_scale(image, 0.5), 95),
+  'crop_0.6': lambda image: (_crop(image, 0.6), 95),
+  'jpeg_30': lambda image: (image, 30),
+  'brightness_+40': lambda image: (cv2.convertScaleAbs(image, alpha=1.0, beta=40), 95),
+}
+
+
+def make_queries(images_dir, image_names, variants=None, deleted=None):
+  # [(biến thể, id ảnh gốc trong index, bytes JPEG)]; chỉ dùng ảnh có trong index và chưa bị xóa
+  # (deleted: mask tombstone của searcher, ảnh đã xóa không bao giờ được trả về)
+  ids = {name: i for i, name in enumerate(image_names) if deleted is None or not deleted[i]}
+  queries = []
+  for name in list_images(images_dir):
+    if name not in ids:
+      continue
+    image = cv2.imread(os.path.join(images_dir, name), cv2.IMREAD_COLOR)
+    if image is None:
+      continue
+    for variant in variants or VARIANTS:
+      query, quality = VARIANTS[variant](image)
+      ok, data = cv2.imencode('.jpg', query, [cv2.IMWRITE_JPEG_QUALITY, quality])
+      if ok:
+        queries.append((variant, ids[name], data.tobytes()))
+  return queries
+
+
+def timed_search(searcher, data, top_k=10, n_query_words=None, verify_top=0, budget_ms=200):
+  # Chạy lại đúng các bước của search_image nhưng bấm giờ từng bước (bước không chạy thì không có)
+  timings = {}
+  t = time.perf_counter()
+  image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+  timings['decode'] = time.perf_counter() - t
+
+  t = time.perf_counter()
+  keypoints, descriptors, kp_weights = searcher.extract(image)
+  timings['extract'] = time.perf_counter() - t
+  if descriptors is None:
+    return [], timings
+
+  t = time.perf_counter()
+  histogram = searcher.encoder.encode(descriptors, kp_weights)
+  timings['assignment'] = time.perf_counter() - t
+
+  t = time.perf_counter()
+  results = searcher.search_features(histogram, max(top_k, verify_top), n_query_words, with_images=False)
+  timings['scoring'] = time.perf_counter() - t
+
+  if verify_top and searcher.verifier is not None:
+    t = time.perf_counter()
+    points = np.array([kp.pt for kp in keypoints], dtype=np.float32)
+    points, descriptors = select_keypoints(points, descriptors, kp_weights,
+                                           searcher.index.meta.get('geometry_keypoints', 300))
+    results = searcher.verifier.rerank(points, descriptors, results, budget_ms)
+    timings['rerank'] = time.perf_counter() - t
+  return [r['id'] for r in results[:top_k]], timings
+
+
+def quality_metrics(ranks):
+  # ranks: vị trí (bắt đầu từ 1) của ảnh gốc trong kết quả, None nếu không có.
+  # Mỗi query chỉ có một ảnh đúng nên AP = 1 / rank
+  ranks = list(ranks)
+  n = max(len(ranks), 1)
+  metrics = {'n_queries': len(ranks), 'mAP': sum(1.0 / r for r in ranks if r) / n}
+  for k in RECALL_AT:
+    metrics[f'recall@{k}'] = sum(1 for r in ranks if r and r <= k) / n
+  return metrics
+
+
+def latency_stats(samples):
+  samples = np.asarray(samples, dtype=np.float64) * 1000
+  if not len(samples):
+    return None
+  return {'mean': float(samples.mean()), 'p50': float(np.percentile(samples, 50)),
+          'p95': float(np.percentile(samples, 95))}
+
+
+def scaled_searcher(searcher, n_images, noise=0.05, seed=42):
+  # Bản sao của searcher với n_images vector: các vector gốc lặp lại kèm nhiễu nhỏ rồi chuẩn hóa
+  # lại, đủ để đo tốc độ scoring mà không cần database thật lớn
+  histograms = np.asarray(searcher.histograms[:len(searcher.histograms)], dtype=np.float32)
+  rng = np.random.default_rng(seed)
+  rows = np.arange(n_images) % len(histograms)
+  scaled = histograms[rows]
+  scaled += noise * np.abs(rng.standard_normal(scaled.shape, dtype=np.float32)) * (scaled > 0)
+  scaled /= np.maximum(np.linalg.norm(scaled, axis=1, keepdims=True), 1e-12)
+
+  clone = copy.copy(searcher)
+  clone.histograms = scaled.astype(searcher.histograms.dtype)
+  clone.image_names = [searcher.image_names[i] for i in rows]
+  clone.deleted = None
+  clone.inverted_index = None
+  if searcher.pq is not None:
+    clone.pq_codes = searcher.pq.encode(scaled)
+  return clone
+
+
+def throughput(searcher, histograms, sizes, top_k=10, n_query_words=None, min_seconds=1.0):
+  report = []
+  for n_images in sizes:
+    clone = scaled_searcher(searcher, n_images)
+    if n_query_words:
+      clone.build_inverted_index()
+    n_queries, started = 0, time.perf_counter()
+    while True:
+      for histogram in histograms:
+        clone.search_features(histogram, top_k, n_query_words, with_images=False)
+      n_queries += len(histograms)
+      elapsed = time.perf_counter() - started
+      if elapsed >= min_seconds:
+        break
+    report.append({'n_images': int(n_images), 'qps': n_queries / elapsed,
+                   'ms_per_query': 1000 * elapsed / n_queries})
+    print(f"  {n_images:>8} ảnh: {n_queries / elapsed:8.1f} query/s")
+    del clone
+  return report
+
+
+def benchmark_index(index_path, images_dir, variants=None, top_k=10, n_query_words=None, verify_top=0,
+                    budget_ms=200, sizes=(1000, 10000, 50000), **searcher_kwargs):
+  searcher = BOVWSearcher(index_path, **searcher_kwargs)
+  queries = make_queries(images_dir, searcher.image_names, variants, searcher.deleted)
+  if not queries:
+    raise ValueError(f"Không có ảnh nào trong {images_dir} thuộc index {index_path}")
+  if n_query_words:
+    searcher.build_inverted_index()
+  top_k = max(top_k, max(RECALL_AT))
+
+  # Chạy thử một query để các lazy init (BLAS, thread pool) không tính vào thời gian đo
+  timed_search(searcher, queries[0][2], top_k, n_query_words, verify_top, budget_ms)
+
+  # Throughput đo bằng histogram của biến thể đầu tiên của mỗi ảnh
+  first_variant = queries[0][0]
+  ranks, timings, histograms = {}, {}, []
+  for variant, target, data in queries:
+    ids, timing = timed_search(searcher, data, top_k, n_query_words, verify_top, budget_ms)
+    ranks.setdefault(variant, []).append(ids.index(target) + 1 if target in ids else None)
+    for stage, seconds in timing.items():
+      timings.setdefault(stage, []).append(seconds)
+    timings.setdefault('total', []).append(sum(timing.values()))
+    if variant == first_variant:
+      image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+      features = searcher.process_query_image(image)
+      if features is not None:
+        histograms.append(features)
+
+  print(f"Throughput scoring ({index_path}):")
+  meta = searcher.index.meta if searcher.index is not None else {}
+  return {
+    'index': index_path,
+    'descriptor': meta.get('descriptor', 'sift'),
+    'encoding': searcher.encoding,
+    'aggregation': searcher.aggregation,
+    'n_images': len(searcher),
+    'n_clusters': searcher.n_clusters,
+    'load_time_s': searcher.load_time,
+    'memory_mb': searcher.memory_mb,
+    'quality': dict(quality_metrics(r for rs in ranks.values() for r in rs),
+                    variants={variant: quality_metrics(rs) for variant, rs in ranks.items()}),
+    'latency_ms': {stage: latency_stats(timings[stage]) for stage in STAGES + ('total',) if stage in timings},
+    'throughput': throughput(searcher, histograms, sizes, top_k, n_query_words) if histograms else [],
+  }
+
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                   text=True).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def print_report(report):
+  quality = report['quality']
+  print(f"\n{report['index']} ({report['descriptor']}, {report['aggregation']}, {report['encoding']}, "
+        f"{report['n_images']} ảnh)")
+  print(f"  mAP {quality['mAP']:.3f}  " +
+        "  ".join(f"R@{k} {quality[f'recall@{k}']:.3f}" for k in RECALL_AT))
+  for variant, metrics in quality['variants'].items():
+    print(f"    {variant:<16} mAP {metrics['mAP']:.3f}  R@1 {metrics['recall@1']:.3f}")
+  print("  Độ trễ (ms, mean / p95): " + ", ".join(
+    f"{stage} {stats['mean']:.1f}/{stats['p95']:.1f}"
+    for stage, stats in report['latency_ms'].items() if stats))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark Instance Search: mAP, recall@k, độ trễ và throughput.')
+  parser.add_argument('--index', type=str, nargs='+', default=['bovw_index'],
+                      help='Một hoặc nhiều BOVW index (hoặc pickle) để so sánh')
+  parser.add_argument('--images_dir', type=str, default='DTS', help='Thư mục ảnh dùng để tạo query')
+  parser.add_argument('--variants', type=str, nargs='+', default=list(VARIANTS), choices=list(VARIANTS))
+  parser.add_argument('--n_query_words', type=int, default=0, help='>0: tìm qua inverted index')
+  parser.add_argument('--verify_top', type=int, default=0, help='Số ứng viên xác minh hình học (0: tắt)')
+  parser.add_argument('--budget_ms', type=int, default=200, help='Ngân sách thời gian cho xác minh hình học')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000],
+                      help='Các kích thước database dùng để đo throughput')
+  parser.add_argument('--output', type=str, default='bovw_benchmark.json', help='File JSON kết quả')
+  args = parser.parse_args()
+
+  report = {
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'git_commit': git_commit(),
+    'config': {key: value for key, value in vars(args).items() if key != 'output'},
+    'indexes': [],
+  }
+  for index_path in args.index:
+    result = benchmark_index(index_path, args.images_dir, args.variants, n_query_words=args.n_query_words,
+                             verify_top=args.verify_top, budget_ms=args.budget_ms, sizes=args.sizes)
+    report['indexes'].append(result)
+    print_report(result)
+
+  with open(args.output, 'w', encoding='utf-8') as f:
+    json.dump(report, f, indent=2, ensure_ascii=False)
+  print(f"\nĐã ghi kết quả vào {args.output}")
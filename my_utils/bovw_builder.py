@@ -0,0 +1,450 @@
+# Build BOVW index từ một thư mục ảnh, gồm 4 bước, mỗi bước có checkpoint trong work_dir
+# nên chạy lại cùng lệnh sẽ tiếp tục từ chỗ bị dừng:
+#   1. extract     trích SIFT (hoặc ORB) song song (process pool), ghi từng shard descriptors ra đĩa
+#   2. vocabulary  train MiniBatchKMeans (ORB: k-majority) out-of-core bằng partial_fit trên các shard
+#   3. encode      soft-assign histogram song song theo shard (SoftAssignEncoder / BinaryAssignEncoder),
+#                  hoặc vector VLAD thô khi --aggregation vlad (my_utils/bovw_vlad.py)
+#   4. write       tính IDF (VLAD: train PCA) và ghi index memory-mapped (my_utils/bovw_store.py)
+#
+#   python -m my_utils.bovw_builder DTS bovw_index --n_clusters 1000 --workers 8
+#   python -m my_utils.bovw_builder DTS bovw_index_orb --descriptor orb --epochs 10
+#   python -m my_utils.bovw_builder DTS bovw_index_root --descriptor rootsift --pca_dim 64 --whiten
+#   python -m my_utils.bovw_builder DTS bovw_index_vlad --aggregation vlad --vlad_words 64 --vlad_dim 256
+import os
+import json
+import time
+import pickle
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+from my_utils.bovw_encoder import DESCRIPTORS, create_encoder, create_extractor, extract_features
+from my_utils.bovw_store import save_index
+from my_utils.descriptor_pca import PCAProjection
+from my_utils.bovw_verify import geometry_blob
+from my_utils.bovw_vlad import VLADEncoder, coarse_codebook, fit_pca
+from my_utils.kmajority import KMajority
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+STAGES = ('extract', 'vocabulary', 'encode', 'write')
+
+
+def list_images(images_dir):
+  paths = []
+  for root, _, files in os.walk(images_dir):
+    for name in files:
+      if name.lower().endswith(IMAGE_EXTENSIONS):
+        paths.append(os.path.relpath(os.path.join(root, name), images_dir))
+  return sorted(paths)
+
+
+def read_image(path, max_side=None):
+  image = cv2.imread(path, cv2.IMREAD_COLOR)
+  if image is not None and max_side:
+    h, w = image.shape[:2]
+    scale = max_side / max(h, w)
+    if scale < 1:
+      image = cv2.resize(image, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+  return image
+
+
+def _save_atomic(path, save_fn):
+  # Ghi ra file tạm rồi rename, tránh để lại shard hỏng khi build bị ngắt giữa chừng
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    save_fn(f)
+  os.replace(tmp_path, path)
+
+
+_worker = {}
+
+
+def _init_extract_worker(n_features, descriptor):
+  cv2.setNumThreads(1)
+  _worker['extractor'] = create_extractor(descriptor, n_features)
+  _worker['descriptor'] = descriptor
+
+
+def _extract_shard(task):
+  images_dir, names, out_path, max_side = task
+  descriptors, kp_weights, keypoints, counts = [], [], [], []
+  for name in names:
+    image = read_image(os.path.join(images_dir, name), max_side)
+    kps, desc, weights = ((None, None, None) if image is None
+                          else extract_features(_worker['extractor'], image, _worker['descriptor']))
+    if desc is None:
+      counts.append(0)
+      continue
+    descriptors.append(desc)
+    kp_weights.append(weights)
+    keypoints.append(np.array([kp.pt for kp in kps], dtype=np.float32))
+    counts.append(len(desc))
+
+  empty = (np.empty((0, 32), dtype=np.uint8) if _worker['descriptor'] == 'orb'
+           else np.empty((0, 128), dtype=np.float32))
+  _save_atomic(out_path, lambda f: np.savez(
+    f,
+    names=np.asarray(names),
+    counts=np.asarray(counts, dtype=np.int64),
+    descriptors=np.concatenate(descriptors) if descriptors else empty,
+    kp_weights=np.concatenate(kp_weights) if kp_weights else np.empty(0, dtype=np.float32),
+    keypoints=np.concatenate(keypoints) if keypoints else np.empty((0, 2), dtype=np.float32),
+  ))
+  return out_path
+
+
+def _init_encode_worker(vocabulary_path, knn, descriptor, projection_path, codebook_path):
+  cv2.setNumThreads(1)
+  projection = PCAProjection.load(projection_path) if projection_path else None
+  if codebook_path:
+    _worker['encoder'] = VLADEncoder(np.load(codebook_path), projection=projection)
+    return
+  kwargs = {'projection': projection} if projection is not None else {}
+  _worker['encoder'] = create_encoder(descriptor, np.load(vocabulary_path), knn=knn, **kwargs)
+
+
+def _encode_shard(task):
+  shard_path, out_path = task
+  encoder = _worker['encoder']
+  with np.load(shard_path) as shard:
+    counts, descriptors, kp_weights = shard['counts'], shard['descriptors'], shard['kp_weights']
+  tf = np.zeros((len(counts), getattr(encoder, 'raw_dim', encoder.n_clusters)), dtype=np.float32)
+  offsets = np.concatenate([[0], np.cumsum(counts)])
+  for i, count in enumerate(counts):
+    if count == 0:
+      continue
+    start, end = offsets[i], offsets[i + 1]
+    tf[i] = encoder.encode_tf(descriptors[start:end], kp_weights[start:end])
+  _save_atomic(out_path, lambda f: np.save(f, tf))
+  return out_path
+
+
+class IndexBuilder:
+  def __init__(self, images_dir, index_path, work_dir=None, n_clusters=1000, knn=5, workers=None,
+               shard_size=256, batch_size=4096, epochs=None, max_side=1024, n_features=0,
+               thumbnail_size=256, geometry_keypoints=300, descriptor='sift', pca_dim=0, whiten=False,
+               aggregation='bovw', vlad_words=64, vlad_dim=256):
+    if descriptor not in DESCRIPTORS:
+      raise ValueError(f"Không hỗ trợ descriptor {descriptor}")
+    if (pca_dim or aggregation == 'vlad') and descriptor == 'orb':
+      raise ValueError("PCA và VLAD chỉ dùng được với descriptor float (sift, rootsift)")
+    self.images_dir = images_dir
+    self.index_path = index_path
+    self.work_dir = work_dir or index_path.rstrip('/\\') + '.work'
+    self.n_clusters = n_clusters
+    self.knn = knn
+    self.workers = workers or os.cpu_count()
+    self.shard_size = shard_size
+    self.batch_size = max(batch_size, n_clusters)
+    self.epochs = epochs
+    self.max_side = max_side
+    self.n_features = n_features
+    self.thumbnail_size = thumbnail_size
+    self.geometry_keypoints = geometry_keypoints
+    self.descriptor = descriptor
+    self.pca_dim = pca_dim
+    self.whiten = whiten
+    self.aggregation = aggregation
+    self.vlad_words = vlad_words
+    self.vlad_dim = vlad_dim
+
+    os.makedirs(os.path.join(self.work_dir, 'descriptors'), exist_ok=True)
+    os.makedirs(os.path.join(self.work_dir, 'tf'), exist_ok=True)
+    self.state_path = os.path.join(self.work_dir, 'state.json')
+    self.state = self._load_state()
+    # Khi resume, giữ nguyên cấu hình của lần build đầu để các shard khớp nhau
+    self.n_clusters = self.state['n_clusters']
+    self.knn = self.state['knn']
+    self.descriptor = self.state.get('descriptor', 'sift')
+    self.pca_dim = self.state.get('pca_dim', 0)
+    self.whiten = self.state.get('whiten', False)
+    self.aggregation = self.state.get('aggregation', 'bovw')
+    self.vlad_words = self.state.get('vlad_words', vlad_words)
+    self.vlad_dim = self.state.get('vlad_dim', vlad_dim)
+    # k-majority (ORB) cần nhiều vòng lặp hơn partial_fit của MiniBatchKMeans
+    self.epochs = epochs or (10 if self.descriptor == 'orb' else 1)
+    self.batch_size = max(batch_size, self.n_clusters)
+
+  def _load_state(self):
+    if os.path.isfile(self.state_path):
+      with open(self.state_path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+      print(f"Tiếp tục build, các bước đã xong: {', '.join(state['done']) or 'chưa có'}")
+      return state
+    images = list_images(self.images_dir)
+    if not images:
+      raise ValueError(f"Không tìm thấy ảnh trong {self.images_dir}")
+    return {
+      'images': images,
+      'shard_size': self.shard_size,
+      'n_clusters': self.n_clusters,
+      'knn': self.knn,
+      'descriptor': self.descriptor,
+      'pca_dim': self.pca_dim,
+      'whiten': self.whiten,
+      'aggregation': self.aggregation,
+      'vlad_words': self.vlad_words,
+      'vlad_dim': self.vlad_dim,
+      'done': [],
+    }
+
+  def _save_state(self):
+    _save_atomic(self.state_path, lambda f: f.write(json.dumps(self.state, indent=2).encode('utf-8')))
+
+  def _finish(self, stage, started):
+    self.state['done'].append(stage)
+    self._save_state()
+    print(f"[{stage}] xong sau {time.perf_counter() - started:.1f}s")
+
+  @property
+  def shards(self):
+    images, size = self.state['images'], self.state['shard_size']
+    return [images[i:i + size] for i in range(0, len(images), size)]
+
+  def shard_path(self, i):
+    return os.path.join(self.work_dir, 'descriptors', f'shard_{i:05d}.npz')
+
+  def tf_path(self, i):
+    return os.path.join(self.work_dir, 'tf', f'shard_{i:05d}.npy')
+
+  @property
+  def vocabulary_path(self):
+    return os.path.join(self.work_dir, 'vocabulary.npy')
+
+  @property
+  def projection_path(self):
+    return os.path.join(self.work_dir, 'projection.npz') if self.pca_dim else None
+
+  @property
+  def codebook_path(self):
+    return os.path.join(self.work_dir, 'vlad_codebook.npy') if self.aggregation == 'vlad' else None
+
+  def run(self):
+    for stage in STAGES:
+      if stage in self.state['done']:
+        continue
+      started = time.perf_counter()
+      getattr(self, f'stage_{stage}')()
+      self._finish(stage, started)
+    return self.index_path
+
+  def stage_extract(self):
+    tasks = [(self.images_dir, names, self.shard_path(i), self.max_side)
+             for i, names in enumerate(self.shards) if not os.path.isfile(self.shard_path(i))]
+    print(f"[extract] {len(tasks)}/{len(self.shards)} shard cần trích {self.descriptor.upper()}")
+    with ProcessPoolExecutor(self.workers, initializer=_init_extract_worker,
+                             initargs=(self.n_features, self.descriptor)) as pool:
+      for n, _ in enumerate(pool.map(_extract_shard, tasks), 1):
+        print(f"[extract] {n}/{len(tasks)}")
+
+  def _descriptor_batches(self, rng):
+    buffer, size = [], 0
+    for i in rng.permutation(len(self.shards)):
+      with np.load(self.shard_path(i)) as shard:
+        descriptors = shard['descriptors']
+      buffer.append(descriptors[rng.permutation(len(descriptors))])
+      size += len(descriptors)
+      while size >= self.batch_size:
+        data = np.concatenate(buffer)
+        yield data[:self.batch_size]
+        buffer, size = [data[self.batch_size:]], len(data) - self.batch_size
+    if size >= self.n_clusters:
+      yield np.concatenate(buffer)
+
+  def stage_vocabulary(self):
+    # partial_fit trên từng batch nên chỉ một batch descriptors nằm trong RAM;
+    # model được lưu sau mỗi epoch để có thể tiếp tục
+    checkpoint = os.path.join(self.work_dir, 'kmeans.pkl')
+    if self.descriptor == 'orb':
+      kmeans = KMajority(self.n_clusters, random_state=42)
+    else:
+      kmeans = MiniBatchKMeans(n_clusters=self.n_clusters, random_state=42,
+                               batch_size=self.batch_size, n_init=3)
+    epoch = 0
+    projection = self._fit_projection() if self.pca_dim else None
+    if os.path.isfile(checkpoint):
+      with open(checkpoint, 'rb') as f:
+        epoch, kmeans = pickle.load(f)
+
+    rng = np.random.default_rng(42)
+    for epoch in range(epoch, self.epochs):
+      n_batches = 0
+      for batch in self._descriptor_batches(rng):
+        kmeans.partial_fit(batch if projection is None else projection.transform(batch))
+        n_batches += 1
+      if n_batches == 0:
+        raise ValueError("Không đủ descriptors để train vocabulary, hãy giảm n_clusters")
+      if self.descriptor == 'orb':
+        kmeans.update()
+      _save_atomic(checkpoint, lambda f: pickle.dump((epoch + 1, kmeans), f))
+      print(f"[vocabulary] epoch {epoch + 1}/{self.epochs}, {n_batches} batch")
+
+    vocabulary = kmeans.cluster_centers_
+    if self.descriptor != 'orb':
+      vocabulary = vocabulary.astype(np.float32)
+    _save_atomic(self.vocabulary_path, lambda f: np.save(f, vocabulary))
+    if self.aggregation == 'vlad':
+      codebook = coarse_codebook(vocabulary, self.vlad_words)
+      _save_atomic(self.codebook_path, lambda f: np.save(f, codebook))
+
+  def _fit_projection(self):
+    # PCA train trên một mẫu descriptors, vocabulary sau đó được train trong không gian đã chiếu
+    if not os.path.isfile(self.projection_path):
+      projection = PCAProjection.fit(self._descriptor_batches(np.random.default_rng(0)),
+                                     self.pca_dim, whiten=self.whiten)
+      _save_atomic(self.projection_path, projection.save)
+      print(f"[vocabulary] PCA {projection.components.shape[1]} -> {self.pca_dim} chiều"
+            f"{' (whitening)' if self.whiten else ''}")
+    return PCAProjection.load(self.projection_path)
+
+  def stage_encode(self):
+    tasks = [(self.shard_path(i), self.tf_path(i))
+             for i in range(len(self.shards)) if not os.path.isfile(self.tf_path(i))]
+    print(f"[encode] {len(tasks)}/{len(self.shards)} shard cần encode")
+    with ProcessPoolExecutor(self.workers, initializer=_init_encode_worker,
+                             initargs=(self.vocabulary_path, self.knn, self.descriptor,
+                                       self.projection_path, self.codebook_path)) as pool:
+      for n, _ in enumerate(pool.map(_encode_shard, tasks), 1):
+        print(f"[encode] {n}/{len(tasks)}")
+
+  def _vlad_vectors(self, n_train=4096):
+    # PCA của VLAD train trên một mẫu vector thô, sau đó chiếu toàn bộ database theo shard
+    rng = np.random.default_rng(42)
+    sample, size = [], 0
+    for i in rng.permutation(len(self.shards)):
+      raw = np.load(self.tf_path(i))
+      raw = raw[np.linalg.norm(raw, axis=1) > 0]
+      sample.append(raw[:n_train - size])
+      size += len(sample[-1])
+      if size >= n_train:
+        break
+    pca = fit_pca(np.concatenate(sample), self.vlad_dim, whiten=self.whiten)
+    vlad = VLADEncoder(np.load(self.codebook_path), pca=pca)
+    print(f"[write] VLAD {vlad.raw_dim} -> {vlad.n_clusters} chiều")
+
+    vectors_path = os.path.join(self.work_dir, 'weighted.npy')
+    vectors = np.lib.format.open_memmap(vectors_path, mode='w+', dtype=np.float32,
+                                        shape=(len(self.state['images']), vlad.n_clusters))
+    row = 0
+    for i in range(len(self.shards)):
+      raw = np.load(self.tf_path(i))
+      block = vlad.apply_pca(raw)
+      # Ảnh không có descriptor giữ vector 0
+      block[np.linalg.norm(raw, axis=1) == 0] = 0
+      vectors[row:row + len(block)] = block
+      row += len(block)
+    vectors.flush()
+    return vlad, vectors, vectors_path
+
+  def stage_write(self):
+    if self.aggregation == 'vlad':
+      vlad, weighted, weighted_path = self._vlad_vectors()
+      tf_all, tf_all_path, df, idf = None, None, None, np.ones(vlad.n_clusters, dtype=np.float32)
+    else:
+      vlad = None
+      tf_all, weighted, tf_all_path, weighted_path, df, idf = self._bovw_histograms()
+
+    # Thumbnail lưu ở RGB như ảnh trong database cũ (st.image hiển thị RGB)
+    def thumbnails():
+      for name in self.state['images']:
+        image = read_image(os.path.join(self.images_dir, name), self.thumbnail_size)
+        yield None if image is None else cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    # Keypoint mạnh nhất của mỗi ảnh cho bước xác minh hình học
+    def geometry():
+      for i in range(len(self.shards)):
+        with np.load(self.shard_path(i)) as shard:
+          counts, descriptors = shard['counts'], shard['descriptors']
+          kp_weights, keypoints = shard['kp_weights'], shard['keypoints']
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        for j in range(len(counts)):
+          start, end = offsets[j], offsets[j + 1]
+          yield geometry_blob(keypoints[start:end], descriptors[start:end], kp_weights[start:end],
+                              self.geometry_keypoints)
+
+    save_index(self.index_path,
+               vocabulary=np.load(self.vocabulary_path),
+               idf_weights=idf,
+               histograms=weighted,
+               names=self.state['images'],
+               images=thumbnails(),
+               thumbnail_size=self.thumbnail_size,
+               meta={'knn_words': self.knn, 'descriptor': self.descriptor,
+                     'geometry_keypoints': self.geometry_keypoints,
+                     'geometry_descriptor_size': 32 if self.descriptor == 'orb' else 128,
+                     'pca_dim': self.pca_dim, 'pca_whiten': self.whiten,
+                     'aggregation': self.aggregation},
+               tf=tf_all,
+               df=df,
+               geometry=geometry(),
+               projection=PCAProjection.load(self.projection_path) if self.pca_dim else None,
+               vlad=vlad)
+    del tf_all, weighted
+    for path in (tf_all_path, weighted_path):
+      if path is not None:
+        os.remove(path)
+
+  def _bovw_histograms(self):
+    n_images = len(self.state['images'])
+    df = np.zeros(self.n_clusters, dtype=np.int64)
+    for i in range(len(self.shards)):
+      df += np.count_nonzero(np.load(self.tf_path(i), mmap_mode='r'), axis=0)
+    idf = np.log(n_images / np.maximum(df, 1)).astype(np.float32)
+
+    # Giữ cả tf (chưa nhân IDF) trong index để có thể thêm/xóa ảnh và tính lại IDF sau này
+    tf_all_path = os.path.join(self.work_dir, 'tf_all.npy')
+    weighted_path = os.path.join(self.work_dir, 'weighted.npy')
+    tf_all = np.lib.format.open_memmap(tf_all_path, mode='w+', dtype=np.float32,
+                                       shape=(n_images, self.n_clusters))
+    weighted = np.lib.format.open_memmap(weighted_path, mode='w+', dtype=np.float32,
+                                         shape=(n_images, self.n_clusters))
+    row = 0
+    for i in range(len(self.shards)):
+      tf = np.load(self.tf_path(i))
+      tf_all[row:row + len(tf)] = tf
+      weighted[row:row + len(tf)] = tf * idf
+      row += len(tf)
+    tf_all.flush()
+    weighted.flush()
+    return tf_all, weighted, tf_all_path, weighted_path, df, idf
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Build BOVW index (SIFT -> MiniBatchKMeans -> soft-assign -> IDF).')
+  parser.add_argument('images_dir', type=str, help='Thư mục ảnh, ví dụ DTS')
+  parser.add_argument('index_path', type=str, help='Thư mục index đầu ra, ví dụ bovw_index')
+  parser.add_argument('--work_dir', type=str, default=None, help='Thư mục checkpoint, mặc định <index_path>.work')
+  parser.add_argument('--n_clusters', type=int, default=1000, help='Số visual words')
+  parser.add_argument('--knn', type=int, default=5, help='Số word gần nhất giữ lại cho mỗi descriptor')
+  parser.add_argument('--workers', type=int, default=None, help='Số process, mặc định bằng số CPU')
+  parser.add_argument('--shard_size', type=int, default=256, help='Số ảnh mỗi shard')
+  parser.add_argument('--batch_size', type=int, default=4096, help='Batch size của MiniBatchKMeans')
+  parser.add_argument('--epochs', type=int, default=None,
+                      help='Số lượt partial_fit qua toàn bộ descriptors (mặc định 1; orb: 10 vòng k-majority)')
+  parser.add_argument('--descriptor', choices=DESCRIPTORS, default='sift',
+                      help='sift/rootsift: descriptor float, khoảng cách Euclid; orb: descriptor nhị phân, khoảng cách Hamming')
+  parser.add_argument('--pca_dim', type=int, default=0,
+                      help='Chiếu descriptor xuống số chiều này bằng PCA trước khi gán word, ví dụ 64 hoặc 32 (0: không dùng)')
+  parser.add_argument('--whiten', action='store_true', help='Whitening sau PCA (của descriptor và của VLAD)')
+  parser.add_argument('--aggregation', choices=['bovw', 'vlad'], default='bovw',
+                      help='bovw: histogram soft-assign K chiều; vlad: vector VLAD dày, ít chiều')
+  parser.add_argument('--vlad_words', type=int, default=64, help='Số tâm của codebook thô cho VLAD')
+  parser.add_argument('--vlad_dim', type=int, default=256, help='Số chiều vector VLAD sau PCA')
+  parser.add_argument('--max_side', type=int, default=1024, help='Resize ảnh có cạnh dài hơn trước khi trích SIFT')
+  parser.add_argument('--n_features', type=int, default=0, help='Số keypoint tối đa mỗi ảnh (0: không giới hạn)')
+  parser.add_argument('--thumbnail_size', type=int, default=256, help='Cạnh dài nhất của thumbnail (px)')
+  parser.add_argument('--geometry_keypoints', type=int, default=300,
+                      help='Số keypoint lưu lại mỗi ảnh cho bước xác minh hình học')
+  args = parser.parse_args()
+
+  builder = IndexBuilder(args.images_dir, args.index_path, work_dir=args.work_dir,
+                         n_clusters=args.n_clusters, knn=args.knn, workers=args.workers,
+                         shard_size=args.shard_size, batch_size=args.batch_size, epochs=args.epochs,
+                         max_side=args.max_side, n_features=args.n_features,
+                         thumbnail_size=args.thumbnail_size, geometry_keypoints=args.geometry_keypoints,
+                         descriptor=args.descriptor, pca_dim=args.pca_dim, whiten=args.whiten,
+                         aggregation=args.aggregation, vlad_words=args.vlad_words, vlad_dim=args.vlad_dim)
+  builder.run()
+  print(f"Đã build index {args.index_path}")
@@ -0,0 +1,172 @@
+# Tìm ảnh trùng / gần trùng trong toàn bộ BOVW index: tính cosine của mọi cặp ảnh theo khối
+# (block_size x block_size, một GEMM float32 mỗi khối), các khối được chia cho nhiều process.
+# Mỗi process tự mở index bằng memmap nên bộ nhớ chỉ phụ thuộc block_size, không phụ thuộc N.
+# Các cặp có điểm >= threshold của mỗi khối được gộp vào union-find ngay khi khối xong, cụm được
+# ghi ra JSON; danh sách cặp được ghi dần ra đĩa rồi gom thành file .npz cùng tên.
+#
+#   python -m my_utils.bovw_dedup bovw_index duplicates.json --threshold 0.9 --workers 8
+import os
+import json
+import time
+import argparse
+import itertools
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from my_utils.bovw_store import load_index
+from my_utils.npy_io import append_npy
+
+_worker = {}
+
+
+def _init_worker(index_path):
+  index = load_index(index_path)
+  _worker['histograms'] = index.histograms
+  _worker['deleted'] = index.deleted
+
+
+def _load_block(start, end):
+  block = np.array(_worker['histograms'][start:end], dtype=np.float32)
+  # Ảnh đã xóa được đặt vector 0 để không khớp với ảnh nào
+  block[_worker['deleted'][start:end]] = 0
+  return block
+
+
+def _compare_blocks(task):
+  (a_start, a_end), (b_start, b_end), threshold = task
+  a = _load_block(a_start, a_end)
+  b = a if a_start == b_start else _load_block(b_start, b_end)
+  scores = a @ b.T
+  mask = scores >= threshold
+  if a_start == b_start:
+    # Khối trên đường chéo: chỉ lấy nửa trên, bỏ cặp (i, i); lọc bằng mask chứ không đặt điểm = 0
+    mask &= ~np.tri(len(a), len(b), dtype=bool)
+  rows, cols = np.nonzero(mask)
+  return (rows + a_start).astype(np.int64), (cols + b_start).astype(np.int64), scores[rows, cols]
+
+
+def iter_duplicate_pairs(index_path, threshold=0.9, block_size=4096, workers=None):
+  # Sinh (rows, cols, scores) của từng khối ngay khi khối đó xong; chỉ tối đa 2 * workers khối được
+  # gửi đi cùng lúc để kết quả chưa gộp không dồn lại trong bộ nhớ
+  if not 0 < threshold <= 1:
+    raise ValueError(f"threshold phải nằm trong (0, 1], nhận được {threshold}")
+  n = len(load_index(index_path))
+  blocks = [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+  tasks = [(blocks[i], blocks[j], threshold) for i in range(len(blocks)) for j in range(i, len(blocks))]
+  print(f"{n} ảnh, {len(tasks)} khối {block_size}x{block_size}")
+
+  workers = workers or os.cpu_count()
+  remaining = iter(tasks)
+  pending, done = set(), 0
+  with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(index_path,)) as pool:
+    while True:
+      for task in itertools.islice(remaining, 2 * workers - len(pending)):
+        pending.add(pool.submit(_compare_blocks, task))
+      if not pending:
+        break
+      finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+      for future in finished:
+        done += 1
+        if done % 100 == 0 or done == len(tasks):
+          print(f"  {done}/{len(tasks)} khối")
+        yield future.result()
+
+
+class UnionFind:
+  # Union-find vector hóa: mỗi lô cặp được gộp bằng vài phép toán trên mảng thay vì vòng lặp Python.
+  # Luôn có parent[i] <= i (gốc là id nhỏ nhất của cụm) nên không thể tạo chu trình
+  def __init__(self, n):
+    self.parent = np.arange(n)
+    self.touched = np.zeros(n, dtype=bool)
+
+  def find(self, items):
+    roots = self.parent[items]
+    while True:
+      up = self.parent[roots]
+      if np.array_equal(up, roots):
+        return roots
+      roots = up
+
+  def union(self, rows, cols):
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    self.touched[rows] = True
+    self.touched[cols] = True
+    a, b = rows, cols
+    while len(a):
+      root_a, root_b = self.find(a), self.find(b)
+      differ = root_a != root_b
+      a, b, root_a, root_b = a[differ], b[differ], root_a[differ], root_b[differ]
+      # Nhiều cặp cùng gốc trong một lượt: giữ gốc nhỏ nhất, các cặp còn lại gộp ở lượt sau
+      np.minimum.at(self.parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+    # Nén đường đi cho các phần tử vừa gộp
+    self.parent[rows] = self.find(rows)
+    self.parent[cols] = self.find(cols)
+
+  def clusters(self):
+    # Các cụm có từ 2 ảnh trở lên, sắp theo kích thước giảm dần
+    members = np.flatnonzero(self.touched)
+    roots = self.find(members)
+    order = np.argsort(roots, kind='stable')
+    _, starts = np.unique(roots[order], return_index=True)
+    clusters = [group.tolist() for group in np.split(members[order], starts[1:])]
+    return sorted((c for c in clusters if len(c) > 1), key=len, reverse=True)
+
+
+def cluster_pairs(rows, cols, n):
+  union_find = UnionFind(n)
+  union_find.union(rows, cols)
+  return union_find.clusters()
+
+
+def find_duplicates(index_path, output_path, threshold=0.9, block_size=4096, workers=None):
+  # Cặp của mỗi khối được gộp vào union-find và ghi nối vào file tạm trên đĩa ngay khi khối xong:
+  # bộ nhớ không phụ thuộc tổng số cặp
+  started = time.perf_counter()
+  index = load_index(index_path)
+  union_find = UnionFind(len(index))
+  base = os.path.splitext(output_path)[0]
+  spill = {key: f'{base}_pairs.{key}.npy' for key in ('rows', 'cols', 'scores')}
+  for key, dtype in (('rows', np.int64), ('cols', np.int64), ('scores', np.float32)):
+    np.save(spill[key], np.zeros(0, dtype=dtype))
+  n_pairs = 0
+  for rows, cols, scores in iter_duplicate_pairs(index_path, threshold, block_size, workers):
+    if len(rows) == 0:
+      continue
+    union_find.union(rows, cols)
+    append_npy(spill['rows'], rows)
+    append_npy(spill['cols'], cols)
+    append_npy(spill['scores'], scores.astype(np.float32))
+    n_pairs += len(rows)
+  clusters = union_find.clusters()
+
+  # np.savez ghi memmap theo từng đoạn, không đọc cả file vào RAM
+  pairs_path = base + '_pairs.npz'
+  np.savez(pairs_path, **{key: np.load(path, mmap_mode='r') for key, path in spill.items()})
+  for path in spill.values():
+    os.remove(path)
+  result = {
+    'index': index_path,
+    'threshold': threshold,
+    'n_images': index.n_live,
+    'n_pairs': n_pairs,
+    'pairs_file': pairs_path,
+    'clusters': [[{'id': i, 'image_name': index.names[i]} for i in cluster] for cluster in clusters],
+  }
+  with open(output_path, 'w', encoding='utf-8') as f:
+    json.dump(result, f, indent=2, ensure_ascii=False)
+  print(f"{n_pairs} cặp, {len(clusters)} cụm trùng lặp ({time.perf_counter() - started:.1f}s)")
+  return result
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Tìm ảnh trùng / gần trùng trong BOVW index (all-pairs cosine).')
+  parser.add_argument('index_path', type=str, help='Thư mục BOVW index')
+  parser.add_argument('output', type=str, help='File JSON ghi các cụm trùng lặp')
+  parser.add_argument('--threshold', type=float, default=0.9, help='Cosine tối thiểu để coi là trùng')
+  parser.add_argument('--block_size', type=int, default=4096,
+                      help='Số ảnh mỗi khối; bộ nhớ mỗi process khoảng block_size^2 * 4 byte')
+  parser.add_argument('--workers', type=int, default=None, help='Số process, mặc định bằng số CPU')
+  args = parser.parse_args()
+
+  find_duplicates(args.index_path, args.output, args.threshold, args.block_size, args.workers)
@@ -0,0 +1,176 @@
+import cv2
+import numpy as np
+
+from my_utils.descriptor_pca import root_sift
+
+
+def keypoint_weights(keypoints, n_descriptors):
+  if not keypoints:
+    return np.full(n_descriptors, 1.0 / max(n_descriptors, 1), dtype=np.float32)
+  weights = np.array([kp.size * kp.response for kp in keypoints], dtype=np.float32)
+  total = weights.sum()
+  return weights / total if total > 0 else np.full(len(weights), 1.0 / len(weights), dtype=np.float32)
+
+
+def extract_sift(sift, image):
+  # Trả về (keypoints, descriptors đã chuẩn hóa L2 dạng float32, trọng số keypoint)
+  gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) == 3 else image
+  keypoints, descriptors = sift.detectAndCompute(gray, None)
+  if descriptors is None:
+    return keypoints, None, None
+  descriptors = descriptors.astype(np.float32)
+  descriptors /= np.maximum(np.linalg.norm(descriptors, axis=1, keepdims=True), 1e-12)
+  return keypoints, descriptors, keypoint_weights(keypoints, len(descriptors))
+
+
+def extract_orb(orb, image):
+  # Như extract_sift nhưng descriptor là bit đã pack sẵn dạng uint8 (N, 32)
+  gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) == 3 else image
+  keypoints, descriptors = orb.detectAndCompute(gray, None)
+  if descriptors is None:
+    return keypoints, None, None
+  return keypoints, descriptors, keypoint_weights(keypoints, len(descriptors))
+
+
+# Loại descriptor của index (meta 'descriptor'): sift, rootsift (float, L2) hoặc orb (nhị phân, Hamming)
+DESCRIPTORS = ('sift', 'rootsift', 'orb')
+
+
+def create_extractor(descriptor='sift', n_features=0):
+  if descriptor in ('sift', 'rootsift'):
+    return cv2.SIFT_create(nfeatures=n_features)
+  if descriptor == 'orb':
+    # ORB bắt buộc có số keypoint tối đa
+    return cv2.ORB_create(nfeatures=n_features or 1000)
+  raise ValueError(f"Không hỗ trợ descriptor {descriptor}")
+
+
+def extract_features(extractor, image, descriptor='sift'):
+  if descriptor == 'orb':
+    return extract_orb(extractor, image)
+  keypoints, descriptors, kp_weights = extract_sift(extractor, image)
+  if descriptor == 'rootsift' and descriptors is not None:
+    descriptors = root_sift(descriptors)
+  return keypoints, descriptors, kp_weights
+
+
+def create_encoder(descriptor, vocabulary, idf_weights=None, knn=5, **kwargs):
+  if descriptor == 'orb':
+    return BinaryAssignEncoder(vocabulary, idf_weights, knn=knn)
+  return SoftAssignEncoder(vocabulary, idf_weights, knn=knn, **kwargs)
+
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hamming_distances(a, b):
+  # Khoảng cách Hamming (N, K) giữa hai tập descriptor nhị phân đã pack (uint8): XOR rồi popcount.
+  # numpy >= 2.0 có popcount sẵn, chạy trên từng word 64-bit khi số byte chia hết cho 8
+  if not hasattr(np, 'bitwise_count'):
+    return _POPCOUNT[a[:, None, :] ^ b[None, :, :]].sum(axis=2, dtype=np.uint16)
+  if a.shape[1] % 8 == 0:
+    a, b = a.view(np.uint64), b.view(np.uint64)
+  return np.bitwise_count(a[:, None, :] ^ b[None, :, :]).sum(axis=2, dtype=np.uint16)
+
+
+class SoftAssignEncoder:
+  # Soft assignment dùng chung cho lúc build index và lúc query:
+  # mỗi descriptor chỉ giữ knn word gần nhất (knn=None: giữ cả K word như bản dense cũ).
+  # projection (PCAProjection): descriptor được chiếu xuống số chiều của vocabulary trước khi gán
+  def __init__(self, vocabulary, idf_weights=None, knn=5, tree=None, tree_beam=3, chunk_size=2048,
+               projection=None):
+    self.vocabulary = np.ascontiguousarray(vocabulary, dtype=np.float32)
+    self.n_clusters = len(self.vocabulary)
+    self.centre_norms = np.einsum('kd,kd->k', self.vocabulary, self.vocabulary)
+    self.idf_weights = None if idf_weights is None else np.asarray(idf_weights, dtype=np.float32)
+    self.knn = knn
+    self.tree = tree
+    self.tree_beam = tree_beam
+    self.chunk_size = chunk_size
+    self.projection = projection
+
+  def assign(self, descriptors):
+    # (word ids, khoảng cách Euclid) dạng (N, k)
+    if self.projection is not None:
+      descriptors = self.projection.transform(descriptors)
+    descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+    if self.tree is not None:
+      return self.tree.query(descriptors, k=self.knn or 5, beam=self.tree_beam)
+
+    k = self.n_clusters if self.knn is None else min(self.knn, self.n_clusters)
+    n = len(descriptors)
+    words = np.empty((n, k), dtype=np.int64)
+    distances = np.empty((n, k), dtype=np.float32)
+    # ||x - c||^2 = ||x||^2 + ||c||^2 - 2 x.c, phần x.c là một GEMM float32; chia khối để
+    # bộ nhớ tạm chỉ O(chunk_size * K)
+    for start in range(0, n, self.chunk_size):
+      x = descriptors[start:start + self.chunk_size]
+      d = x @ self.vocabulary.T
+      d *= -2
+      d += self.centre_norms
+      d += np.einsum('nd,nd->n', x, x)[:, None]
+      np.maximum(d, 0, out=d)
+      if k < self.n_clusters:
+        idx = np.argpartition(d, k - 1, axis=1)[:, :k]
+        d = np.take_along_axis(d, idx, axis=1)
+      else:
+        idx = np.broadcast_to(np.arange(k), d.shape)
+      words[start:start + len(x)] = idx
+      distances[start:start + len(x)] = np.sqrt(d)
+    return words, distances
+
+  def encode_tf(self, descriptors, kp_weights=None):
+    # Histogram chưa nhân IDF (term frequency mềm)
+    if kp_weights is None:
+      kp_weights = np.full(len(descriptors), 1.0 / len(descriptors), dtype=np.float32)
+    words, distances = self.assign(descriptors)
+
+    # sigma phụ thuộc số word giữ lại (knn): query phải encode cùng knn với database
+    # (query_knn_words trong my_utils/bovw_searcher.py)
+    finite = np.isfinite(distances)
+    sigma = np.mean(distances[finite]) / 2
+    weights = np.exp(-distances / (2 * sigma**2))
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    if words.shape[1] == self.n_clusters and self.tree is None:
+      return (kp_weights @ weights).astype(np.float32)
+    return np.bincount(words.ravel(), weights=(weights * kp_weights[:, None]).ravel(),
+                       minlength=self.n_clusters).astype(np.float32)
+
+  def apply_idf(self, tf):
+    histogram = tf * self.idf_weights if self.idf_weights is not None else tf.astype(np.float32)
+    norm = np.linalg.norm(histogram, axis=-1, keepdims=True)
+    return (histogram / np.maximum(norm, 1e-12)).astype(np.float32)
+
+  def encode(self, descriptors, kp_weights=None):
+    return self.apply_idf(self.encode_tf(descriptors, kp_weights))
+
+
+class BinaryAssignEncoder(SoftAssignEncoder):
+  # Soft assignment cho descriptor nhị phân: vocabulary là các tâm nhị phân (k-majority, xem
+  # my_utils/kmajority.py), khoảng cách là Hamming thay cho Euclid
+  def __init__(self, vocabulary, idf_weights=None, knn=5, chunk_size=256):
+    self.vocabulary = np.ascontiguousarray(vocabulary, dtype=np.uint8)
+    self.n_clusters = len(self.vocabulary)
+    self.idf_weights = None if idf_weights is None else np.asarray(idf_weights, dtype=np.float32)
+    self.knn = knn
+    self.tree = None
+    self.chunk_size = chunk_size
+
+  def assign(self, descriptors):
+    descriptors = np.ascontiguousarray(descriptors, dtype=np.uint8)
+    k = self.n_clusters if self.knn is None else min(self.knn, self.n_clusters)
+    n = len(descriptors)
+    words = np.empty((n, k), dtype=np.int64)
+    distances = np.empty((n, k), dtype=np.float32)
+    # Bộ nhớ tạm O(chunk_size * K * số byte descriptor)
+    for start in range(0, n, self.chunk_size):
+      d = hamming_distances(descriptors[start:start + self.chunk_size], self.vocabulary)
+      if k < self.n_clusters:
+        idx = np.argpartition(d, k - 1, axis=1)[:, :k]
+        d = np.take_along_axis(d, idx, axis=1)
+      else:
+        idx = np.broadcast_to(np.arange(k), d.shape)
+      words[start:start + len(d)] = idx
+      distances[start:start + len(d)] = d
+    return words, distances
@@ -0,0 +1,67 @@
+import numpy as np
+
+
+class InvertedIndex:
+  # Posting list của từng visual word lưu dạng CSC: postings của word w nằm trong
+  # doc_ids/weights[indptr[w]:indptr[w + 1]]
+  def __init__(self, histograms, max_words_per_image=100, chunk_size=4096):
+    self.n_images, self.n_words = histograms.shape
+    self.max_words_per_image = max_words_per_image
+
+    doc_ids, word_ids, weights = [], [], []
+    for start in range(0, self.n_images, chunk_size):
+      block = np.asarray(histograms[start:start + chunk_size], dtype=np.float32)
+      if max_words_per_image is not None and max_words_per_image < self.n_words:
+        # Chỉ giữ các word trội nhất của mỗi ảnh
+        cols = np.argpartition(-block, max_words_per_image - 1, axis=1)[:, :max_words_per_image]
+        rows = np.repeat(np.arange(len(block)), max_words_per_image)
+        cols = cols.ravel()
+        vals = block[rows, cols]
+        keep = vals > 0
+        rows, cols, vals = rows[keep], cols[keep], vals[keep]
+      else:
+        rows, cols = np.nonzero(block)
+        vals = block[rows, cols]
+      doc_ids.append((rows + start).astype(np.int32))
+      word_ids.append(cols.astype(np.int32))
+      weights.append(vals.astype(np.float32))
+
+    doc_ids = np.concatenate(doc_ids) if doc_ids else np.empty(0, dtype=np.int32)
+    word_ids = np.concatenate(word_ids) if word_ids else np.empty(0, dtype=np.int32)
+    weights = np.concatenate(weights) if weights else np.empty(0, dtype=np.float32)
+
+    order = np.argsort(word_ids, kind='stable')
+    self.doc_ids = doc_ids[order]
+    self.weights = weights[order]
+    self.indptr = np.zeros(self.n_words + 1, dtype=np.int64)
+    np.cumsum(np.bincount(word_ids, minlength=self.n_words), out=self.indptr[1:])
+
+  def __len__(self):
+    return len(self.doc_ids)
+
+  def posting_lengths(self):
+    return np.diff(self.indptr)
+
+  def query_words(self, query, n_query_words=None):
+    words = np.flatnonzero(query)
+    if n_query_words is not None and n_query_words < len(words):
+      words = words[np.argpartition(-query[words], n_query_words - 1)[:n_query_words]]
+    return words
+
+  def search(self, query, n_query_words=None):
+    # Trả về (ids ứng viên, điểm) chỉ từ postings của các word trong query,
+    # không phụ thuộc kích thước database
+    words = self.query_words(query, n_query_words)
+    starts = self.indptr[words]
+    lengths = self.indptr[words + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+      return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(total) - np.repeat(offsets - starts, lengths)
+    contributions = self.weights[positions] * np.repeat(query[words].astype(np.float32), lengths)
+
+    candidates, inverse = np.unique(self.doc_ids[positions], return_inverse=True)
+    scores = np.bincount(inverse, weights=contributions).astype(np.float32)
+    return candidates.astype(np.int64), scores
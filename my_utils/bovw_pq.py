@@ -0,0 +1,128 @@
+# Nén vector BOVW trong index:
+#   float16  histograms.npy lưu ở float16 (một nửa dung lượng, điểm gần như không đổi)
+#   pq       product quantization: vector K chiều chia thành m đoạn, mỗi đoạn lưu 1 byte là id
+#            centroid gần nhất (pq_codes.npy). Điểm cosine tính bằng bảng tra (asymmetric
+#            distance), histograms.npy float32 vẫn nằm trên đĩa để re-rank chính xác short list
+#
+#   python -m my_utils.bovw_pq bovw_index --encoding pq --m 50
+#   python -m my_utils.bovw_pq bovw_index --encoding float16
+import os
+import argparse
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+from my_utils.bovw_store import load_index, write_meta
+
+PQ_FILE = 'pq.npz'
+PQ_CODES_FILE = 'pq_codes.npy'
+
+
+class ProductQuantizer:
+  def __init__(self, dim, m=50, n_centroids=256, codebooks=None):
+    self.dim = dim
+    self.m = m
+    self.dsub = -(-dim // m)
+    self.n_centroids = n_centroids
+    self.codebooks = codebooks
+
+  def _split(self, x):
+    x = np.asarray(x, dtype=np.float32)
+    pad = self.m * self.dsub - self.dim
+    if pad:
+      x = np.pad(x, [(0, 0)] * (x.ndim - 1) + [(0, pad)])
+    return x.reshape(x.shape[:-1] + (self.m, self.dsub))
+
+  def fit(self, x, random_state=42):
+    sub = self._split(x)
+    self.n_centroids = min(self.n_centroids, len(x))
+    self.codebooks = np.empty((self.m, self.n_centroids, self.dsub), dtype=np.float32)
+    for j in range(self.m):
+      kmeans = MiniBatchKMeans(n_clusters=self.n_centroids, random_state=random_state,
+                               batch_size=max(1024, self.n_centroids * 4), n_init=1)
+      self.codebooks[j] = kmeans.fit(sub[:, j]).cluster_centers_
+    return self
+
+  def encode(self, x, chunk_size=4096):
+    x = np.atleast_2d(x)
+    codes = np.empty((len(x), self.m), dtype=np.uint8)
+    norms = np.einsum('jcd,jcd->jc', self.codebooks, self.codebooks)
+    for start in range(0, len(x), chunk_size):
+      sub = self._split(x[start:start + chunk_size])
+      # argmin ||x - c||^2 = argmin ||c||^2 - 2 x.c cho từng đoạn
+      d = norms[None] - 2 * np.einsum('njd,jcd->njc', sub, self.codebooks)
+      codes[start:start + len(sub)] = np.argmin(d, axis=2)
+    return codes
+
+  def decode(self, codes):
+    x = self.codebooks[np.arange(self.m), codes].reshape(len(codes), -1)
+    return x[:, :self.dim]
+
+  def lookup_table(self, query):
+    # (m, n_centroids): tích vô hướng của từng đoạn query với từng centroid
+    return np.einsum('jd,jcd->jc', self._split(query), self.codebooks)
+
+  def scores(self, codes, query, chunk_size=65536):
+    table = self.lookup_table(query)
+    out = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), chunk_size):
+      block = codes[start:start + chunk_size]
+      acc = np.zeros(len(block), dtype=np.float32)
+      for j in range(self.m):
+        acc += table[j, block[:, j]]
+      out[start:start + len(block)] = acc
+    return out
+
+  def save(self, path):
+    np.savez(path, codebooks=self.codebooks, dim=np.int64(self.dim), m=np.int64(self.m))
+
+  @classmethod
+  def load(cls, path):
+    data = np.load(path)
+    codebooks = data['codebooks']
+    return cls(int(data['dim']), int(data['m']), codebooks.shape[1], codebooks=codebooks)
+
+
+def compress_index(path, encoding, m=50, n_train=65536, chunk_size=4096):
+  index = load_index(path)
+  histograms_path = os.path.join(path, 'histograms.npy')
+  meta = dict(index.meta)
+
+  if encoding == 'float16':
+    tmp_path = histograms_path + '.tmp'
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=index.histograms.shape)
+    for start in range(0, len(index), chunk_size):
+      out[start:start + chunk_size] = index.histograms[start:start + chunk_size]
+    out.flush()
+    del out, index
+    os.replace(tmp_path, histograms_path)
+  elif encoding == 'pq':
+    live = np.flatnonzero(~index.deleted)
+    rng = np.random.default_rng(42)
+    sample = np.sort(rng.choice(live, min(n_train, len(live)), replace=False))
+    pq = ProductQuantizer(index.histograms.shape[1], m=m).fit(index.histograms[sample])
+    pq.save(os.path.join(path, PQ_FILE))
+    codes = np.lib.format.open_memmap(os.path.join(path, PQ_CODES_FILE), mode='w+',
+                                      dtype=np.uint8, shape=(len(index), pq.m))
+    for start in range(0, len(index), chunk_size):
+      codes[start:start + chunk_size] = pq.encode(index.histograms[start:start + chunk_size])
+    codes.flush()
+    meta['pq_m'] = pq.m
+  elif encoding != 'float32':
+    raise ValueError(f"Không hỗ trợ encoding {encoding}")
+
+  meta['encoding'] = encoding
+  write_meta(path, meta)
+  return meta
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Nén vector trong BOVW index (float16 hoặc product quantization).')
+  parser.add_argument('index_path', type=str, help='Thư mục BOVW index')
+  parser.add_argument('--encoding', choices=['float16', 'pq'], default='pq')
+  parser.add_argument('--m', type=int, default=50, help='Số đoạn (byte) mỗi vector khi dùng PQ')
+  parser.add_argument('--n_train', type=int, default=65536, help='Số vector dùng để train codebook PQ')
+  args = parser.parse_args()
+
+  meta = compress_index(args.index_path, args.encoding, m=args.m, n_train=args.n_train)
+  print(f"Đã nén index {args.index_path} ({meta['encoding']})")
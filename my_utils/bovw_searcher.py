@@ -0,0 +1,331 @@
+import os
+import sys
+import time
+import pickle
+import threading
+
+import cv2
+import numpy as np
+from sklearn.preprocessing import normalize
+
+from my_utils.bovw_encoder import create_encoder, create_extractor, extract_features
+from my_utils.bovw_inverted import InvertedIndex
+from my_utils.bovw_pq import ProductQuantizer, PQ_FILE
+from my_utils.bovw_verify import SpatialVerifier, select_keypoints
+from my_utils.bovw_vlad import load_vlad
+from my_utils.bovw_store import is_index, load_index
+from my_utils.descriptor_pca import load_projection
+from my_utils.query_cache import QueryCache
+from my_utils.vocab_tree import VocabularyTree, TREE_FILE
+
+
+def get_rss_mb():
+  # RSS hiện tại của process; ngoài Linux thì dùng peak RSS
+  try:
+    with open('/proc/self/statm') as f:
+      pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+  except (OSError, ValueError, AttributeError):
+    try:
+      import resource
+    except ImportError:
+      return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def query_knn_words(index_knn, knn_words=None, assignment='exact'):
+  # Bandwidth sigma của soft assignment là trung bình khoảng cách tới các word được giữ lại, nên
+  # histogram query chỉ so được với database khi dùng đúng knn lúc build (meta 'knn_words')
+  if knn_words is None:
+    knn_words = index_knn
+  if knn_words != index_knn:
+    raise ValueError(f"Index được encode với knn_words={index_knn}, không query được với knn_words={knn_words}")
+  if assignment == 'tree' and knn_words is None:
+    raise ValueError("Index encode dense (trên toàn bộ K word) không dùng được cây từ vựng, "
+                     "hãy build lại index với --knn")
+  return knn_words
+
+
+class QueryFeatures:
+  # Những gì một ảnh query cần cho chấm điểm và xác minh hình học; histogram là None nếu ảnh
+  # không có keypoint nào
+  __slots__ = ('points', 'descriptors', 'kp_weights', 'histogram')
+
+  def __init__(self, points, descriptors, kp_weights, histogram):
+    self.points = points
+    self.descriptors = descriptors
+    self.kp_weights = kp_weights
+    self.histogram = histogram
+
+  @property
+  def nbytes(self):
+    return sum(a.nbytes for a in (self.points, self.descriptors, self.kp_weights, self.histogram)
+               if a is not None)
+
+
+class BOVWSearcher:
+  def __init__(self, database_path, assignment='exact', knn_words=None, tree_beam=3, rerank_size=100,
+               query_cache_mb=64):
+    print("Đang load BOVW database...")
+    start = time.perf_counter()
+    rss_before = get_rss_mb()
+
+    if is_index(database_path):
+      self._load_index(database_path)
+    else:
+      self._load_pickle(database_path)
+
+    # knn_words: số word giữ lại cho mỗi descriptor, mặc định lấy theo lúc build index
+    # (None với pickle cũ: soft assignment trên toàn bộ K word).
+    # assignment='tree': tìm các word gần nhất qua cây từ vựng thay vì so với cả K word
+    index_knn = self.index.meta.get('knn_words') if self.index is not None else None
+    knn_words = query_knn_words(index_knn, knn_words, assignment)
+    if assignment == 'tree' and (self.descriptor == 'orb' or self.aggregation == 'vlad'):
+      raise ValueError("Cây từ vựng chỉ hỗ trợ histogram BOVW với descriptor SIFT")
+    self.assignment = assignment
+    self.knn_words = knn_words
+    self.vocab_tree = self._load_tree(database_path) if assignment == 'tree' else None
+    if self.aggregation == 'vlad':
+      # Index VLAD: query được encode thành vector VLAD, phần chấm điểm giữ nguyên
+      self.encoder = load_vlad(database_path, self.projection)
+    else:
+      encoder_kwargs = {}
+      if self.descriptor != 'orb':
+        encoder_kwargs = {'tree': self.vocab_tree, 'tree_beam': tree_beam, 'projection': self.projection}
+      self.encoder = create_encoder(self.descriptor, self.vocabulary, self.idf_weights, knn=knn_words,
+                                    **encoder_kwargs)
+
+    # Index nén PQ: chấm điểm trên mã PQ, rồi re-rank rerank_size ứng viên bằng vector gốc trên đĩa
+    self.rerank_size = rerank_size
+
+    # Trích đặc trưng query bằng đúng loại descriptor của index (meta 'descriptor')
+    self.extractor = create_extractor(self.descriptor)
+    # Đặc trưng của các ảnh query gần đây theo hash nội dung: rerun cùng ảnh chỉ còn bước chấm điểm
+    self.query_cache = QueryCache(query_cache_mb * 1024 * 1024)
+    self.inverted_index = None
+    self._index_lock = threading.Lock()
+
+    self.load_time = time.perf_counter() - start
+    self.memory_mb = get_rss_mb()
+    self.database_memory_mb = self.memory_mb - rss_before
+    print(f"Đã load database với {len(self)} ảnh "
+          f"({self.load_time:.2f}s, RSS {self.memory_mb:.0f} MB)")
+
+  def _load_index(self, path):
+    # Index memory-mapped: histograms và thumbnails nằm trên đĩa, chỉ đọc phần cần dùng
+    self.index = load_index(path)
+    self.n_clusters = self.index.n_clusters
+    self.descriptor = self.index.meta.get('descriptor', 'sift')
+    self.aggregation = self.index.meta.get('aggregation', 'bovw')
+    # RootSIFT/SIFT đã chiếu PCA: vocabulary ở không gian đã chiếu, query được chiếu trong encoder
+    self.projection = load_projection(path)
+    vocabulary_dtype = np.uint8 if self.descriptor == 'orb' else np.float32
+    self.vocabulary = np.ascontiguousarray(self.index.vocabulary, dtype=vocabulary_dtype)
+    self.idf_weights = np.asarray(self.index.idf_weights, dtype=np.float32)
+    self.image_names = self.index.names
+    self.histograms = self.index.histograms
+    self.images = None
+    self.deleted = self.index.deleted if self.index.deleted.any() else None
+    self.encoding = self.index.meta.get('encoding', 'float32')
+    self.pq, self.pq_codes = None, None
+    if self.encoding == 'pq':
+      self.pq = ProductQuantizer.load(os.path.join(path, PQ_FILE))
+      self.pq_codes = np.ascontiguousarray(self.index.pq_codes)
+    self.verifier = None
+    if self.index.geometry is not None:
+      norm = cv2.NORM_HAMMING if self.descriptor == 'orb' else cv2.NORM_L2
+      self.verifier = SpatialVerifier(self.index.geometry, norm=norm)
+    self._meta_mtime = os.path.getmtime(os.path.join(path, 'meta.json'))
+
+  def _load_pickle(self, path):
+    with open(path, 'rb') as f:
+      data = pickle.load(f)
+    self.index = None
+    self.descriptor = 'sift'
+    self.aggregation = 'bovw'
+    self.projection = None
+    self.n_clusters = data['n_clusters']
+    self.vocabulary = np.ascontiguousarray(data['vocabulary'], dtype=np.float32)
+    self.idf_weights = np.asarray(data.get('idf_weights', np.ones(self.n_clusters)), dtype=np.float32)
+
+    # Chuyển database từ dict sang các mảng liên tục để query không phải duyệt dict
+    database = data['database']
+    self.image_names = list(database.keys())
+    # Chuẩn hóa L2 sẵn ở float32: cosine similarity chỉ còn là một phép nhân ma trận
+    histograms = np.stack([database[name]['histogram'] for name in self.image_names]).astype(np.float32)
+    self.histograms = normalize(histograms, norm='l2', axis=1)
+    self.images = [database[name]['image'] for name in self.image_names]
+    self.deleted = None
+    self.encoding = 'float32'
+    self.pq, self.pq_codes = None, None
+    self.verifier = None
+
+  def _load_tree(self, database_path):
+    tree_path = os.path.join(database_path, TREE_FILE)
+    if self.index is not None and os.path.isfile(tree_path):
+      return VocabularyTree.load(tree_path)
+    return VocabularyTree(self.vocabulary)
+
+  def get_image(self, i):
+    if self.images is not None:
+      return self.images[i]
+    return self.index.thumbnails.get(i)
+
+  def is_stale(self):
+    # Index đã được cập nhật (bovw_update) kể từ lúc load
+    if self.index is None:
+      return False
+    try:
+      return os.path.getmtime(os.path.join(self.index.path, 'meta.json')) != self._meta_mtime
+    except OSError:
+      return False
+
+  def __len__(self):
+    if self.deleted is not None:
+      return int(len(self.deleted) - self.deleted.sum())
+    return len(self.histograms)
+
+  def extract(self, image):
+    return extract_features(self.extractor, image, self.descriptor)
+
+  def process_query_image(self, image):
+    try:
+      _, descriptors, kp_weights = self.extract(image)
+      if descriptors is None:
+        return None
+      return self.encoder.encode(descriptors, kp_weights)
+
+    except Exception as e:
+      print(f"Lỗi khi xử lý ảnh: {str(e)}")
+      return None
+
+  def build_inverted_index(self, max_words_per_image=100):
+    with self._index_lock:
+      if self.inverted_index is None or self.inverted_index.max_words_per_image != max_words_per_image:
+        self.inverted_index = InvertedIndex(self.histograms, max_words_per_image=max_words_per_image)
+    return self.inverted_index
+
+  def _top_k(self, scores, top_k):
+    top_k = min(top_k, scores.shape[-1])
+    if top_k <= 0:
+      return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, top_k - 1)[:top_k]
+    return idx[np.argsort(-scores[idx])]
+
+  def _make_results(self, idx, scores, with_images=True):
+    results = [{
+      'id': int(i),
+      'image_name': self.image_names[i],
+      'score': float(score),
+    } for i, score in zip(idx, scores) if np.isfinite(score)]
+    if with_images:
+      self._attach_images(results)
+    return results
+
+  def _attach_images(self, results):
+    # Chỉ decode ảnh cho các kết quả thực sự hiển thị
+    for r in results:
+      r['image'] = self.get_image(r['id'])
+    return results
+
+  def _score(self, query_features, chunk_size=16384):
+    if self.pq is not None:
+      return self.pq.scores(self.pq_codes, query_features)
+    if self.histograms.dtype == np.float32:
+      return self.histograms @ query_features
+    # float16: nhân theo khối ở float32 để dùng BLAS
+    scores = np.empty(len(self.histograms), dtype=np.float32)
+    for start in range(0, len(self.histograms), chunk_size):
+      block = np.asarray(self.histograms[start:start + chunk_size], dtype=np.float32)
+      scores[start:start + len(block)] = block @ query_features
+    return scores
+
+  def _rerank(self, idx, query_features, top_k):
+    # Tính lại điểm chính xác cho short list từ vector gốc (chỉ đọc các dòng cần thiết)
+    idx = np.sort(idx)
+    exact = np.asarray(self.histograms[idx], dtype=np.float32) @ query_features
+    order = self._top_k(exact, top_k)
+    return idx[order], exact[order]
+
+  def search_features(self, query_features, top_k=5, n_query_words=None, with_images=True):
+    query_features = query_features.astype(np.float32)
+    # Vector VLAD dày và có giá trị âm, không dùng được inverted index
+    if n_query_words and self.aggregation == 'bovw':
+      # Inverted index: chi phí theo số postings của các word trong query
+      index = self.build_inverted_index() if self.inverted_index is None else self.inverted_index
+      candidates, scores = index.search(query_features, n_query_words)
+      if self.deleted is not None:
+        keep = ~self.deleted[candidates]
+        candidates, scores = candidates[keep], scores[keep]
+      order = self._top_k(scores, top_k)
+      return self._make_results(candidates[order], scores[order], with_images)
+
+    scores = self._score(query_features)
+    if self.deleted is not None:
+      scores[self.deleted] = -np.inf
+    if self.pq is not None and self.rerank_size:
+      shortlist = self._top_k(scores, max(top_k, self.rerank_size))
+      shortlist = shortlist[np.isfinite(scores[shortlist])]
+      return self._make_results(*self._rerank(shortlist, query_features, top_k), with_images)
+    idx = self._top_k(scores, top_k)
+    return self._make_results(idx, scores[idx], with_images)
+
+  def encode_query(self, image):
+    keypoints, descriptors, kp_weights = self.extract(image)
+    if descriptors is None:
+      return QueryFeatures(None, None, None, None)
+    points = np.array([kp.pt for kp in keypoints], dtype=np.float32)
+    return QueryFeatures(points, descriptors, kp_weights, self.encoder.encode(descriptors, kp_weights))
+
+  def query_features(self, query_image, cache_key=None):
+    # query_image có thể là hàm trả về ảnh: khi trúng cache thì không cần decode ảnh nữa
+    def compute():
+      return self.encode_query(query_image() if callable(query_image) else query_image)
+    if cache_key is None:
+      return compute()
+    return self.query_cache.get_or_compute(cache_key, compute, lambda f: f.nbytes)
+
+  def search_query(self, features, top_k=5, n_query_words=None, verify_top=0, budget_ms=200):
+    # verify_top > 0: xác minh hình học verify_top ứng viên đầu trong budget_ms rồi sắp xếp lại
+    if features.histogram is None:
+      return []
+    if not verify_top or self.verifier is None:
+      return self.search_features(features.histogram, top_k, n_query_words)
+
+    results = self.search_features(features.histogram, max(top_k, verify_top), n_query_words, with_images=False)
+    points, descriptors = select_keypoints(features.points, features.descriptors, features.kp_weights,
+                                           self.index.meta.get('geometry_keypoints', 300))
+    results = self.verifier.rerank(points, descriptors, results, budget_ms)
+    return self._attach_images(results[:top_k])
+
+  def search_image(self, query_image, top_k=5, n_query_words=None, verify_top=0, budget_ms=200,
+                   cache_key=None):
+    # cache_key: hash nội dung ảnh (QueryCache.key_for), None thì không dùng cache
+    try:
+      features = self.query_features(query_image, cache_key)
+    except Exception as e:
+      print(f"Lỗi khi xử lý ảnh: {str(e)}")
+      return []
+    return self.search_query(features, top_k, n_query_words, verify_top, budget_ms)
+
+  def search_batch(self, images, top_k=5):
+    features = [self.process_query_image(image) for image in images]
+    valid = [i for i, f in enumerate(features) if f is not None]
+    results = [[] for _ in images]
+    if not valid:
+      return results
+
+    queries = np.stack([features[i] for i in valid]).astype(np.float32)
+    if self.pq is not None or self.histograms.dtype != np.float32:
+      for row, i in enumerate(valid):
+        results[i] = self.search_features(queries[row], top_k)
+      return results
+
+    scores = queries @ self.histograms.T
+    if self.deleted is not None:
+      scores[:, self.deleted] = -np.inf
+    for row, i in enumerate(valid):
+      idx = self._top_k(scores[row], top_k)
+      results[i] = self._make_results(idx, scores[row, idx])
+    return results
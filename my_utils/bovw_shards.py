@@ -0,0 +1,250 @@
+# Chia BOVW index thành nhiều shard trên đĩa và tìm kiếm song song (scatter-gather):
+#   - mỗi shard là một BOVW index đầy đủ (my_utils/bovw_store.py) trong <path>/shard_XXX,
+#     shards.json ghi danh sách shard và offset id toàn cục của từng shard
+#   - ShardedSearcher giữ một process pool sống suốt vòng đời searcher; mỗi process mở các shard
+#     bằng memmap một lần rồi dùng lại cho mọi query
+#   - query được trích đặc trưng + encode một lần ở process chính, gửi tới mọi shard, top-k của
+#     từng shard được gộp bằng heap
+#
+#   python -m my_utils.bovw_shards bovw_index bovw_sharded --n_shards 16
+import os
+import json
+import time
+import heapq
+import shutil
+import weakref
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from threadpoolctl import threadpool_limits
+
+from my_utils.bovw_pq import PQ_FILE, PQ_CODES_FILE, compress_index
+from my_utils.bovw_searcher import BOVWSearcher, get_rss_mb
+from my_utils.bovw_store import is_index, load_index, save_index, write_meta
+
+SHARDS_FILE = 'shards.json'
+FORMAT_NAME = 'bovw-sharded'
+# Các file dùng chung của index gốc, chép nguyên sang từng shard
+SHARED_FILES = ('projection.npz', 'vlad.npz', 'vocab_tree.npz')
+
+
+class _Rows:
+  # Xem một tập dòng của histograms (memmap) như một mảng, đọc theo khối khi save_index ghi shard
+  def __init__(self, array, ids):
+    self.array = array
+    self.ids = ids
+    self.shape = (len(ids),) + array.shape[1:]
+
+  def __getitem__(self, key):
+    return np.asarray(self.array[self.ids[key]], dtype=np.float32)
+
+
+def is_sharded(path):
+  return os.path.isfile(os.path.join(path, SHARDS_FILE))
+
+
+def split_index(index_path, out_path, n_shards):
+  # Ảnh đã xóa (tombstone) không được chép sang shard
+  index = load_index(index_path)
+  live = np.flatnonzero(~index.deleted)
+  n_shards = max(1, min(n_shards, len(live)))
+  encoding = index.meta.get('encoding', 'float32')
+  keep = ('knn_words', 'descriptor', 'geometry_keypoints', 'geometry_descriptor_size', 'pca_dim',
+          'pca_whiten', 'aggregation')
+  meta = {key: index.meta[key] for key in keep if key in index.meta}
+
+  shards, offsets = [], [0]
+  for s, ids in enumerate(np.array_split(live, n_shards)):
+    name = f'shard_{s:03d}'
+    path = os.path.join(out_path, name)
+    save_index(path,
+               vocabulary=index.vocabulary,
+               idf_weights=index.idf_weights,
+               histograms=_Rows(index.histograms, ids),
+               names=[index.names[i] for i in ids],
+               images=(index.thumbnails.get_bytes(i) for i in ids),
+               thumbnail_size=index.meta.get('thumbnail_size', 256),
+               thumbnail_quality=index.meta.get('thumbnail_quality', 85),
+               meta=meta,
+               geometry=(index.geometry.get_bytes(i) for i in ids) if index.geometry is not None else None)
+    for file_name in SHARED_FILES:
+      if os.path.isfile(os.path.join(index_path, file_name)):
+        shutil.copyfile(os.path.join(index_path, file_name), os.path.join(path, file_name))
+    if encoding == 'float16':
+      compress_index(path, 'float16')
+    elif encoding == 'pq':
+      # Dùng chung codebook PQ, chỉ cắt mã của các ảnh trong shard
+      shutil.copyfile(os.path.join(index_path, PQ_FILE), os.path.join(path, PQ_FILE))
+      np.save(os.path.join(path, PQ_CODES_FILE), np.asarray(index.pq_codes[ids]))
+      shard = load_index(path)
+      write_meta(path, dict(shard.meta, encoding='pq', pq_m=index.meta['pq_m']))
+    shards.append(name)
+    offsets.append(offsets[-1] + len(ids))
+    print(f"{name}: {len(ids)} ảnh")
+
+  manifest = {
+    'format': FORMAT_NAME,
+    'version': 1,
+    'source': os.path.abspath(index_path),
+    'n_images': int(offsets[-1]),
+    'shards': shards,
+    'offsets': offsets,
+  }
+  with open(os.path.join(out_path, SHARDS_FILE), 'w', encoding='utf-8') as f:
+    json.dump(manifest, f, indent=2)
+  return manifest
+
+
+_worker = {}
+
+
+def _init_worker(shard_paths, searcher_kwargs):
+  # Mỗi process chỉ dùng một thread BLAS/OpenCV, song song hóa nằm ở số process
+  threadpool_limits(1)
+  cv2.setNumThreads(1)
+  # Shard được mở bằng memmap nên mọi process mở hết các shard mà không tốn thêm RAM đáng kể
+  # (page cache dùng chung); task của shard nào cũng chạy được ở process nào
+  _worker['searchers'] = [BOVWSearcher(path, query_cache_mb=0, **searcher_kwargs) for path in shard_paths]
+
+
+def _search_shard(task):
+  s, queries, top_k, n_query_words = task
+  searcher = _worker['searchers'][s]
+  return [[(r['score'], r['id']) for r in searcher.search_features(q, top_k, n_query_words, with_images=False)]
+          for q in queries]
+
+
+class _ShardedGeometry:
+  # Geometry theo id toàn cục cho SpatialVerifier
+  def __init__(self, searcher):
+    self.searcher = searcher
+
+  def get(self, i):
+    s, local = self.searcher._locate(i)
+    return self.searcher.shards[s].geometry.get(local)
+
+
+def _shutdown(pool, verifier):
+  pool.shutdown(wait=False, cancel_futures=True)
+  if verifier is not None:
+    verifier.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ShardedSearcher(BOVWSearcher):
+  # Cùng giao diện với BOVWSearcher (search_image, search_batch, get_image, query_cache, ...):
+  # BOVWSearcher.__init__ load shard đầu (mọi shard dùng chung vocabulary/IDF nên encoder, extractor,
+  # query cache của nó dùng được cho cả index), chỉ bước chấm điểm được phân tán xuống các shard.
+  # histograms, pq, deleted, inverted_index kế thừa từ BOVWSearcher là của riêng shard đầu
+  def __init__(self, path, workers=None, query_cache_mb=64, **searcher_kwargs):
+    start = time.perf_counter()
+    rss_before = get_rss_mb()
+
+    self.path = path
+    with open(os.path.join(path, SHARDS_FILE), 'r', encoding='utf-8') as f:
+      self.manifest = json.load(f)
+    self.shard_paths = [os.path.join(path, name) for name in self.manifest['shards']]
+    self.offsets = np.asarray(self.manifest['offsets'], dtype=np.int64)
+    self._manifest_mtime = os.path.getmtime(os.path.join(path, SHARDS_FILE))
+    super().__init__(self.shard_paths[0], query_cache_mb=query_cache_mb, **searcher_kwargs)
+
+    self.shards = [self.index] + [load_index(p) for p in self.shard_paths[1:]]
+    self.image_names = _ShardedNames(self)
+    if self.verifier is not None:
+      # Dùng lại verifier (và thread pool của nó) mà BOVWSearcher đã tạo, chỉ đổi sang geometry toàn cục
+      self.verifier.geometry = _ShardedGeometry(self)
+
+    self.workers = workers or min(len(self.shard_paths), os.cpu_count())
+    self.pool = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                    initargs=(self.shard_paths, searcher_kwargs))
+    # Dừng pool cả khi searcher bị bỏ mà không gọi close() (ví dụ cache của Streamlit bị xóa)
+    self._finalizer = weakref.finalize(self, _shutdown, self.pool, self.verifier)
+
+    self.load_time = time.perf_counter() - start
+    self.memory_mb = get_rss_mb()
+    self.database_memory_mb = self.memory_mb - rss_before
+    print(f"Đã load {len(self.shards)} shard với {len(self)} ảnh, {self.workers} process "
+          f"({self.load_time:.2f}s, RSS {self.memory_mb:.0f} MB)")
+
+  def _locate(self, i):
+    s = int(np.searchsorted(self.offsets, i, side='right')) - 1
+    return s, int(i - self.offsets[s])
+
+  def get_image(self, i):
+    s, local = self._locate(i)
+    return self.shards[s].thumbnails.get(local)
+
+  def is_stale(self):
+    try:
+      return os.path.getmtime(os.path.join(self.path, SHARDS_FILE)) != self._manifest_mtime
+    except OSError:
+      return False
+
+  def __len__(self):
+    return int(self.offsets[-1])
+
+  def close(self):
+    self._finalizer()
+
+  def search_features_batch(self, queries, top_k=5, n_query_words=None, with_images=True):
+    # Scatter: mỗi shard nhận cả lô query; gather: gộp top-k của các shard bằng heap
+    queries = [np.asarray(q, dtype=np.float32) for q in queries]
+    futures = [self.pool.submit(_search_shard, (s, queries, top_k, n_query_words))
+               for s in range(len(self.shards))]
+    per_shard = [future.result() for future in futures]
+    results = []
+    for q in range(len(queries)):
+      candidates = ((score, int(self.offsets[s] + local))
+                    for s, shard_results in enumerate(per_shard) for score, local in shard_results[q])
+      best = heapq.nlargest(top_k, candidates, key=lambda c: c[0])
+      results.append(self._make_results([i for _, i in best], [score for score, _ in best], with_images))
+    return results
+
+  def search_features(self, query_features, top_k=5, n_query_words=None, with_images=True):
+    return self.search_features_batch([query_features], top_k, n_query_words, with_images)[0]
+
+  def search_batch(self, images, top_k=5):
+    features = [self.process_query_image(image) for image in images]
+    valid = [i for i, f in enumerate(features) if f is not None]
+    results = [[] for _ in images]
+    for i, r in zip(valid, self.search_features_batch([features[i] for i in valid], top_k)):
+      results[i] = r
+    return results
+
+
+class _ShardedNames:
+  # image_names theo id toàn cục
+  def __init__(self, searcher):
+    self.searcher = searcher
+
+  def __len__(self):
+    return len(self.searcher)
+
+  def __getitem__(self, i):
+    s, local = self.searcher._locate(i)
+    return self.searcher.shards[s].names[local]
+
+  def __iter__(self):
+    for shard in self.searcher.shards:
+      yield from shard.names
+
+
+def open_searcher(path, **kwargs):
+  # Index nhiều shard, index một thư mục hoặc pickle cũ
+  if is_sharded(path):
+    return ShardedSearcher(path, **kwargs)
+  return BOVWSearcher(path, **kwargs)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Chia BOVW index thành nhiều shard để tìm kiếm song song.')
+  parser.add_argument('index_path', type=str, help='Thư mục BOVW index nguồn')
+  parser.add_argument('out_path', type=str, help='Thư mục index nhiều shard đầu ra')
+  parser.add_argument('--n_shards', type=int, default=os.cpu_count(), help='Số shard, mặc định bằng số CPU')
+  args = parser.parse_args()
+
+  if not is_index(args.index_path):
+    raise SystemExit(f"{args.index_path} không phải BOVW index (pickle cũ: chuyển bằng my_utils.bovw_store trước)")
+  manifest = split_index(args.index_path, args.out_path, args.n_shards)
+  print(f"Đã chia {manifest['n_images']} ảnh thành {len(manifest['shards'])} shard trong {args.out_path}")
@@ -0,0 +1,327 @@
+# Định dạng index BOVW trên đĩa (một thư mục):
+#   meta.json                      thông tin chung (n_clusters, n_images, ...)
+#   vocabulary.npy, idf.npy        từ điển thị giác (float32, hoặc uint8 đã pack với ORB) và trọng số IDF
+#   histograms.npy                 ma trận (N, K) float32 đã chuẩn hóa L2, load bằng memmap
+#   names.bin + names.npy          bảng tên ảnh: chuỗi utf-8 nối liền + offsets
+#   thumbs.pack + thumbs.npy       thumbnail JPEG nối liền + offsets, chỉ decode khi hiển thị
+#   tf.npy, df.npy                 histogram chưa nhân IDF và document frequency, dùng để
+#                                  cập nhật index và tính lại IDF (my_utils/bovw_update.py)
+#   deleted.npy                    mask các ảnh đã xóa (tombstone)
+#   pq.npz, pq_codes.npy           codebook và mã PQ khi index được nén (my_utils/bovw_pq.py)
+#   geometry.pack + geometry.npy   toạ độ + descriptor (uint8) của các keypoint mạnh nhất mỗi ảnh,
+#                                  dùng cho bước xác minh hình học (my_utils/bovw_verify.py)
+#   projection.npz                 phép chiếu PCA của descriptor trước khi gán word (my_utils/descriptor_pca.py)
+#   vlad.npz                       codebook thô + PCA khi index lưu vector VLAD thay cho histogram
+#                                  (meta 'aggregation' = 'vlad', my_utils/bovw_vlad.py)
+#
+# Chuyển từ pickle cũ:  python -m my_utils.bovw_store bovw_database_compressed.pkl bovw_index
+import os
+import json
+import pickle
+import argparse
+
+import cv2
+import numpy as np
+
+from my_utils.npy_io import append_npy
+
+FORMAT_NAME = 'bovw-index'
+FORMAT_VERSION = 1
+
+
+def _open_bytes(path):
+  if os.path.getsize(path) == 0:
+    return np.empty(0, dtype=np.uint8)
+  return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+def _append_blobs(blob_path, offsets_path, blobs):
+  offsets = np.load(offsets_path)
+  new_offsets = []
+  end = int(offsets[-1])
+  with open(blob_path, 'ab') as f:
+    for data in blobs:
+      f.write(data)
+      end += len(data)
+      new_offsets.append(end)
+  append_npy(offsets_path, np.asarray(new_offsets, dtype=np.int64))
+
+
+class StringTable:
+  def __init__(self, blob_path, offsets_path):
+    self._blob = _open_bytes(blob_path)
+    self._offsets = np.load(offsets_path, mmap_mode='r')
+
+  def __len__(self):
+    return len(self._offsets) - 1
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    return bytes(self._blob[self._offsets[i]:self._offsets[i + 1]]).decode('utf-8')
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  @staticmethod
+  def append(blob_path, offsets_path, strings):
+    _append_blobs(blob_path, offsets_path, [s.encode('utf-8') for s in strings])
+
+  @staticmethod
+  def write(blob_path, offsets_path, strings):
+    offsets = [0]
+    with open(blob_path, 'wb') as f:
+      for s in strings:
+        data = s.encode('utf-8')
+        f.write(data)
+        offsets.append(offsets[-1] + len(data))
+    np.save(offsets_path, np.asarray(offsets, dtype=np.int64))
+
+
+def encode_thumbnail(image, size=256, quality=85):
+  # Giữ nguyên thứ tự kênh của ảnh gốc, encode/decode đều không đổi kênh
+  h, w = image.shape[:2]
+  scale = size / max(h, w)
+  if scale < 1:
+    image = cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+  ok, buf = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+  if not ok:
+    raise ValueError("Không encode được thumbnail")
+  return buf.tobytes()
+
+
+class ThumbnailPack:
+  def __init__(self, pack_path, offsets_path):
+    self._data = _open_bytes(pack_path)
+    self._offsets = np.load(offsets_path, mmap_mode='r')
+
+  def __len__(self):
+    return len(self._offsets) - 1
+
+  def get_bytes(self, i):
+    return bytes(self._data[self._offsets[i]:self._offsets[i + 1]])
+
+  def get(self, i):
+    start, end = self._offsets[i], self._offsets[i + 1]
+    if end == start:
+      return None
+    return cv2.imdecode(np.asarray(self._data[start:end]), cv2.IMREAD_UNCHANGED)
+
+  @staticmethod
+  def _encode(image, size, quality):
+    if image is None:
+      return b''
+    if isinstance(image, (bytes, bytearray)):
+      return bytes(image)
+    return encode_thumbnail(image, size, quality)
+
+  @staticmethod
+  def append(pack_path, offsets_path, images, size=256, quality=85):
+    _append_blobs(pack_path, offsets_path, (ThumbnailPack._encode(image, size, quality) for image in images))
+
+  @staticmethod
+  def write(pack_path, offsets_path, images, size=256, quality=85):
+    # images có thể là generator (ảnh numpy hoặc bytes JPEG đã encode) để không giữ cả dataset trong RAM
+    offsets = [0]
+    with open(pack_path, 'wb') as f:
+      for image in images:
+        data = ThumbnailPack._encode(image, size, quality)
+        f.write(data)
+        offsets.append(offsets[-1] + len(data))
+    np.save(offsets_path, np.asarray(offsets, dtype=np.int64))
+
+
+def pack_geometry(points, descriptors):
+  # Một bản ghi: toạ độ float32 (n, 2) rồi tới descriptor uint8 (n, d).
+  # Descriptor float (SIFT đã chuẩn hóa L2) được lượng tử về uint8 như SIFT gốc của OpenCV
+  points = np.ascontiguousarray(points, dtype=np.float32)
+  if descriptors.dtype != np.uint8:
+    descriptors = np.clip(np.rint(descriptors * 512), 0, 255).astype(np.uint8)
+  return points.tobytes() + np.ascontiguousarray(descriptors).tobytes()
+
+
+class GeometryPack:
+  def __init__(self, pack_path, offsets_path, descriptor_size=128):
+    self._data = _open_bytes(pack_path)
+    self._offsets = np.load(offsets_path, mmap_mode='r')
+    self.descriptor_size = descriptor_size
+
+  def __len__(self):
+    return len(self._offsets) - 1
+
+  def get_bytes(self, i):
+    return bytes(self._data[self._offsets[i]:self._offsets[i + 1]])
+
+  def get(self, i):
+    start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+    n = (end - start) // (8 + self.descriptor_size)
+    data = np.asarray(self._data[start:end])
+    points = data[:n * 8].view(np.float32).reshape(n, 2)
+    descriptors = data[n * 8:].reshape(n, self.descriptor_size)
+    return points, descriptors
+
+  @staticmethod
+  def append(pack_path, offsets_path, blobs):
+    _append_blobs(pack_path, offsets_path, blobs)
+
+  @staticmethod
+  def write(pack_path, offsets_path, blobs):
+    offsets = [0]
+    with open(pack_path, 'wb') as f:
+      for data in blobs:
+        f.write(data)
+        offsets.append(offsets[-1] + len(data))
+    np.save(offsets_path, np.asarray(offsets, dtype=np.int64))
+
+
+class BOVWIndex:
+  def __init__(self, path, mmap=True):
+    self.path = path
+    with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+      self.meta = json.load(f)
+    if self.meta.get('format') != FORMAT_NAME:
+      raise ValueError(f"{path} không phải BOVW index")
+
+    # meta.json được ghi sau cùng khi cập nhật, n_images trong meta là số dòng hợp lệ
+    n = self.meta['n_images']
+    mmap_mode = 'r' if mmap else None
+    self.vocabulary = np.load(os.path.join(path, 'vocabulary.npy'))
+    self.idf_weights = np.load(os.path.join(path, 'idf.npy'))
+    self.histograms = np.load(os.path.join(path, 'histograms.npy'), mmap_mode=mmap_mode)[:n]
+    self.names = StringTable(os.path.join(path, 'names.bin'), os.path.join(path, 'names.npy'))
+    self.thumbnails = ThumbnailPack(os.path.join(path, 'thumbs.pack'), os.path.join(path, 'thumbs.npy'))
+    self.tf = self._load_optional('tf.npy', mmap_mode)
+    if self.tf is not None:
+      self.tf = self.tf[:n]
+    self.df = self._load_optional('df.npy')
+    self.geometry = None
+    if os.path.isfile(os.path.join(path, 'geometry.npy')):
+      self.geometry = GeometryPack(os.path.join(path, 'geometry.pack'), os.path.join(path, 'geometry.npy'),
+                                   self.meta.get('geometry_descriptor_size', 128))
+    self.pq_codes = self._load_optional('pq_codes.npy')
+    if self.pq_codes is not None:
+      self.pq_codes = self.pq_codes[:n]
+    deleted = self._load_optional('deleted.npy')
+    self.deleted = np.zeros(n, dtype=bool)
+    if deleted is not None:
+      self.deleted[:min(n, len(deleted))] = deleted[:n]
+
+  def _load_optional(self, name, mmap_mode=None):
+    file_path = os.path.join(self.path, name)
+    return np.load(file_path, mmap_mode=mmap_mode) if os.path.isfile(file_path) else None
+
+  @property
+  def n_live(self):
+    return int(len(self.deleted) - np.count_nonzero(self.deleted))
+
+  @property
+  def n_clusters(self):
+    return self.meta['n_clusters']
+
+  def __len__(self):
+    return self.meta['n_images']
+
+
+def is_index(path):
+  return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+def load_index(path, mmap=True):
+  return BOVWIndex(path, mmap=mmap)
+
+
+def write_meta(path, meta):
+  tmp_path = os.path.join(path, 'meta.json.tmp')
+  with open(tmp_path, 'w', encoding='utf-8') as f:
+    json.dump(meta, f, indent=2)
+  os.replace(tmp_path, os.path.join(path, 'meta.json'))
+
+
+def save_index(path, vocabulary, idf_weights, histograms, names, images=None,
+               thumbnail_size=256, thumbnail_quality=85, chunk_size=4096, meta=None,
+               tf=None, df=None, geometry=None, projection=None, vlad=None):
+  os.makedirs(path, exist_ok=True)
+  n_images, n_clusters = histograms.shape
+  for name in ('tf.npy', 'df.npy', 'deleted.npy', 'pq.npz', 'pq_codes.npy', 'geometry.pack', 'geometry.npy',
+               'projection.npz', 'vlad.npz'):
+    if os.path.isfile(os.path.join(path, name)):
+      os.remove(os.path.join(path, name))
+
+  # Vocabulary nhị phân (ORB) giữ nguyên uint8
+  vocabulary = np.asarray(vocabulary)
+  np.save(os.path.join(path, 'vocabulary.npy'),
+          vocabulary if vocabulary.dtype == np.uint8 else vocabulary.astype(np.float32))
+  np.save(os.path.join(path, 'idf.npy'), np.asarray(idf_weights, dtype=np.float32))
+
+  # Ghi theo từng khối để histograms đầu vào có thể là memmap lớn hơn RAM
+  out = np.lib.format.open_memmap(os.path.join(path, 'histograms.npy'), mode='w+',
+                                  dtype=np.float32, shape=(n_images, n_clusters))
+  for start in range(0, n_images, chunk_size):
+    block = np.asarray(histograms[start:start + chunk_size], dtype=np.float32)
+    norms = np.linalg.norm(block, axis=1, keepdims=True)
+    out[start:start + len(block)] = block / np.maximum(norms, 1e-12)
+  out.flush()
+  del out
+
+  if tf is not None:
+    out = np.lib.format.open_memmap(os.path.join(path, 'tf.npy'), mode='w+',
+                                    dtype=np.float32, shape=(n_images, n_clusters))
+    for start in range(0, n_images, chunk_size):
+      out[start:start + chunk_size] = tf[start:start + chunk_size]
+    out.flush()
+    del out
+  if df is not None:
+    np.save(os.path.join(path, 'df.npy'), np.asarray(df, dtype=np.int64))
+
+  StringTable.write(os.path.join(path, 'names.bin'), os.path.join(path, 'names.npy'), names)
+  if projection is not None:
+    projection.save(os.path.join(path, 'projection.npz'))
+  if vlad is not None:
+    vlad.save(os.path.join(path, 'vlad.npz'))
+  if geometry is not None:
+    GeometryPack.write(os.path.join(path, 'geometry.pack'), os.path.join(path, 'geometry.npy'), geometry)
+  ThumbnailPack.write(os.path.join(path, 'thumbs.pack'), os.path.join(path, 'thumbs.npy'),
+                      images if images is not None else [None] * n_images,
+                      thumbnail_size, thumbnail_quality)
+
+  meta = {
+    **(meta or {}),
+    'format': FORMAT_NAME,
+    'version': FORMAT_VERSION,
+    'n_clusters': int(n_clusters),
+    'n_images': int(n_images),
+    'thumbnail_size': thumbnail_size,
+    'thumbnail_quality': thumbnail_quality,
+  }
+  write_meta(path, meta)
+  return meta
+
+
+def convert_pickle(pickle_path, path, thumbnail_size=256, thumbnail_quality=85):
+  with open(pickle_path, 'rb') as f:
+    data = pickle.load(f)
+  database = data['database']
+  names = list(database.keys())
+  n_clusters = data['n_clusters']
+  histograms = np.stack([database[name]['histogram'] for name in names])
+  return save_index(path,
+                    vocabulary=data['vocabulary'],
+                    idf_weights=data.get('idf_weights', np.ones(n_clusters)),
+                    histograms=histograms,
+                    names=names,
+                    images=(database[name].get('image') for name in names),
+                    thumbnail_size=thumbnail_size,
+                    thumbnail_quality=thumbnail_quality)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Chuyển BOVW database dạng pickle sang index memory-mapped.')
+  parser.add_argument('pickle_path', type=str, help='File pickle cũ, ví dụ bovw_database_compressed.pkl')
+  parser.add_argument('index_path', type=str, help='Thư mục index đầu ra')
+  parser.add_argument('--thumbnail_size', type=int, default=256, help='Cạnh dài nhất của thumbnail (px)')
+  parser.add_argument('--thumbnail_quality', type=int, default=85, help='Chất lượng JPEG của thumbnail')
+  args = parser.parse_args()
+
+  meta = convert_pickle(args.pickle_path, args.index_path, args.thumbnail_size, args.thumbnail_quality)
+  print(f"Đã ghi index {args.index_path} với {meta['n_images']} ảnh")
@@ -0,0 +1,210 @@
+# Cập nhật BOVW index đã build mà không cần build lại từ đầu:
+#   - thêm ảnh: encode với vocabulary hiện có rồi nối vào cuối index
+#   - xóa ảnh: đánh dấu tombstone trong deleted.npy
+#   - document frequency (df.npy) được cập nhật theo từng lần thêm/xóa; IDF (ghi lại cả ma trận
+#     histogram, O(N x K)) chỉ được tính lại khi gọi refresh_idf, hoặc refresh_idf_if_needed khi số
+#     ảnh thêm/xóa từ lần tính trước (pending_idf_updates trong meta.json) vượt một tỉ lệ của index
+#
+#   python -m my_utils.bovw_update bovw_index add new_images/ extra.jpg --refresh_idf
+#   python -m my_utils.bovw_update bovw_index remove 000000001675.jpg
+#   python -m my_utils.bovw_update bovw_index refresh_idf
+import os
+import argparse
+
+import cv2
+import numpy as np
+
+from my_utils.bovw_builder import list_images, read_image
+from my_utils.bovw_encoder import create_encoder, create_extractor, extract_features
+from my_utils.bovw_pq import ProductQuantizer, PQ_FILE, PQ_CODES_FILE
+from my_utils.bovw_store import GeometryPack, StringTable, ThumbnailPack, encode_thumbnail, load_index, write_meta
+from my_utils.bovw_verify import geometry_blob
+from my_utils.descriptor_pca import load_projection
+from my_utils.npy_io import append_npy
+
+
+class BOVWIndexUpdater:
+  def __init__(self, index_path, max_side=1024):
+    self.path = index_path
+    self.max_side = max_side
+    self._reload()
+    self.descriptor = self.index.meta.get('descriptor', 'sift')
+    self.extractor = create_extractor(self.descriptor)
+    if self.index.tf is None or self.index.df is None:
+      raise ValueError(f"{index_path} không có tf.npy/df.npy (index chuyển từ pickle hoặc index VLAD), "
+                       "hãy build lại bằng my_utils.bovw_builder")
+
+  def _reload(self):
+    self.index = load_index(self.path)
+    self.encoder = create_encoder(self.index.meta.get('descriptor', 'sift'), self.index.vocabulary,
+                                  self.index.idf_weights, knn=self.index.meta.get('knn_words'),
+                                  **self._encoder_kwargs())
+    self.pq = ProductQuantizer.load(self._file(PQ_FILE)) if self.index.meta.get('encoding') == 'pq' else None
+
+  def _encoder_kwargs(self):
+    if self.index.meta.get('descriptor') == 'orb':
+      return {}
+    return {'projection': load_projection(self.path)}
+
+  def _file(self, name):
+    return os.path.join(self.path, name)
+
+  def _save(self, name, array):
+    tmp_path = self._file(name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+      np.save(f, array)
+    os.replace(tmp_path, self._file(name))
+
+  def live_ids(self):
+    return {name: i for i, name in enumerate(self.index.names) if not self.index.deleted[i]}
+
+  def add_images(self, items, refresh_idf=False):
+    # items: iterable các cặp (tên ảnh, ảnh BGR); ảnh trùng tên với ảnh đang có sẽ bị bỏ qua
+    existing = self.live_ids()
+    names, tf_rows, thumbnails, geometry = [], [], [], []
+    n_keypoints = self.index.meta.get('geometry_keypoints', 300)
+    thumbnail_size = self.index.meta.get('thumbnail_size', 256)
+    thumbnail_quality = self.index.meta.get('thumbnail_quality', 85)
+    for name, image in items:
+      if name in existing or name in names:
+        print(f"Bỏ qua {name}: đã có trong index")
+        continue
+      keypoints, descriptors, kp_weights = extract_features(self.extractor, image, self.descriptor)
+      if descriptors is None:
+        tf_rows.append(np.zeros(self.encoder.n_clusters, dtype=np.float32))
+        geometry.append(b'')
+      else:
+        tf_rows.append(self.encoder.encode_tf(descriptors, kp_weights))
+        points = np.array([kp.pt for kp in keypoints], dtype=np.float32)
+        geometry.append(geometry_blob(points, descriptors, kp_weights, n_keypoints))
+      names.append(name)
+      # Encode thumbnail ngay để không giữ ảnh gốc của cả lô (ví dụ keyframe video) trong RAM
+      thumbnails.append(encode_thumbnail(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), thumbnail_size, thumbnail_quality))
+    if not names:
+      return []
+
+    tf = np.stack(tf_rows)
+    meta = dict(self.index.meta)
+    first_id = meta['n_images']
+    # Ghi dữ liệu trước, meta.json sau cùng
+    append_npy(self._file('tf.npy'), tf)
+    histograms = self.encoder.apply_idf(tf)
+    append_npy(self._file('histograms.npy'), histograms)
+    if self.pq is not None:
+      append_npy(self._file(PQ_CODES_FILE), self.pq.encode(histograms))
+    StringTable.append(self._file('names.bin'), self._file('names.npy'), names)
+    ThumbnailPack.append(self._file('thumbs.pack'), self._file('thumbs.npy'), thumbnails)
+    if self.index.geometry is not None:
+      GeometryPack.append(self._file('geometry.pack'), self._file('geometry.npy'), geometry)
+    self._save('deleted.npy', np.concatenate([self.index.deleted, np.zeros(len(names), dtype=bool)]))
+    self._save('df.npy', self.index.df + np.count_nonzero(tf, axis=0))
+    meta['n_images'] = first_id + len(names)
+    meta['pending_idf_updates'] = meta.get('pending_idf_updates', 0) + len(names)
+    write_meta(self.path, meta)
+    self._reload()
+
+    if refresh_idf:
+      self.refresh_idf()
+    return list(range(first_id, first_id + len(names)))
+
+  def add_paths(self, paths, root=None, refresh_idf=False):
+    def items():
+      for path in paths:
+        if os.path.isdir(path):
+          base = root or path
+          for name in list_images(path):
+            file_path = os.path.join(path, name)
+            image = read_image(file_path, self.max_side)
+            if image is not None:
+              yield os.path.relpath(file_path, base), image
+        else:
+          image = read_image(path, self.max_side)
+          if image is None:
+            print(f"Không đọc được ảnh {path}")
+            continue
+          yield (os.path.relpath(path, root) if root else os.path.basename(path)), image
+    return self.add_images(items(), refresh_idf=refresh_idf)
+
+  def remove(self, names_or_ids, refresh_idf=False):
+    existing = self.live_ids()
+    ids = []
+    for item in names_or_ids:
+      i = item if isinstance(item, (int, np.integer)) else existing.get(item)
+      if i is None or not 0 <= i < len(self.index.deleted) or self.index.deleted[i]:
+        print(f"Bỏ qua {item}: không có trong index")
+        continue
+      ids.append(int(i))
+    if not ids:
+      return []
+
+    ids = np.unique(ids)
+    deleted = np.array(self.index.deleted, dtype=bool)
+    deleted[ids] = True
+    self._save('df.npy', self.index.df - np.count_nonzero(self.index.tf[ids], axis=0))
+    self._save('deleted.npy', deleted)
+    write_meta(self.path, dict(self.index.meta, n_live=int(len(deleted) - deleted.sum()),
+                               pending_idf_updates=self.index.meta.get('pending_idf_updates', 0) + len(ids)))
+    self._reload()
+
+    if refresh_idf:
+      self.refresh_idf()
+    return ids.tolist()
+
+  def refresh_idf(self, chunk_size=4096):
+    # IDF = log(N / df) với N là số ảnh còn sống; histogram được nhân lại IDF tại chỗ theo khối,
+    # không phải trích đặc trưng hay encode lại
+    n_live = max(self.index.n_live, 1)
+    idf = np.log(n_live / np.maximum(self.index.df, 1)).astype(np.float32)
+    self._save('idf.npy', idf)
+
+    encoder = create_encoder(self.descriptor, self.index.vocabulary, idf, knn=self.index.meta.get('knn_words'),
+                             **self._encoder_kwargs())
+    histograms = np.load(self._file('histograms.npy'), mmap_mode='r+')
+    codes = np.load(self._file(PQ_CODES_FILE), mmap_mode='r+') if self.pq is not None else None
+    for start in range(0, len(self.index), chunk_size):
+      block = encoder.apply_idf(np.asarray(self.index.tf[start:start + chunk_size], dtype=np.float32))
+      histograms[start:start + len(block)] = block
+      if codes is not None:
+        codes[start:start + len(block)] = self.pq.encode(block)
+    histograms.flush()
+    del histograms
+    if codes is not None:
+      codes.flush()
+      del codes
+
+    write_meta(self.path, dict(self.index.meta, n_live=int(n_live), pending_idf_updates=0))
+    self._reload()
+    return idf
+
+  def refresh_idf_if_needed(self, max_fraction=0.05):
+    # Gom nhiều lần thêm/xóa vào một lần tính lại IDF: chỉ tính khi số ảnh thay đổi từ lần trước
+    # vượt max_fraction số ảnh trong index
+    pending = self.index.meta.get('pending_idf_updates', 0)
+    if pending and pending >= max_fraction * max(self.index.n_live, 1):
+      return self.refresh_idf()
+    return None
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Thêm/xóa ảnh trong BOVW index mà không build lại.')
+  parser.add_argument('index_path', type=str, help='Thư mục BOVW index')
+  parser.add_argument('command', choices=['add', 'remove', 'refresh_idf'])
+  parser.add_argument('items', nargs='*', help='add: file ảnh hoặc thư mục; remove: tên ảnh trong index')
+  parser.add_argument('--root', type=str, default=None, help='Tên ảnh được lưu theo đường dẫn tương đối với root')
+  parser.add_argument('--refresh_idf', action='store_true',
+                      help='Tính lại IDF ngay sau khi thêm/xóa (mặc định chỉ tính khi đã thay đổi quá 5%% index)')
+  args = parser.parse_args()
+
+  updater = BOVWIndexUpdater(args.index_path)
+  if args.command == 'add':
+    ids = updater.add_paths(args.items, root=args.root, refresh_idf=args.refresh_idf)
+    print(f"Đã thêm {len(ids)} ảnh")
+  elif args.command == 'remove':
+    ids = updater.remove(args.items, refresh_idf=args.refresh_idf)
+    print(f"Đã xóa {len(ids)} ảnh")
+  else:
+    updater.refresh_idf()
+    print("Đã tính lại IDF")
+  if args.command != 'refresh_idf' and not args.refresh_idf and updater.refresh_idf_if_needed() is not None:
+    print("Đã tính lại IDF")
+  print(f"Index hiện có {updater.index.n_live} ảnh")
@@ -0,0 +1,97 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import cv2
+import numpy as np
+
+from my_utils.bovw_store import pack_geometry
+
+
+def select_keypoints(points, descriptors, weights, max_keypoints=300):
+  # Giữ các keypoint có size * response lớn nhất (xếp giảm dần), trả về đúng dạng lưu trong geometry pack
+  if max_keypoints and len(points) > max_keypoints:
+    keep = np.argpartition(-weights, max_keypoints - 1)[:max_keypoints]
+    keep = keep[np.argsort(-weights[keep])]
+    points, descriptors = points[keep], descriptors[keep]
+  if descriptors.dtype != np.uint8:
+    descriptors = np.clip(np.rint(descriptors * 512), 0, 255).astype(np.uint8)
+  return np.asarray(points, dtype=np.float32), descriptors
+
+
+def geometry_blob(points, descriptors, weights, max_keypoints=300):
+  return pack_geometry(*select_keypoints(points, descriptors, weights, max_keypoints))
+
+
+class SpatialVerifier:
+  # Xác minh hình học cho short list: so khớp keypoint của query với keypoint đã lưu của từng
+  # ứng viên (ratio test), đếm inlier bằng RANSAC homography/affine. Chạy trong thread pool
+  # (OpenCV nhả GIL) và dừng khi hết ngân sách thời gian của query. Task đang chạy không hủy được
+  # nên deadline được kiểm tra giữa các bước, và mỗi bước bị chặn trên (số descriptor query
+  # max_descriptors, số vòng RANSAC max_iters) để một ứng viên không chạy quá lâu sau deadline
+  def __init__(self, geometry, model='homography', ratio=0.8, ransac_threshold=5.0,
+               min_inliers=8, max_workers=4, norm=cv2.NORM_L2, max_descriptors=500, max_iters=500):
+    self.geometry = geometry
+    self.model = model
+    self.ratio = ratio
+    self.ransac_threshold = ransac_threshold
+    self.min_inliers = min_inliers
+    self.norm = norm
+    self.max_descriptors = max_descriptors
+    self.max_iters = max_iters
+    self.pool = ThreadPoolExecutor(max_workers=max_workers)
+
+  def _prepare(self, descriptors):
+    return descriptors.astype(np.float32) if self.norm == cv2.NORM_L2 else descriptors
+
+  def count_inliers(self, query_points, query_descriptors, i, deadline=None):
+    def expired():
+      return deadline is not None and time.perf_counter() > deadline
+
+    if expired():
+      return None
+    points, descriptors = self.geometry.get(i)
+    min_matches = 4 if self.model == 'homography' else 3
+    if len(points) < min_matches or len(query_points) < min_matches:
+      return 0
+
+    matcher = cv2.BFMatcher(self.norm)
+    matches = matcher.knnMatch(query_descriptors, self._prepare(descriptors), k=2)
+    good = [m[0] for m in matches if len(m) == 2 and m[0].distance < self.ratio * m[1].distance]
+    if len(good) < min_matches:
+      return 0
+    if expired():
+      return None
+
+    src = query_points[[m.queryIdx for m in good]].reshape(-1, 1, 2)
+    dst = points[[m.trainIdx for m in good]].reshape(-1, 1, 2)
+    if self.model == 'homography':
+      _, mask = cv2.findHomography(src, dst, cv2.RANSAC, self.ransac_threshold, maxIters=self.max_iters)
+    else:
+      _, mask = cv2.estimateAffinePartial2D(src, dst, method=cv2.RANSAC,
+                                            ransacReprojThreshold=self.ransac_threshold, maxIters=self.max_iters)
+    return 0 if mask is None else int(mask.sum())
+
+  def verify(self, query_points, query_descriptors, candidates, budget_ms=200):
+    # Trả về {id: số inlier} cho các ứng viên xác minh kịp trong budget_ms
+    deadline = time.perf_counter() + budget_ms / 1000
+    # Chặn số descriptor của query; với query qua select_keypoints đây là các keypoint mạnh nhất
+    if self.max_descriptors and len(query_points) > self.max_descriptors:
+      query_points, query_descriptors = query_points[:self.max_descriptors], query_descriptors[:self.max_descriptors]
+    query_descriptors = self._prepare(query_descriptors)
+    futures = {self.pool.submit(self.count_inliers, query_points, query_descriptors, int(i), deadline): int(i)
+               for i in candidates}
+    done, not_done = wait(futures, timeout=max(deadline - time.perf_counter(), 0))
+    for future in not_done:
+      future.cancel()
+    return {futures[f]: f.result() for f in done if f.exception() is None and f.result() is not None}
+
+  def rerank(self, query_points, query_descriptors, results, budget_ms=200):
+    # results: danh sách dict có 'id' theo thứ tự điểm BOVW. Ứng viên đủ inlier được đưa lên
+    # trước (theo số inlier), phần còn lại giữ thứ tự cũ
+    inliers = self.verify(query_points, query_descriptors, [r['id'] for r in results], budget_ms)
+    for r in results:
+      r['inliers'] = inliers.get(r['id'])
+    verified = [r for r in results if (r['inliers'] or 0) >= self.min_inliers]
+    verified.sort(key=lambda r: (-r['inliers'], -r['score']))
+    rest = [r for r in results if (r['inliers'] or 0) < self.min_inliers]
+    return verified + rest
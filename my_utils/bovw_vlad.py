@@ -0,0 +1,99 @@
+# VLAD (vector of locally aggregated descriptors): thay cho histogram BOVW K chiều thưa, mỗi ảnh là
+# một vector dày 128-512 chiều.
+#   1. codebook thô: gom vocabulary của index thành n_words cụm (mặc định 64)
+#   2. với mỗi descriptor cộng phần dư (descriptor - tâm gần nhất) vào khối của tâm đó
+#   3. power normalization (căn có dấu) rồi chuẩn hóa L2 -> vector n_words * D chiều
+#   4. PCA xuống dim chiều (train trên vector VLAD của database), chuẩn hóa L2 lần nữa
+# Vector cuối được lưu ở histograms.npy nên scoring, float16/PQ và re-rank dùng lại nguyên như BOVW.
+#
+#   python -m my_utils.bovw_builder DTS bovw_index_vlad --aggregation vlad --vlad_words 64 --vlad_dim 256
+import os
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import PCA
+
+from my_utils.descriptor_pca import PCAProjection
+
+VLAD_FILE = 'vlad.npz'
+
+
+def coarse_codebook(vocabulary, n_words=64, random_state=42):
+  # Codebook thô dựng lại từ vocabulary có sẵn, không cần đọc lại descriptors
+  vocabulary = np.asarray(vocabulary, dtype=np.float32)
+  n_words = min(n_words, len(vocabulary))
+  kmeans = MiniBatchKMeans(n_clusters=n_words, random_state=random_state,
+                           batch_size=max(1024, n_words * 4), n_init=3)
+  return kmeans.fit(vocabulary).cluster_centers_.astype(np.float32)
+
+
+def fit_pca(vectors, dim, whiten=False):
+  # vectors: mẫu VLAD thô (n, n_words * D); số chiều không vượt quá số mẫu
+  vectors = np.asarray(vectors, dtype=np.float32)
+  dim = min(dim, len(vectors), vectors.shape[1])
+  pca = PCA(n_components=dim, whiten=False, svd_solver='randomized', random_state=42).fit(vectors)
+  scale = 1 / np.sqrt(pca.explained_variance_ + 1e-6) if whiten else None
+  return PCAProjection(pca.mean_.astype(np.float32), pca.components_.astype(np.float32),
+                       None if scale is None else scale.astype(np.float32))
+
+
+class VLADEncoder:
+  # Cùng giao diện với SoftAssignEncoder: encode_tf trả về VLAD thô (trước PCA), encode trả về
+  # vector cuối cùng. projection: phép chiếu descriptor của index (descriptor_pca), nếu có
+  def __init__(self, codebook, pca=None, projection=None, power=0.5, chunk_size=2048):
+    self.codebook = np.ascontiguousarray(codebook, dtype=np.float32)
+    self.codebook_norms = np.einsum('kd,kd->k', self.codebook, self.codebook)
+    self.pca = pca
+    self.projection = projection
+    self.power = power
+    self.chunk_size = chunk_size
+    self.raw_dim = self.codebook.size
+    self.n_clusters = pca.dim if pca is not None else self.raw_dim
+
+  def encode_tf(self, descriptors, kp_weights=None):
+    if self.projection is not None:
+      descriptors = self.projection.transform(descriptors)
+    descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+    n_words = len(self.codebook)
+    vlad = np.zeros_like(self.codebook)
+    counts = np.zeros(n_words, dtype=np.float32)
+    for start in range(0, len(descriptors), self.chunk_size):
+      x = descriptors[start:start + self.chunk_size]
+      labels = np.argmin(self.codebook_norms - 2 * (x @ self.codebook.T), axis=1)
+      # Tổng descriptor theo từng tâm bằng một GEMM với ma trận one-hot
+      one_hot = (labels[:, None] == np.arange(n_words)).astype(np.float32)
+      vlad += one_hot.T @ x
+      counts += one_hot.sum(axis=0)
+    vlad -= counts[:, None] * self.codebook
+    vlad = vlad.ravel()
+    vlad = np.sign(vlad) * np.abs(vlad) ** self.power
+    return (vlad / max(np.linalg.norm(vlad), 1e-12)).astype(np.float32)
+
+  def apply_pca(self, vlad):
+    if self.pca is None:
+      return np.asarray(vlad, dtype=np.float32)
+    return self.pca.transform(np.atleast_2d(vlad)).reshape(np.shape(vlad)[:-1] + (self.pca.dim,))
+
+  def encode(self, descriptors, kp_weights=None):
+    return self.apply_pca(self.encode_tf(descriptors, kp_weights))
+
+  def save(self, path):
+    arrays = {'codebook': self.codebook, 'power': np.float32(self.power)}
+    if self.pca is not None:
+      arrays.update(pca_mean=self.pca.mean, pca_components=self.pca.components)
+      if self.pca.scale is not None:
+        arrays['pca_scale'] = self.pca.scale
+    np.savez(path, **arrays)
+
+  @classmethod
+  def load(cls, path, projection=None):
+    data = np.load(path)
+    pca = None
+    if 'pca_components' in data:
+      pca = PCAProjection(data['pca_mean'], data['pca_components'],
+                          data['pca_scale'] if 'pca_scale' in data else None)
+    return cls(data['codebook'], pca=pca, projection=projection, power=float(data['power']))
+
+
+def load_vlad(index_path, projection=None):
+  return VLADEncoder.load(os.path.join(index_path, VLAD_FILE), projection=projection)
@@ -2,40 +2,65 @@ from miscs.face_models.sface import SFace
 from miscs.face_models.yunet import YuNet
 import numpy as np
 import cv2 as cv
-from my_utils.face_controller import FaceController
+from my_utils.face_controller import detect_faces
+
+class FaceImage:
+  # Kết quả xử lý một ảnh: khuôn mặt phát hiện được và embedding của từng khuôn mặt. Mỗi khuôn mặt
+  # chỉ được căn chỉnh và embed khi cần tới, lần sau dùng lại kết quả đã lưu
+  def __init__(self, image, detector: YuNet, recognizer: SFace):
+    self.image = image
+    self.recognizer = recognizer
+    faces, _ = detect_faces(detector, image)
+    self.faces = np.asarray(faces, dtype=np.float32).reshape(-1, 15)
+    self._embeddings = {}
+
+  def __len__(self):
+    return len(self.faces)
+
+  def embed(self, indices):
+    # (len(indices), 128), đã chuẩn hóa L2 để cosine chỉ là tích vô hướng; các khuôn mặt chưa có
+    # embedding được embed chung trong một lần forward
+    indices = list(indices)
+    missing = [i for i in dict.fromkeys(indices) if i not in self._embeddings]
+    if missing:
+      crops = self.recognizer.alignCrops(self.image, self.faces[missing, :-1])
+      features = self.recognizer.inferCrops(crops)
+      features = features / np.maximum(np.linalg.norm(features, axis=1, keepdims=True), 1e-12)
+      self._embeddings.update(zip(missing, features))
+    if not indices:
+      return np.empty((0, 128), dtype=np.float32)
+    return np.stack([self._embeddings[i] for i in indices])
+
+  @property
+  def embeddings(self):
+    return self.embed(range(len(self)))
+
 
 class Verification:
   def __init__(self, detector: YuNet, recognizer: SFace):
     self.detector = detector
     self.recognizer = recognizer
-    self.dt = FaceController('face_dataset')
-  
+    self.card = None
+    self.selfie_result = None
+
   def set_card(self, card_number):
+    self.card = FaceImage(card_number, self.detector, self.recognizer)
     self.card_number = card_number
-    _, self.card_number = self.dt.detect(self.card_number)
-  
+
   def set_selfie(self, selfie):
+    self.selfie_result = FaceImage(selfie, self.detector, self.recognizer)
     self.selfie = selfie
-    _, self.selfie = self.dt.detect(self.selfie)
 
-  def detect(self, image):
-    self.detector.setInputSize((image.shape[1], image.shape[0]))
-
-    return self.detector.infer(image)
-  
   def verify_card(self):
-    face_card = self.detect(self.card_number)
-    face2 = self.detect(self.selfie)
-    
-    if face_card.shape[0] > 0 and face2.shape[0] > 0:
-      score, matches = [], []
-      for face in face2:
-        rs = self.recognizer.match(self.card_number, face_card[0][:-1], self.selfie, face[:-1])
-        score.append(rs[0])
-        matches.append(rs[1])
-      return face_card, face2, score, matches
+    # Chỉ khuôn mặt đầu tiên trên thẻ được embed (một lần), mọi khuôn mặt trong ảnh chân dung được
+    # chấm điểm với nó bằng một phép nhân ma trận
+    if len(self.card) > 0 and len(self.selfie_result) > 0:
+      card_embedding = self.card.embed([0])[0]
+      score = (self.selfie_result.embeddings @ card_embedding).tolist()
+      matches = [1 if s >= self.recognizer.cosineThreshold else 0 for s in score]
+      return self.card.faces, self.selfie_result.faces, score, matches
     return None, None, None, None
-  
+
   def visualize(self, img1, faces1, img2, faces2, matches, scores, target_size=[512, 512]): # target_size: (h, w)
     out1 = img1.copy()
     out2 = img2.copy()
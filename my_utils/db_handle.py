@@ -10,6 +10,7 @@ import json
 class DBHandle:
   def __init__(self, dbname) -> None:
     self.dbName = dbname
+    self.changesName = f"{dbname}_changes"
 
     # Sử dụng credentials từ Streamlit secrets
     import firebase_admin
@@ -49,7 +50,8 @@ class DBHandle:
 
   def insert(self, data: dict):
     try:
-      new_ref = self.db.collection(self.dbName).add(data)
+      # updated_at cho phép snapshot local chỉ kéo về các document đã thay đổi
+      new_ref = self.db.collection(self.dbName).add(dict(data, updated_at=firestore.SERVER_TIMESTAMP))
       new_reff = new_ref[0]
       print('Time insert:', new_ref[0].to_datetime())
       return new_ref[1].id
@@ -59,14 +61,15 @@ class DBHandle:
 
   def update(self, id, data: dict):
     try:
-      return self.db.collection(self.dbName).document(id).update(data)
+      return self.db.collection(self.dbName).document(id).update(dict(data, updated_at=firestore.SERVER_TIMESTAMP))
     except Exception as e:
       print(f"Error updating data: {str(e)}")
       return False
 
   def get_all(self):
+    # stream() chỉ đọc khi được duyệt: đọc hết trong try để lỗi Firestore trả về False ở đây
     try:
-      return self.db.collection(self.dbName).stream()
+      return list(self.db.collection(self.dbName).stream())
     except Exception as e:
       print(f"Error getting all data: {str(e)}")
       return False
@@ -80,9 +83,26 @@ class DBHandle:
 
   def delete(self, id):
     try:
-      return self.db.collection(self.dbName).document(id).delete()
+      result = self.db.collection(self.dbName).document(id).delete()
+      # Document đã xóa không còn để query theo updated_at, ghi lại vào change log
+      self.db.collection(self.changesName).add({'id': id, 'op': 'delete', 'updated_at': firestore.SERVER_TIMESTAMP})
+      return result
     except Exception as e:
       print(f"Error deleting data: {str(e)}")
+      return False
+
+  def get_updated_since(self, since):
+    try:
+      return list(self.db.collection(self.dbName).where(filter=fil('updated_at', '>=', since)).stream())
+    except Exception as e:
+      print(f"Error getting updated data: {str(e)}")
+      return False
+
+  def get_changes_since(self, since):
+    try:
+      return list(self.db.collection(self.changesName).where(filter=fil('updated_at', '>=', since)).stream())
+    except Exception as e:
+      print(f"Error getting change log: {str(e)}")
       return False      
   
   def upload_file(self, file: UploadedFile, path: str):
@@ -0,0 +1,77 @@
+import os
+
+import numpy as np
+
+PROJECTION_FILE = 'projection.npz'
+
+
+def root_sift(descriptors):
+  # RootSIFT (Arandjelović & Zisserman): chuẩn hóa L1 rồi lấy căn, so sánh Euclid trên RootSIFT
+  # tương đương Hellinger kernel trên SIFT gốc. Kết quả có chuẩn L2 bằng 1
+  descriptors = np.abs(descriptors)
+  descriptors /= np.maximum(descriptors.sum(axis=1, keepdims=True), 1e-12)
+  return np.sqrt(descriptors, out=descriptors)
+
+
+class PCAProjection:
+  # Chiếu descriptor xuống dim chiều bằng PCA (tùy chọn whitening) rồi chuẩn hóa L2 lại.
+  # Được lưu trong index (projection.npz) để lúc query dùng đúng phép chiếu lúc build
+  def __init__(self, mean=None, components=None, scale=None):
+    self.mean = mean
+    self.components = components
+    self.scale = scale
+
+  @property
+  def dim(self):
+    return len(self.components)
+
+  @property
+  def whiten(self):
+    return self.scale is not None
+
+  @classmethod
+  def fit(cls, batches, dim, whiten=False, max_samples=200000, eps=1e-6):
+    # Tích lũy tổng và ma trận hiệp phương sai theo từng batch nên không cần giữ toàn bộ mẫu trong RAM
+    n, total, outer = 0, None, None
+    for batch in batches:
+      batch = np.asarray(batch[:max_samples - n], dtype=np.float64)
+      if total is None:
+        total, outer = np.zeros(batch.shape[1]), np.zeros((batch.shape[1], batch.shape[1]))
+      total += batch.sum(axis=0)
+      outer += batch.T @ batch
+      n += len(batch)
+      if n >= max_samples:
+        break
+    if n <= dim:
+      raise ValueError(f"Cần hơn {dim} descriptors để train PCA")
+
+    mean = total / n
+    covariance = outer / n - np.outer(mean, mean)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    order = np.argsort(eigenvalues)[::-1][:dim]
+    scale = 1 / np.sqrt(np.maximum(eigenvalues[order], 0) + eps) if whiten else None
+    return cls(mean.astype(np.float32), eigenvectors[:, order].T.astype(np.float32),
+               None if scale is None else scale.astype(np.float32))
+
+  def transform(self, descriptors):
+    projected = (np.asarray(descriptors, dtype=np.float32) - self.mean) @ self.components.T
+    if self.scale is not None:
+      projected *= self.scale
+    projected /= np.maximum(np.linalg.norm(projected, axis=1, keepdims=True), 1e-12)
+    return projected
+
+  def save(self, path):
+    arrays = {'mean': self.mean, 'components': self.components}
+    if self.scale is not None:
+      arrays['scale'] = self.scale
+    np.savez(path, **arrays)
+
+  @classmethod
+  def load(cls, path):
+    data = np.load(path)
+    return cls(data['mean'], data['components'], data['scale'] if 'scale' in data else None)
+
+
+def load_projection(index_path):
+  path = os.path.join(index_path, PROJECTION_FILE)
+  return PCAProjection.load(path) if os.path.isfile(path) else None
@@ -0,0 +1,216 @@
+# Snapshot local của collection sinh viên trên Firestore để không phải stream cả collection mỗi lần
+# refresh bảng:
+#   embeddings.npy  (n, 2, 128) float32: embedding ảnh thẻ và ảnh chân dung, một hàng mỗi sinh viên
+#   meta.sqlite     bảng students (id document, hàng trong embeddings.npy, msv, name, TheSV, ChanDung,
+#                   updated_at, deleted) và sync_state (mốc updated_at đã đồng bộ)
+# sync() chỉ kéo về các document có updated_at >= mốc đã lưu (DBHandle ghi updated_at ở mọi lần
+# insert / update) và các lần xóa trong change log. Lần đầu (chưa có snapshot) đọc cả collection.
+# Sinh viên sửa embedding được ghi đè tại chỗ, sinh viên mới được nối thêm vào cuối file .npy.
+#
+#   python -m my_utils.embedding_snapshot face_snapshot --full
+import os
+import sqlite3
+import argparse
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+
+from my_utils.face_gallery import EMBEDDING_KEYS
+from my_utils.npy_io import append_npy
+
+METADATA_KEYS = ('msv', 'name', 'TheSV', 'ChanDung')
+
+
+def _timestamp(value):
+  # Timestamp Firestore (datetime có timezone) -> giây epoch
+  if value is None:
+    return 0.0
+  if isinstance(value, datetime):
+    return value.timestamp()
+  return float(value)
+
+
+class EmbeddingSnapshot:
+  def __init__(self, path='face_snapshot', dim=128):
+    self.path = path
+    self.dim = dim
+    os.makedirs(path, exist_ok=True)
+    self.embeddings_path = os.path.join(path, 'embeddings.npy')
+    if not os.path.isfile(self.embeddings_path):
+      np.save(self.embeddings_path, np.zeros((0, len(EMBEDDING_KEYS), dim), dtype=np.float32))
+    # Streamlit gọi từ nhiều thread, mọi truy cập SQLite đi qua một lock
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(os.path.join(path, 'meta.sqlite'), check_same_thread=False)
+    self.conn.executescript("""
+      CREATE TABLE IF NOT EXISTS students (
+        id TEXT PRIMARY KEY, row INTEGER NOT NULL, msv TEXT, name TEXT, TheSV TEXT, ChanDung TEXT,
+        updated_at REAL NOT NULL DEFAULT 0, deleted INTEGER NOT NULL DEFAULT 0);
+      CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value REAL);
+    """)
+    self.conn.commit()
+    self._load_embeddings()
+
+  def _load_embeddings(self):
+    self.embeddings = np.load(self.embeddings_path, mmap_mode='r')
+
+  @property
+  def last_sync(self):
+    row = self.conn.execute("SELECT value FROM sync_state WHERE key = 'updated_at'").fetchone()
+    return None if row is None else row[0]
+
+  def __len__(self):
+    return self.conn.execute("SELECT COUNT(*) FROM students WHERE deleted = 0").fetchone()[0]
+
+  def _vectors(self, dat):
+    vectors = np.zeros((len(EMBEDDING_KEYS), self.dim), dtype=np.float32)
+    for v, key in enumerate(EMBEDDING_KEYS):
+      feature = dat.get(key)
+      if feature is not None and len(feature):
+        vectors[v] = np.asarray(feature, dtype=np.float32).ravel()[:self.dim]
+    return vectors
+
+  def apply(self, docs, deleted_ids=()):
+    # docs: các (id, dict) mới hoặc đã sửa; deleted_ids: id đã xóa. Trả về (số upsert, số xóa)
+    with self.lock:
+      known = {doc_id: (row, updated_at, deleted) for doc_id, row, updated_at, deleted in
+               self.conn.execute("SELECT id, row, updated_at, deleted FROM students")}
+      rows = {doc_id: row for doc_id, (row, _, _) in known.items()}
+      updates, appends, records = {}, [], []
+      newest = self.last_sync or 0.0
+      for doc_id, dat in docs:
+        updated_at = _timestamp(dat.get('updated_at'))
+        # Document đúng bằng mốc lần trước được trả về lại (query >=), bỏ qua nếu không đổi
+        if doc_id in known and not known[doc_id][2] and updated_at and updated_at <= known[doc_id][1]:
+          continue
+        vectors = self._vectors(dat)
+        if doc_id in rows:
+          updates[rows[doc_id]] = vectors
+          row = rows[doc_id]
+        else:
+          row = len(self.embeddings) + len(appends)
+          appends.append(vectors)
+          rows[doc_id] = row
+        newest = max(newest, updated_at)
+        records.append((doc_id, row) + tuple(dat.get(key) for key in METADATA_KEYS) + (updated_at,))
+
+      # Ghi embedding trước rồi mới commit metadata: nếu bị ngắt giữa chừng, lần sync sau ghi lại
+      if updates:
+        matrix = np.load(self.embeddings_path, mmap_mode='r+')
+        for row, vectors in updates.items():
+          matrix[row] = vectors
+        matrix.flush()
+        del matrix
+      if appends:
+        append_npy(self.embeddings_path, np.stack(appends))
+      self._load_embeddings()
+
+      self.conn.executemany("""
+        INSERT INTO students (id, row, msv, name, TheSV, ChanDung, updated_at, deleted)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+        ON CONFLICT(id) DO UPDATE SET msv = excluded.msv, name = excluded.name, TheSV = excluded.TheSV,
+          ChanDung = excluded.ChanDung, updated_at = excluded.updated_at, deleted = 0""", records)
+      n_deleted = 0
+      for doc_id in deleted_ids:
+        n_deleted += self.conn.execute("UPDATE students SET deleted = 1 WHERE id = ? AND deleted = 0",
+                                       (doc_id,)).rowcount
+      self.conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('updated_at', ?)", (newest,))
+      self.conn.commit()
+    return len(records), n_deleted
+
+  def sync(self, db, full=False):
+    # Đồng bộ với Firestore qua DBHandle; full=True đọc lại cả collection (ví dụ dữ liệu cũ chưa có
+    # updated_at). Document chưa từng có updated_at chỉ được thấy ở lần full
+    # DBHandle trả về False khi đọc Firestore lỗi: giữ nguyên snapshot (và mốc) thay vì coi như
+    # collection rỗng, nếu không lần full sẽ đánh dấu xóa mọi sinh viên
+    since = self.last_sync
+    if full or since is None:
+      result = db.get_all()
+      if result is False:
+        print("Không đọc được collection, giữ nguyên snapshot")
+        return 0, 0
+      docs = [(doc.id, doc.to_dict()) for doc in result]
+      # Document không còn trên Firestore thì đánh dấu xóa
+      alive = {doc_id for doc_id, _ in docs}
+      with self.lock:
+        known = [row[0] for row in self.conn.execute("SELECT id FROM students WHERE deleted = 0")]
+      deleted_ids = [doc_id for doc_id in known if doc_id not in alive]
+    else:
+      # >= thay vì > để không bỏ sót document có cùng timestamp với mốc; upsert lặp lại vô hại
+      since = datetime.fromtimestamp(since, tz=timezone.utc)
+      updated, changes = db.get_updated_since(since), db.get_changes_since(since)
+      if updated is False or changes is False:
+        print("Không đọc được thay đổi trên Firestore, giữ nguyên snapshot")
+        return 0, 0
+      docs = [(doc.id, doc.to_dict()) for doc in updated]
+      deleted_ids = [change.to_dict()['id'] for change in changes]
+    return self.apply(docs, deleted_ids)
+
+  def records(self):
+    # Giống FaceController.parse_data: {id document: dict trường của document}
+    with self.lock:
+      rows = self.conn.execute(f"SELECT id, row, {', '.join(METADATA_KEYS)} FROM students "
+                               "WHERE deleted = 0 ORDER BY row").fetchall()
+    # Embedding trả về dạng mảng numpy (không đổi sang list float) để refresh bảng nhanh
+    embeddings = np.array(self.embeddings)
+    records = {}
+    for doc_id, row, *meta in rows:
+      dat = dict(zip(METADATA_KEYS, meta))
+      for v, key in enumerate(EMBEDDING_KEYS):
+        dat[key] = embeddings[row, v]
+      records[doc_id] = dat
+    return records
+
+  def ids(self):
+    with self.lock:
+      return {row[0] for row in self.conn.execute("SELECT id FROM students WHERE deleted = 0")}
+
+  def msvs(self, ids):
+    # {id document: msv} cho các id cho trước
+    ids = list(ids)
+    with self.lock:
+      return dict(self.conn.execute(f"SELECT id, msv FROM students WHERE id IN ({', '.join('?' * len(ids))})",
+                                    ids).fetchall())
+
+  def matrix(self, since=None):
+    # (ids, msv, embeddings (2, n, D)) của các sinh viên còn lại, dùng trực tiếp cho FaceGallery;
+    # since: chỉ lấy các sinh viên có updated_at >= since
+    with self.lock:
+      rows = self.conn.execute("SELECT id, msv, row FROM students WHERE deleted = 0 AND updated_at >= ? "
+                               "ORDER BY row", (since or 0.0,)).fetchall()
+    if not rows:
+      return [], [], np.zeros((len(EMBEDDING_KEYS), 0, self.dim), dtype=np.float32)
+    ids, msvs, index = zip(*rows)
+    return list(ids), list(msvs), np.asarray(self.embeddings[list(index)]).transpose(1, 0, 2)
+
+  def compact(self):
+    # Bỏ các hàng của sinh viên đã xóa khỏi embeddings.npy
+    with self.lock:
+      rows = self.conn.execute("SELECT id, row FROM students WHERE deleted = 0 ORDER BY row").fetchall()
+      matrix = np.asarray(self.embeddings)[[row for _, row in rows]] if rows else \
+        np.zeros((0, len(EMBEDDING_KEYS), self.dim), dtype=np.float32)
+      tmp_path = self.embeddings_path + '.tmp.npy'
+      np.save(tmp_path, matrix)
+      os.replace(tmp_path, self.embeddings_path)
+      self.conn.execute("DELETE FROM students WHERE deleted = 1")
+      self.conn.executemany("UPDATE students SET row = ? WHERE id = ?",
+                            [(new_row, doc_id) for new_row, (doc_id, _) in enumerate(rows)])
+      self.conn.commit()
+      self._load_embeddings()
+
+
+if __name__ == '__main__':
+  from my_utils.db_handle import DBHandle
+
+  parser = argparse.ArgumentParser(description='Đồng bộ snapshot embedding local với Firestore.')
+  parser.add_argument('path', type=str, help='Thư mục snapshot')
+  parser.add_argument('--collection', type=str, default='face_dataset', help='Tên collection Firestore')
+  parser.add_argument('--full', action='store_true', help='Đọc lại toàn bộ collection')
+  parser.add_argument('--compact', action='store_true', help='Dọn các hàng đã xóa sau khi đồng bộ')
+  args = parser.parse_args()
+
+  snapshot = EmbeddingSnapshot(args.path)
+  n_upserts, n_deleted = snapshot.sync(DBHandle(args.collection), full=args.full)
+  if args.compact:
+    snapshot.compact()
+  print(f"{n_upserts} sinh viên mới / sửa, {n_deleted} bị xóa, snapshot có {len(snapshot)} sinh viên")
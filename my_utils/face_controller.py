@@ -6,11 +6,52 @@ from streamlit.runtime.uploaded_file_manager import UploadedFile
 from miscs.face_models.yunet import YuNet
 from miscs.face_models.sface import SFace
 from google.cloud import firestore
-import re, unicodedata
+from my_utils.embedding_snapshot import EmbeddingSnapshot
+from my_utils.face_index import ExactFaceIndex, create_face_index
+from my_utils.signed_url_cache import SignedUrlCache
+import os, re, unicodedata
+
+
+def detect_faces(detector, img: np.ndarray, scale_factor: float = 1.3, max_side: int = 640, min_side: int = 24):
+  # Một lượt YuNet trên ảnh đã giới hạn cạnh dài max_side; chỉ khi không thấy mặt mới thử các mức
+  # nhỏ hơn của pyramid (mặt quá to so với khung hình) và cuối cùng một mức lớn hơn 2 lần (mặt
+  # nhỏ trong ảnh lớn). Bbox và landmark được đổi về tọa độ ảnh gốc, trả về kèm ảnh gốc
+  heigh, width = img.shape[:2]
+  base = min(1.0, max_side / max(heigh, width))
+  scales = [base]
+  while scales[-1] / scale_factor * min(heigh, width) > min_side:
+    scales.append(scales[-1] / scale_factor)
+  if base < 1.0:
+    scales.append(min(1.0, 2 * base))
+
+  for scale in scales:
+    # Mọi mức đều resize thẳng từ ảnh gốc: resize nối tiếp từ mức trước làm mờ thêm và mất mặt
+    level = cv2.resize(img, (max(1, int(width * scale)), max(1, int(heigh * scale))),
+                       interpolation=cv2.INTER_AREA) if scale != 1.0 else img
+    h, w = level.shape[:2]
+    detector.setInputSize((w, h))
+    bboxs = detector.infer(level)
+    if len(bboxs) > 0:
+      bboxs = bboxs.copy()
+      # x, y, w, h và 5 landmark (10 giá trị) theo tỉ lệ thực của mức pyramid; cột cuối là score
+      bboxs[:, 0:14:2] *= width / w
+      bboxs[:, 1:14:2] *= heigh / h
+      return (bboxs, img)
+
+  return ([], img)
+
 
 class FaceController:
-  def __init__(self, dbname) -> None:
+  def __init__(self, dbname, index_path='face_index.npz', index_kind='ivf', snapshot_path='face_snapshot') -> None:
     self.db = DBHandle(dbname)
+    # Bản sao local của collection, chỉ đồng bộ phần thay đổi mỗi lần refresh
+    self.snapshot = EmbeddingSnapshot(snapshot_path)
+    # Signed URL / thumbnail của ảnh thẻ và ảnh chân dung cho bảng sinh viên
+    self.urls = SignedUrlCache(self.db.bucket)
+    # Index embedding cho nhận dạng trên gallery lớn, load / dựng lười ở lần identify đầu tiên
+    self.index_path = index_path
+    self.index_kind = index_kind
+    self.face_index = None
     self.detector = YuNet(
       modelPath='./miscs/face_models/face_detection_yunet_2023mar.onnx',
       confThreshold=0.85,
@@ -20,23 +61,9 @@ class FaceController:
       disType=0,
     )
     
-  def detect(self, img: np.ndarray, scale_factor: float = 1.3):
-    heigh = img.shape[0]
-    width = img.shape[1]
-    
-    scale = 1.0
-    while scale * min(heigh, width) > 24:
-      img_resized = cv2.resize(img, (int(width * scale), int(heigh * scale)))
-      h, w = img_resized.shape[:2]
-      self.detector.setInputSize((w, h))
-      bboxs = self.detector.infer(img_resized)
-      print(bboxs)
-      if len(bboxs) > 0:
-        return (bboxs, img_resized)
-      scale /= scale_factor
-    
-    return ([], img)
-  
+  def detect(self, img: np.ndarray, scale_factor: float = 1.3, max_side: int = 640, min_side: int = 24):
+    return detect_faces(self.detector, img, scale_factor, max_side, min_side)
+
   def insert(self, msv: str, name: str, thesv: UploadedFile, chandung: UploadedFile):
     _thesv_img = Image.open(thesv)
     _chandung_img = Image.open(chandung)
@@ -58,6 +85,7 @@ class FaceController:
     chandung.seek(0)
     self.db.upload_file(thesv, 'face_dataset/TheSV')
     self.db.upload_file(chandung, 'face_dataset/ChanDung')
+    self.urls.invalidate([f"face_dataset/TheSV/{thesv.name}", f"face_dataset/ChanDung/{chandung.name}"])
     
     doc = {
       'msv': msv,
@@ -68,7 +96,9 @@ class FaceController:
       'feature_chandung': chandung_feature[0].tolist(),
     }
     
-    self.db.insert(doc)
+    doc_id = self.db.insert(doc)
+    if doc_id:
+      self._index_features(doc_id, [thesv_feature[0], chandung_feature[0]])
     return 1
   
   def update(self, id, msv: str, name: str, thesv: UploadedFile, chandung: UploadedFile):
@@ -96,6 +126,7 @@ class FaceController:
     
     if thesv is not None:
       self.db.upload_file(thesv, 'face_dataset/TheSV')
+      self.urls.invalidate([f"face_dataset/TheSV/{thesv.name}"])
       self.db.update(id, { \
                         'TheSV': f"gs://demo2-2a1d9.appspot.com/face_dataset/TheSV/{thesv.name}", \
                         'feature': thesv_feature[0].tolist(), \
@@ -103,11 +134,16 @@ class FaceController:
       
     if chandung is not None:
       self.db.upload_file(chandung, 'face_dataset/ChanDung')
+      self.urls.invalidate([f"face_dataset/ChanDung/{chandung.name}"])
       self.db.update(id, { \
                         'ChanDung': f"gs://demo2-2a1d9.appspot.com/face_dataset/ChanDung/{chandung.name}",
                         'feature_chandung': chandung_feature[0].tolist(),
                         })
     
+    if self.face_index is not None and (thesv is not None or chandung is not None):
+      dat = self.db.get_by_id(id).to_dict()
+      self._index_features(id, [dat['feature'], dat['feature_chandung']])
+
     if msv is not None:
       self.db.update(id, {'msv': msv})
     if name is not None:
@@ -118,44 +154,81 @@ class FaceController:
   def delete(self, ids):
     for id in ids:
       self.db.delete(id)
+    if self.face_index is not None and self.face_index.remove(set(ids)):
+      self._save_face_index()
     return 1
-  
-  def parse_data(self):
-    tb = {
-      # "msv" : [],
-      # "name" : [],
-      # "TheSV" : [],
-      # "ChanDung" : [],
-      # "checkbox" : [],
-      # "id": [],
-      # "feature": [],
-      # "feature_chandung": [],
-    }
 
-    for i in self.db.get_all():
-      tb[i.id] = i.to_dict()
-      # j = i.to_dict()
-      # tb["feature_chandung"].append(j["feature_chandung"])
-      # tb["checkbox"].append(False)
-      # tb["msv"].append(j["msv"])
-      # tb["name"].append(j["name"])
-      # path1 = j["TheSV"].replace("gs://demo2-2a1d9.appspot.com/","")
-      # path2 = j["ChanDung"].replace("gs://demo2-2a1d9.appspot.com/","")
+  def load_face_index(self, rebuild=False):
+    # Index lưu trên đĩa; chưa có (hoặc rebuild) thì dựng từ snapshot local của collection,
+    # mỗi sinh viên hai hàng: ảnh thẻ và ảnh chân dung. Index cũ hơn snapshot (synced_at < mốc
+    # sync_state) được cập nhật phần chênh lệch
+    if self.face_index is None and os.path.isfile(self.index_path) and not rebuild:
+      face_index = ExactFaceIndex.load(self.index_path)
+      # File trên đĩa khác loại index đang cấu hình (index_kind) thì dựng lại
+      rebuild = face_index.kind != self.index_kind
+      if not rebuild:
+        self.face_index = face_index
+        self.snapshot.sync(self.db)
+    if self.face_index is None or rebuild:
+      self.snapshot.sync(self.db)
+      self.face_index = create_face_index(self.index_kind)
+
+    last_sync = self.snapshot.last_sync or 0.0
+    if self.face_index.synced_at < last_sync or rebuild or not os.path.isfile(self.index_path):
+      self._sync_face_index(last_sync)
+    return self.face_index
 
-      # public_url = self.db.bucket.blob(path1).generate_signed_url(expiration=timedelta(seconds=3300), method='GET')
-      # tb["TheSV"].append(public_url)
-      # tb["feature"].append(j["feature"])
-      # public_url = self.db.bucket.blob(path2).generate_signed_url(expiration=timedelta(seconds=3600), method='GET')
-      # tb["ChanDung"].append(public_url)
+  def _sync_face_index(self, last_sync):
+    # Xóa sinh viên không còn trong snapshot, thêm lại (thay thế) sinh viên sửa từ mốc trước
+    alive = self.snapshot.ids()
+    labels = set(self.face_index.labels[~self.face_index.deleted].tolist())
+    self.face_index.remove(labels - alive)
+    ids, _, embeddings = self.snapshot.matrix(since=self.face_index.synced_at or None)
+    if len(ids):
+      # Bỏ các embedding trống (sinh viên thiếu ảnh)
+      labels = np.tile(np.asarray(ids, dtype=object), len(embeddings))
+      features = embeddings.reshape(-1, embeddings.shape[-1])
+      valid = features.any(axis=1)
+      self.face_index.remove(set(ids))
+      if valid.any():
+        self.face_index.add(labels[valid], features[valid])
+    self.face_index.synced_at = last_sync
+    self._save_face_index()
 
-    return tb
+  def _save_face_index(self):
+    # Hàng bị thay thế / xóa chỉ là tombstone, dọn khi chiếm quá nhiều trước khi ghi ra đĩa
+    self.face_index.compact_if_needed()
+    self.face_index.save(self.index_path)
+
+  def _index_features(self, doc_id, features):
+    # Giữ index đồng bộ khi thêm / sửa sinh viên (chỉ khi index đã được load)
+    if self.face_index is None:
+      return
+    self.face_index.add([doc_id] * len(features), np.asarray(features, dtype=np.float32).reshape(len(features), -1))
+    self._save_face_index()
+
+  def identify(self, img: np.ndarray, threshold: float = None):
+    # Nhận dạng mọi khuôn mặt trong ảnh trên toàn bộ gallery: [(bbox, id document hoặc None, cosine)]
+    threshold = self.regconize.cosineThreshold if threshold is None else threshold
+    face_index = self.load_face_index()
+    bboxs, img = self.detect(img)
+    if len(bboxs) == 0:
+      return []
+    features = self.regconize.inferBatch(img, bboxs[:, :-1])
+    return [(bbox[:4], label, score)
+            for bbox, (label, score) in zip(bboxs, face_index.identify(features, threshold))]
+  
+  def parse_data(self):
+    # {id document: dict}, đọc từ snapshot local sau khi kéo về phần thay đổi trên Firestore
+    self.snapshot.sync(self.db)
+    return self.snapshot.records()
 
   def find(self, msv: str, name: str):
     def remove_accents(input_str):
       nfkd_form = unicodedata.normalize('NFKD', input_str)
       return u"".join([c for c in nfkd_form if not unicodedata.combining(c)])
     
-    docs = self.db.get_all()
+    docs = self.parse_data()
     results = {}
     
     msv = '.*' + re.sub(
@@ -175,15 +248,14 @@ class FaceController:
     while '**' in name:
       name = name.replace('**', '*')
     
-    for doc in docs:
-      dat = doc.to_dict()
+    for doc_id, dat in docs.items():
       dat_msv = re.sub(r'\s+', '', remove_accents(dat['msv']).lower())
       dat_name = re.sub(r'\s+', '', remove_accents(dat['name']).lower())
 
       m1 = (msv == "") or (re.match(msv, dat_msv) is not None)
       m2 = (name == "") or (re.match(name, dat_name) is not None)
       if m1 and m2:
-        results[doc.id] = dat
+        results[doc_id] = dat
 
     return results            
   
@@ -0,0 +1,81 @@
+# Gallery khuôn mặt cho điểm danh lớp học: toàn bộ embedding SFace của sinh viên được giữ trong
+# một ma trận float32 đã chuẩn hóa L2 nên cosine của mọi khuôn mặt với cả danh sách chỉ là một phép
+# nhân ma trận. Mỗi sinh viên có thể có nhiều embedding (ảnh thẻ, ảnh chân dung), điểm của sinh viên
+# là điểm cao nhất trong số đó. Ghép khuôn mặt - sinh viên một-một bằng thuật toán Hungary
+# (tổng cosine lớn nhất), chỉ giữ các cặp đạt ngưỡng cosine của SFace.
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+SFACE_COSINE_THRESHOLD = 0.363
+EMBEDDING_KEYS = ('feature', 'feature_chandung')
+
+
+def l2_normalize(features):
+  features = np.asarray(features, dtype=np.float32).reshape(-1, np.shape(features)[-1])
+  return features / np.maximum(np.linalg.norm(features, axis=1, keepdims=True), 1e-12)
+
+
+class FaceGallery:
+  # embeddings: danh sách (n_views, n, D) hoặc (n, D); hàng toàn 0 (thiếu ảnh) không khớp với ai
+  def __init__(self, labels, embeddings, threshold=SFACE_COSINE_THRESHOLD):
+    self.labels = list(labels)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if embeddings.ndim == 2:
+      embeddings = embeddings[None]
+    self.n_views, n, self.dim = embeddings.shape
+    assert n == len(self.labels), "Số embedding và số nhãn không khớp"
+    # Các view xếp liền nhau thành một ma trận (n_views * n, D) để chỉ cần một GEMM
+    self.matrix = np.ascontiguousarray(l2_normalize(embeddings.reshape(-1, self.dim)))
+    self.threshold = threshold
+
+  @classmethod
+  def from_records(cls, records, label_key='msv', keys=EMBEDDING_KEYS, threshold=SFACE_COSINE_THRESHOLD):
+    # records: các dict của Firestore (hoặc hàng DataFrame) có nhãn và các trường embedding
+    labels, views = [], [[] for _ in keys]
+    dim = None
+    for record in records:
+      labels.append(record[label_key])
+      for view, key in zip(views, keys):
+        feature = record.get(key) if hasattr(record, 'get') else record[key]
+        feature = None if feature is None else np.asarray(feature, dtype=np.float32).ravel()
+        if feature is not None and feature.size:
+          dim = feature.size
+        view.append(feature)
+    dim = dim or 128
+    embeddings = np.zeros((len(keys), len(labels), dim), dtype=np.float32)
+    for v, view in enumerate(views):
+      for i, feature in enumerate(view):
+        if feature is not None and feature.size == dim:
+          embeddings[v, i] = feature
+    return cls(labels, embeddings, threshold)
+
+  def __len__(self):
+    return len(self.labels)
+
+  def scores(self, queries):
+    # (n_queries, n) cosine của từng khuôn mặt với từng sinh viên (max theo các view)
+    queries = l2_normalize(queries)
+    if len(self) == 0:
+      return np.zeros((len(queries), 0), dtype=np.float32)
+    return (queries @ self.matrix.T).reshape(len(queries), self.n_views, len(self)).max(axis=1)
+
+  def match(self, queries):
+    # Trả về danh sách (chỉ số khuôn mặt, chỉ số sinh viên, cosine), mỗi khuôn mặt và mỗi sinh viên
+    # xuất hiện nhiều nhất một lần
+    queries = np.asarray(queries, dtype=np.float32)
+    if queries.size == 0 or len(self) == 0:
+      return []
+    scores = self.scores(queries)
+    # Chỉ đưa vào Hungary những sinh viên khớp ít nhất một khuôn mặt: ma trận chi phí chỉ còn
+    # cỡ số khuôn mặt x số ứng viên thay vì cả danh sách lớp
+    candidates = np.flatnonzero((scores >= self.threshold).any(axis=0))
+    if len(candidates) == 0:
+      return []
+    sub = scores[:, candidates]
+    # Cặp dưới ngưỡng có lợi ích 0 để không ảnh hưởng tới phép ghép, bị bỏ ở bước lọc sau
+    rows, cols = linear_sum_assignment(np.where(sub >= self.threshold, sub, 0), maximize=True)
+    keep = sub[rows, cols] >= self.threshold
+    return [(int(r), int(candidates[c]), float(sub[r, c])) for r, c in zip(rows[keep], cols[keep])]
+
+  def match_labels(self, queries):
+    return [(face, self.labels[student], score) for face, student, score in self.match(queries)]
@@ -0,0 +1,379 @@
+# Index tìm kiếm embedding khuôn mặt (SFace, 128 chiều) cho gallery lớn (cả trường, 100k+ người).
+#   - ExactFaceIndex: quét toàn bộ bằng một GEMM, dùng làm chuẩn và làm fallback
+#   - IVFFaceIndex: IVF-flat thuần NumPy. Embedding (đã chuẩn hóa L2) được chia vào n_lists cụm
+#     bằng spherical k-means; query chỉ quét n_probe cụm gần nhất. Khi index còn nhỏ hoặc chưa
+#     train, tự quay về quét toàn bộ
+# Cả hai có cùng giao diện add / remove / search / save / load. Mỗi hàng có nhãn (id document
+# Firestore), một người có thể có nhiều hàng (ảnh thẻ, ảnh chân dung); xóa là tombstone, insert lại
+# cùng nhãn sẽ thay thế các hàng cũ.
+#
+#   python -m my_utils.face_index face_index.npz --report       (recall / latency so với quét toàn bộ)
+#   python -m my_utils.face_index face_index.npz --synthetic 100000 --report
+import os
+import time
+import argparse
+
+import numpy as np
+
+from my_utils.face_gallery import l2_normalize
+
+INDEX_KINDS = ('exact', 'ivf')
+
+
+class ExactFaceIndex:
+  kind = 'exact'
+
+  def __init__(self, dim=128):
+    self.dim = dim
+    # Các mảng được cấp phát dư (gấp đôi khi đầy) để mỗi lần add chỉ tốn theo số hàng thêm vào;
+    # vectors / labels / deleted là view của _size hàng đầu
+    self._size = 0
+    self._vector_buf = np.zeros((0, dim), dtype=np.float32)
+    self._label_buf = np.zeros(0, dtype=object)
+    self._deleted_buf = np.zeros(0, dtype=bool)
+    # {nhãn: các hàng còn sống} để xóa / thay thế theo nhãn không phải quét cả index
+    self._rows = {}
+    self._n_live = 0
+    # Mốc sync_state của EmbeddingSnapshot mà index đã được cập nhật tới (FaceController)
+    self.synced_at = 0.0
+
+  @property
+  def vectors(self):
+    return self._vector_buf[:self._size]
+
+  @property
+  def labels(self):
+    return self._label_buf[:self._size]
+
+  @property
+  def deleted(self):
+    return self._deleted_buf[:self._size]
+
+  def __len__(self):
+    return self._n_live
+
+  def _buffers(self):
+    return ('_vector_buf', '_label_buf', '_deleted_buf')
+
+  def _reserve(self, size):
+    capacity = len(self._vector_buf)
+    if size <= capacity:
+      return
+    capacity = max(size, 2 * capacity, 1024)
+    for name in self._buffers():
+      old = getattr(self, name)
+      buf = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+      n = min(self._size, len(old))
+      buf[:n] = old[:n]
+      setattr(self, name, buf)
+
+  def _set_rows(self, vectors, labels, deleted):
+    self._size = 0
+    self._vector_buf = np.ascontiguousarray(vectors, dtype=np.float32)
+    self._label_buf = np.asarray(labels, dtype=object)
+    self._deleted_buf = np.asarray(deleted, dtype=bool).copy()
+    self._size = len(self._vector_buf)
+    self._rows = {}
+    for row in np.flatnonzero(~self._deleted_buf).tolist():
+      self._rows.setdefault(self._label_buf[row], []).append(row)
+    self._n_live = int(self._size - self._deleted_buf.sum())
+
+  def add(self, labels, embeddings):
+    embeddings = l2_normalize(embeddings)
+    labels = np.asarray(labels, dtype=object).ravel()
+    assert len(labels) == len(embeddings), "Số nhãn và số embedding không khớp"
+    self.remove(set(labels.tolist()))
+    start, end = self._size, self._size + len(labels)
+    self._reserve(end)
+    self._vector_buf[start:end] = embeddings
+    self._label_buf[start:end] = labels
+    self._deleted_buf[start:end] = False
+    self._size = end
+    for row, label in enumerate(labels.tolist(), start):
+      self._rows.setdefault(label, []).append(row)
+    self._n_live += len(labels)
+    return np.arange(start, end)
+
+  def remove(self, labels):
+    if isinstance(labels, str):
+      labels = {labels}
+    rows = [row for label in labels for row in self._rows.pop(label, ())]
+    if rows:
+      self._deleted_buf[rows] = True
+      self._n_live -= len(rows)
+    return len(rows)
+
+  @property
+  def deleted_fraction(self):
+    return (self._size - self._n_live) / max(self._size, 1)
+
+  def compact(self):
+    # Bỏ hẳn các hàng đã xóa (tombstone)
+    live = ~self.deleted
+    self._set_rows(self.vectors[live], self.labels[live], self.deleted[live])
+
+  def compact_if_needed(self, max_fraction=0.2):
+    # Gom tombstone (nhãn bị thay thế hoặc bị xóa) lại, chỉ compact khi chiếm quá max_fraction số hàng
+    if self.deleted_fraction > max_fraction:
+      self.compact()
+      return True
+    return False
+
+  def _search_rows(self, queries, rows, k):
+    # Top-k trong tập hàng rows cho một query
+    scores = self.vectors[rows] @ queries
+    scores[self.deleted[rows]] = -np.inf
+    k = min(k, len(rows))
+    top = np.argpartition(-scores, k - 1)[:k] if k < len(rows) else np.arange(len(rows))
+    top = top[np.argsort(-scores[top])]
+    return scores[top], rows[top]
+
+  def search_exact(self, queries, k=1):
+    queries = l2_normalize(queries)
+    if len(self.vectors) == 0:
+      return [([], []) for _ in queries]
+    scores = queries @ self.vectors.T
+    scores[:, self.deleted] = -np.inf
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    results = []
+    for q, t in enumerate(top):
+      t = t[np.argsort(-scores[q, t])]
+      t = t[np.isfinite(scores[q, t])]
+      results.append((scores[q, t], t))
+    return results
+
+  def search(self, queries, k=1):
+    return self.search_exact(queries, k)
+
+  def identify(self, queries, threshold=0.363, k=1):
+    # Nhãn tốt nhất (hoặc None) và cosine cho từng query
+    results = []
+    for scores, rows in self.search(queries, k):
+      if len(rows) and scores[0] >= threshold:
+        results.append((self.labels[rows[0]], float(scores[0])))
+      else:
+        results.append((None, float(scores[0]) if len(rows) else 0.0))
+    return results
+
+  def _arrays(self):
+    return {'kind': np.array(self.kind), 'vectors': self.vectors, 'labels': self.labels.astype(str),
+            'deleted': self.deleted, 'synced_at': np.float64(self.synced_at)}
+
+  def save(self, path):
+    # Ghi file tạm rồi đổi tên để không làm hỏng index đang có nếu bị ngắt giữa chừng
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **self._arrays())
+    os.replace(tmp_path, path)
+
+  def _restore(self, data):
+    self._set_rows(data['vectors'], data['labels'].astype(object), data['deleted'])
+    self.synced_at = float(data['synced_at']) if 'synced_at' in data else 0.0
+
+  @staticmethod
+  def load(path):
+    data = np.load(path, allow_pickle=False)
+    index = create_face_index(str(data['kind']), dim=data['vectors'].shape[1])
+    index._restore(data)
+    return index
+
+
+class IVFFaceIndex(ExactFaceIndex):
+  kind = 'ivf'
+
+  def __init__(self, dim=128, n_lists=None, n_probe=8, min_train_size=4096):
+    super().__init__(dim)
+    self.n_lists = n_lists
+    self.n_probe = n_probe
+    self.min_train_size = min_train_size
+    self.centroids = None
+    self._assign_buf = np.zeros(len(self._vector_buf), dtype=np.int32)
+    self.trained_size = 0
+    self._auto_lists = n_lists is None
+    self._lists = None
+
+  @property
+  def trained(self):
+    return self.centroids is not None
+
+  @property
+  def assign(self):
+    return self._assign_buf[:self._size]
+
+  @assign.setter
+  def assign(self, assign):
+    self._assign_buf = np.zeros(len(self._vector_buf), dtype=np.int32)
+    self._assign_buf[:len(assign)] = assign
+
+  def _buffers(self):
+    return super()._buffers() + ('_assign_buf',)
+
+  def train(self, embeddings=None, n_iter=10, sample_size=65536, random_state=42):
+    # Spherical k-means (tâm chuẩn hóa L2, gán theo cosine) trên một mẫu các hàng còn sống
+    embeddings = self.vectors[~self.deleted] if embeddings is None else l2_normalize(embeddings)
+    n_lists = max(1, int(4 * np.sqrt(len(embeddings)))) if self._auto_lists else self.n_lists
+    n_lists = min(n_lists, len(embeddings))
+    rng = np.random.default_rng(random_state)
+    if len(embeddings) > sample_size:
+      embeddings = embeddings[rng.choice(len(embeddings), sample_size, replace=False)]
+    centroids = embeddings[rng.choice(len(embeddings), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+      labels = np.argmax(embeddings @ centroids.T, axis=1)
+      sums = np.zeros_like(centroids)
+      np.add.at(sums, labels, embeddings)
+      empty = ~sums.any(axis=1)
+      sums[empty] = centroids[empty]
+      centroids = l2_normalize(sums)
+    self.centroids = centroids
+    self.n_lists = n_lists
+    self.trained_size = len(self)
+    self.assign = self._assign(self.vectors)
+    self._lists = None
+    return self
+
+  def _assign(self, vectors, chunk_size=65536):
+    if len(vectors) == 0:
+      return np.zeros(0, dtype=np.int32)
+    return np.concatenate([np.argmax(vectors[s:s + chunk_size] @ self.centroids.T, axis=1)
+                           for s in range(0, len(vectors), chunk_size)]).astype(np.int32)
+
+  def add(self, labels, embeddings):
+    rows = super().add(labels, embeddings)
+    if len(self) >= self.min_train_size and (not self.trained or
+                                             (self._auto_lists and len(self) > 4 * self.trained_size)):
+      # Train lần đầu khi đủ dữ liệu, train lại khi index đã lớn gấp 4 lần (số cụm tăng theo căn N);
+      # các lần insert khác chỉ gán vào cụm có sẵn
+      self.train()
+    elif self.trained:
+      self._assign_buf[rows] = self._assign(self.vectors[rows])
+      self._lists = None
+    return rows
+
+  def compact(self):
+    assign = self.assign[~self.deleted] if self.trained else None
+    super().compact()
+    if assign is not None:
+      self.assign = assign
+      self._lists = None
+
+  def _inverted_lists(self):
+    # Hàng của từng cụm nằm liền nhau sau khi sắp theo cụm; dựng lại lười sau mỗi lần thay đổi
+    if self._lists is None:
+      order = np.argsort(self.assign, kind='stable')
+      bounds = np.searchsorted(self.assign[order], np.arange(self.n_lists + 1))
+      self._lists = (order, bounds)
+    return self._lists
+
+  def search(self, queries, k=1, n_probe=None):
+    if not self.trained or len(self) < self.min_train_size:
+      return self.search_exact(queries, k)
+    queries = l2_normalize(queries)
+    n_probe = min(n_probe or self.n_probe, self.n_lists)
+    order, bounds = self._inverted_lists()
+    probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+    results = []
+    for query, probe in zip(queries, probes):
+      rows = np.concatenate([order[bounds[c]:bounds[c + 1]] for c in probe])
+      if len(rows) == 0:
+        results.append(([], []))
+        continue
+      scores, rows = self._search_rows(query, rows, k)
+      finite = np.isfinite(scores)
+      results.append((scores[finite], rows[finite]))
+    return results
+
+  def _arrays(self):
+    arrays = super()._arrays()
+    arrays.update(n_probe=np.int32(self.n_probe), min_train_size=np.int32(self.min_train_size),
+                  auto_lists=np.bool_(self._auto_lists))
+    if self.trained:
+      arrays.update(centroids=self.centroids, assign=self.assign, trained_size=np.int64(self.trained_size))
+    return arrays
+
+  def _restore(self, data):
+    super()._restore(data)
+    self.n_probe = int(data['n_probe'])
+    self.min_train_size = int(data['min_train_size'])
+    self._auto_lists = bool(data['auto_lists'])
+    if 'centroids' in data:
+      self.centroids = data['centroids'].astype(np.float32)
+      self.n_lists = len(self.centroids)
+      self.assign = data['assign'].astype(np.int32)
+      self.trained_size = int(data['trained_size'])
+
+
+def create_face_index(kind='ivf', dim=128, **kwargs):
+  if kind == 'exact':
+    return ExactFaceIndex(dim)
+  if kind == 'ivf':
+    return IVFFaceIndex(dim, **kwargs)
+  raise ValueError(f"Loại index không hợp lệ: {kind} (chọn một trong {INDEX_KINDS})")
+
+
+def evaluate(index, queries, k=10, n_probe=None):
+  # Recall@1 / recall@k và latency của index so với quét toàn bộ trên cùng dữ liệu
+  queries = l2_normalize(queries)
+  start = time.perf_counter()
+  exact = index.search_exact(queries, k)
+  exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+  start = time.perf_counter()
+  if isinstance(index, IVFFaceIndex):
+    approx = index.search(queries, k, n_probe=n_probe)
+  else:
+    approx = index.search(queries, k)
+  approx_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+  recall_1 = np.mean([len(a[1]) > 0 and len(e[1]) > 0 and a[1][0] == e[1][0] for a, e in zip(approx, exact)])
+  recall_k = np.mean([len(np.intersect1d(a[1], e[1])) / max(len(e[1]), 1) for a, e in zip(approx, exact)])
+  return {
+    'kind': index.kind,
+    'n_vectors': len(index),
+    'n_queries': len(queries),
+    'n_probe': getattr(index, 'n_probe', None) if n_probe is None else n_probe,
+    'recall@1': float(recall_1),
+    f'recall@{k}': float(recall_k),
+    'exact_ms': exact_ms,
+    'index_ms': approx_ms,
+    'speedup': exact_ms / max(approx_ms, 1e-9),
+  }
+
+
+def synthetic_gallery(n_people, dim=128, noise=0.35, random_state=0):
+  # Mỗi người một vector gốc ngẫu nhiên; query là vector gốc cộng nhiễu (ảnh khác của cùng người)
+  rng = np.random.default_rng(random_state)
+  gallery = l2_normalize(rng.normal(size=(n_people, dim)))
+  return [f'person_{i}' for i in range(n_people)], gallery
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Index ANN cho embedding khuôn mặt: báo cáo recall / latency.')
+  parser.add_argument('index_path', type=str, help='File index (.npz)')
+  parser.add_argument('--synthetic', type=int, default=0, help='Tạo index giả lập với số người này rồi lưu vào index_path')
+  parser.add_argument('--kind', type=str, default='ivf', choices=INDEX_KINDS, help='Loại index khi tạo mới')
+  parser.add_argument('--n_probe', type=int, nargs='+', default=[None], help='Số cụm quét khi query (IVF)')
+  parser.add_argument('--n_queries', type=int, default=1000, help='Số query để đo')
+  parser.add_argument('--k', type=int, default=10, help='Đo recall@k')
+  parser.add_argument('--report', action='store_true', help='In recall / latency so với quét toàn bộ')
+  args = parser.parse_args()
+
+  if args.synthetic:
+    labels, gallery = synthetic_gallery(args.synthetic)
+    index = create_face_index(args.kind)
+    start = time.perf_counter()
+    index.add(labels, gallery)
+    print(f"Đã tạo index {index.kind} với {len(index)} vector ({time.perf_counter() - start:.2f}s)")
+    index.save(args.index_path)
+  else:
+    index = ExactFaceIndex.load(args.index_path)
+    print(f"Đã load index {index.kind} với {len(index)} vector")
+
+  if args.report:
+    rng = np.random.default_rng(1)
+    live = np.flatnonzero(~index.deleted)
+    rows = rng.choice(live, min(args.n_queries, len(live)), replace=False)
+    queries = index.vectors[rows] + rng.normal(scale=0.35 / np.sqrt(index.dim), size=(len(rows), index.dim))
+    for n_probe in args.n_probe:
+      report = evaluate(index, queries, args.k, n_probe)
+      print(f"n_probe={report['n_probe']}: recall@1 {report['recall@1']:.3f}, "
+            f"recall@{args.k} {report[f'recall@{args.k}']:.3f}, {report['index_ms']:.2f} ms/query "
+            f"(quét toàn bộ {report['exact_ms']:.2f} ms, nhanh hơn {report['speedup']:.1f}x)")
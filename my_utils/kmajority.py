@@ -0,0 +1,67 @@
+import numpy as np
+
+from my_utils.bovw_encoder import hamming_distances
+
+
+class KMajority:
+  # K-means cho descriptor nhị phân (k-majority): gán theo khoảng cách Hamming, tâm mới là bit
+  # chiếm đa số trong cụm. Dữ liệu được đưa vào theo batch (partial_fit) để train out-of-core;
+  # gọi update() sau mỗi lượt qua toàn bộ dữ liệu, mỗi lượt là một vòng lặp Lloyd
+  def __init__(self, n_clusters, random_state=42, chunk_size=256):
+    self.n_clusters = n_clusters
+    self.rng = np.random.default_rng(random_state)
+    self.chunk_size = chunk_size
+    self.cluster_centers_ = None
+    self._bit_sums = None
+    self._counts = None
+
+  def _init_centers(self, descriptors):
+    unique = np.unique(descriptors, axis=0)
+    if len(unique) < self.n_clusters:
+      raise ValueError("Không đủ descriptors khác nhau để train vocabulary, hãy giảm n_clusters")
+    self.cluster_centers_ = unique[self.rng.choice(len(unique), self.n_clusters, replace=False)]
+    self._reset()
+
+  def _reset(self):
+    n_bits = self.cluster_centers_.shape[1] * 8
+    self._bit_sums = np.zeros((self.n_clusters, n_bits), dtype=np.int64)
+    self._counts = np.zeros(self.n_clusters, dtype=np.int64)
+
+  def predict(self, descriptors):
+    descriptors = np.ascontiguousarray(descriptors, dtype=np.uint8)
+    labels = np.empty(len(descriptors), dtype=np.int64)
+    for start in range(0, len(descriptors), self.chunk_size):
+      d = hamming_distances(descriptors[start:start + self.chunk_size], self.cluster_centers_)
+      labels[start:start + len(d)] = np.argmin(d, axis=1)
+    return labels
+
+  def partial_fit(self, descriptors):
+    descriptors = np.ascontiguousarray(descriptors, dtype=np.uint8)
+    if self.cluster_centers_ is None:
+      self._init_centers(descriptors)
+    labels = self.predict(descriptors)
+    # Cộng số bit 1 theo từng cụm: sắp xếp theo nhãn rồi reduceat trên các đoạn liên tiếp
+    order = np.argsort(labels, kind='stable')
+    counts = np.bincount(labels, minlength=self.n_clusters)
+    filled = np.flatnonzero(counts)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+    bits = np.unpackbits(descriptors[order], axis=1)
+    self._bit_sums[filled] += np.add.reduceat(bits, starts, axis=0, dtype=np.int64)
+    self._counts += counts
+    return self
+
+  def update(self):
+    # Trả về số tâm bị thay đổi; cụm rỗng giữ nguyên tâm cũ
+    filled = self._counts > 0
+    majority = np.packbits(2 * self._bit_sums[filled] > self._counts[filled, None], axis=1)
+    changed = int(np.any(majority != self.cluster_centers_[filled], axis=1).sum())
+    self.cluster_centers_[filled] = majority
+    self._reset()
+    return changed
+
+  def fit(self, descriptors, n_iter=10):
+    for _ in range(n_iter):
+      self.partial_fit(descriptors)
+      if self.update() == 0:
+        break
+    return self
@@ -0,0 +1,39 @@
+# Ghi .npy tại chỗ, dùng chung cho BOVW index (my_utils/bovw_store.py, my_utils/bovw_update.py) và
+# snapshot embedding khuôn mặt (my_utils/embedding_snapshot.py)
+import io
+import os
+
+import numpy as np
+
+
+def append_npy(path, rows):
+  # Nối thêm dòng vào file .npy tại chỗ: ghi dữ liệu trước rồi mới sửa shape trong header,
+  # nếu bị ngắt giữa chừng file vẫn đọc được với shape cũ
+  with open(path, 'r+b') as f:
+    version = np.lib.format.read_magic(f)
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+    shape, fortran_order, dtype = read_header(f)
+    header_len = f.tell()
+    rows = np.ascontiguousarray(rows, dtype=dtype).reshape((-1,) + shape[1:])
+
+    header = io.BytesIO()
+    header_dict = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order,
+                   'shape': (shape[0] + len(rows),) + shape[1:]}
+    if version == (1, 0):
+      np.lib.format.write_array_header_1_0(header, header_dict)
+    else:
+      np.lib.format.write_array_header_2_0(header, header_dict)
+    if not fortran_order and len(header.getvalue()) == header_len:
+      f.seek(0, os.SEEK_END)
+      f.write(rows.tobytes())
+      f.seek(0)
+      f.write(header.getvalue())
+      return shape[0] + len(rows)
+
+  # Header không còn chỗ cho shape mới: ghi lại cả file
+  data = np.concatenate([np.load(path), rows])
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    np.save(f, data)
+  os.replace(tmp_path, path)
+  return len(data)
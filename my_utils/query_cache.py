@@ -0,0 +1,72 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class QueryCache:
+  # LRU cache theo hash nội dung ảnh, giới hạn theo tổng số byte của các giá trị
+  def __init__(self, max_bytes=64 * 1024 * 1024):
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self._bytes = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def key_for(data: bytes):
+    return hashlib.sha1(data).hexdigest()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def get(self, key, default=None):
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key][0]
+      self.misses += 1
+      return default
+
+  def put(self, key, value, nbytes):
+    with self._lock:
+      if key in self._entries:
+        self._bytes -= self._entries.pop(key)[1]
+      if nbytes > self.max_bytes:
+        return
+      self._entries[key] = (value, nbytes)
+      self._bytes += nbytes
+      while self._bytes > self.max_bytes:
+        _, (_, size) = self._entries.popitem(last=False)
+        self._bytes -= size
+
+  def get_or_compute(self, key, compute, sizeof):
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key][0]
+      self.misses += 1
+    value = compute()
+    self.put(key, value, sizeof(value))
+    return value
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+  def stats(self):
+    total = self.hits + self.misses
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_rate': self.hits / total if total else 0.0,
+      'entries': len(self._entries),
+      'bytes': self._bytes,
+      'max_bytes': self.max_bytes,
+    }
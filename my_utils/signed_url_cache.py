@@ -0,0 +1,109 @@
+# Cache signed URL của ảnh trên Cloud Storage theo đường dẫn blob. Mỗi URL được dùng lại tới khi
+# gần hết hạn (refresh_margin) rồi mới ký lại; các URL cần ký được tạo song song bằng thread pool.
+# Tùy chọn thumbnail: tải ảnh một lần, thu nhỏ và lưu ở thumbnail_dir, bảng hiển thị bằng data URI
+# nên không cần ký URL và trình duyệt không phải tải ảnh gốc.
+import os
+import re
+import time
+import base64
+import hashlib
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+_GS_PREFIX = re.compile(r'^gs://[^/]+/')
+
+
+def blob_path(uri):
+  # "gs://<bucket>/face_dataset/TheSV/a.jpg" -> "face_dataset/TheSV/a.jpg"
+  return _GS_PREFIX.sub('', uri)
+
+
+class SignedUrlCache:
+  def __init__(self, bucket, expiration=3600, refresh_margin=300, workers=16,
+               thumbnail_dir='face_thumbnails', thumbnail_size=128):
+    self.bucket = bucket
+    self.expiration = expiration
+    self.refresh_margin = refresh_margin
+    self.workers = workers
+    self.thumbnail_dir = thumbnail_dir
+    self.thumbnail_size = thumbnail_size
+    self.lock = threading.Lock()
+    self.urls = {}
+    self.thumbnails = {}
+
+  def _sign(self, path):
+    expires_at = time.time() + self.expiration
+    url = self.bucket.blob(path).generate_signed_url(expiration=timedelta(seconds=self.expiration), method='GET')
+    return url, expires_at
+
+  def _thumbnail_file(self, path):
+    return os.path.join(self.thumbnail_dir, hashlib.sha1(path.encode('utf-8')).hexdigest() + '.jpg')
+
+  def _thumbnail(self, path):
+    # Thumbnail trên đĩa dùng lại được giữa các lần chạy; chưa có thì tải ảnh gốc và thu nhỏ
+    file_path = self._thumbnail_file(path)
+    if os.path.isfile(file_path):
+      with open(file_path, 'rb') as f:
+        data = f.read()
+    else:
+      image = cv2.imdecode(np.frombuffer(self.bucket.blob(path).download_as_bytes(), np.uint8), cv2.IMREAD_COLOR)
+      if image is None:
+        return None
+      h, w = image.shape[:2]
+      scale = self.thumbnail_size / max(h, w)
+      if scale < 1:
+        image = cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+      data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes()
+      os.makedirs(self.thumbnail_dir, exist_ok=True)
+      with open(file_path, 'wb') as f:
+        f.write(data)
+    return 'data:image/jpeg;base64,' + base64.b64encode(data).decode('ascii')
+
+  def _run(self, func, paths):
+    if len(paths) <= 1:
+      return [func(path) for path in paths]
+    with ThreadPoolExecutor(min(self.workers, len(paths))) as pool:
+      return list(pool.map(func, paths))
+
+  def get_many(self, uris, thumbnails=False):
+    # uris: đường dẫn gs:// hoặc đường dẫn blob; trả về URL (hoặc data URI) theo đúng thứ tự
+    paths = [blob_path(uri) for uri in uris]
+    if thumbnails:
+      with self.lock:
+        missing = list(dict.fromkeys(p for p in paths if p not in self.thumbnails))
+      for path, data in zip(missing, self._run(self._thumbnail, missing)):
+        if data is not None:
+          with self.lock:
+            self.thumbnails[path] = data
+      # Ảnh không đọc được thì quay về signed URL
+      with self.lock:
+        fallback = [p for p in paths if p not in self.thumbnails]
+      urls = dict(zip(fallback, self.get_many(fallback))) if fallback else {}
+      with self.lock:
+        return [self.thumbnails.get(p) or urls[p] for p in paths]
+
+    now = time.time()
+    with self.lock:
+      stale = list(dict.fromkeys(p for p in paths
+                                 if p not in self.urls or self.urls[p][1] - self.refresh_margin <= now))
+    for path, signed in zip(stale, self._run(self._sign, stale)):
+      with self.lock:
+        self.urls[path] = signed
+    with self.lock:
+      return [self.urls[p][0] for p in paths]
+
+  def get(self, uri, thumbnails=False):
+    return self.get_many([uri], thumbnails)[0]
+
+  def invalidate(self, uris):
+    # Gọi khi blob bị ghi đè (upload lại cùng tên file)
+    with self.lock:
+      for path in map(blob_path, uris):
+        self.urls.pop(path, None)
+        self.thumbnails.pop(path, None)
+        if os.path.isfile(self._thumbnail_file(path)):
+          os.remove(self._thumbnail_file(path))
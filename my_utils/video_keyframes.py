@@ -0,0 +1,116 @@
+# Đưa video vào BOVW index theo keyframe: đọc video tuần tự, so histogram màu (HSV) của frame hiện
+# tại với keyframe gần nhất, chỉ lấy frame mới làm keyframe khi khác đủ nhiều (chuyển cảnh hoặc cảnh
+# đã thay đổi dần). Số ảnh thêm vào index vì vậy theo số cảnh chứ không theo số frame.
+# Mỗi keyframe được lưu với tên "<video>#t=<giây>" (media fragment) để kết quả tìm kiếm mở đúng
+# thời điểm trong video.
+#
+#   python -m my_utils.video_keyframes bovw_index UIUX/KCF/*.mp4 UIUX/SORT/*.mp4 --threshold 0.3
+import re
+import argparse
+
+import cv2
+import numpy as np
+
+from my_utils.bovw_update import BOVWIndexUpdater
+
+_NAME_PATTERN = re.compile(r'^(?P<video>.+)#t=(?P<t>\d+(?:\.\d+)?)$')
+
+
+def keyframe_name(video, seconds):
+  return f"{video}#t={seconds:.3f}"
+
+
+def parse_keyframe_name(name):
+  # (đường dẫn video, giây) nếu ảnh là keyframe của video, ngược lại None
+  match = _NAME_PATTERN.match(name)
+  if match is None:
+    return None
+  return match.group('video'), float(match.group('t'))
+
+
+def format_timestamp(seconds):
+  minutes, seconds = divmod(seconds, 60)
+  return f"{int(minutes):02d}:{seconds:05.2f}"
+
+
+def _frame_signature(frame, size=160):
+  # Histogram H-S trên ảnh thu nhỏ: đủ để phát hiện chuyển cảnh, rẻ hơn nhiều so với SIFT
+  h, w = frame.shape[:2]
+  scale = size / max(h, w)
+  small = cv2.resize(frame, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+  hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+  hist = cv2.calcHist([hsv], [0, 1], None, [16, 8], [0, 180, 0, 256])
+  return cv2.normalize(hist, hist).flatten()
+
+
+def detect_keyframes(video_path, threshold=0.3, min_gap=1.0, step=2, max_side=1024):
+  # Sinh (giây, frame BGR) cho từng keyframe. threshold: khoảng cách Bhattacharyya tối thiểu so với
+  # keyframe trước; min_gap: số giây tối thiểu giữa hai keyframe; step: chỉ xét 1 trong step frame
+  capture = cv2.VideoCapture(video_path)
+  if not capture.isOpened():
+    print(f"Không mở được video {video_path}")
+    return
+  fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+  last_signature, last_time = None, -np.inf
+  index = 0
+  try:
+    while True:
+      if index % step:
+        if not capture.grab():
+          break
+        index += 1
+        continue
+      ok, frame = capture.read()
+      if not ok:
+        break
+      seconds = index / fps
+      index += 1
+      if seconds - last_time < min_gap:
+        continue
+      signature = _frame_signature(frame)
+      if last_signature is not None and \
+          cv2.compareHist(last_signature, signature, cv2.HISTCMP_BHATTACHARYYA) < threshold:
+        continue
+      last_signature, last_time = signature, seconds
+      h, w = frame.shape[:2]
+      scale = max_side / max(h, w) if max_side else 1
+      if scale < 1:
+        frame = cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+      yield seconds, frame
+  finally:
+    capture.release()
+
+
+def ingest_videos(index_path, video_paths, threshold=0.3, min_gap=1.0, step=2, refresh_idf=False):
+  updater = BOVWIndexUpdater(index_path)
+
+  def items():
+    for video_path in video_paths:
+      n = 0
+      for seconds, frame in detect_keyframes(video_path, threshold, min_gap, step, updater.max_side):
+        n += 1
+        yield keyframe_name(video_path, seconds), frame
+      print(f"{video_path}: {n} keyframe")
+
+  ids = updater.add_images(items(), refresh_idf=refresh_idf)
+  if not refresh_idf:
+    # Cả lô keyframe chỉ tính lại IDF (nếu cần) một lần
+    updater.refresh_idf_if_needed()
+  return updater, ids
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Thêm keyframe của video vào BOVW index.')
+  parser.add_argument('index_path', type=str, help='Thư mục BOVW index (build bằng my_utils.bovw_builder)')
+  parser.add_argument('videos', nargs='+', help='Các file video')
+  parser.add_argument('--threshold', type=float, default=0.3,
+                      help='Khoảng cách histogram (Bhattacharyya, 0-1) tối thiểu để lấy keyframe mới')
+  parser.add_argument('--min_gap', type=float, default=1.0, help='Số giây tối thiểu giữa hai keyframe')
+  parser.add_argument('--step', type=int, default=2, help='Chỉ xét 1 trong step frame')
+  parser.add_argument('--refresh_idf', action='store_true',
+                      help='Luôn tính lại IDF sau khi thêm (mặc định chỉ tính khi đã thay đổi quá 5%% index)')
+  args = parser.parse_args()
+
+  updater, ids = ingest_videos(args.index_path, args.videos, args.threshold, args.min_gap, args.step,
+                               refresh_idf=args.refresh_idf)
+  print(f"Đã thêm {len(ids)} keyframe, index hiện có {updater.index.n_live} ảnh")
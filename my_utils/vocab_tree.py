@@ -0,0 +1,146 @@
+# Cây từ vựng (hierarchical k-means) dựng trên vocabulary có sẵn: lá của cây là chính các
+# visual word gốc nên id của word không đổi. Gán descriptor bằng beam search từ gốc xuống lá,
+# chỉ tính khoảng cách tới các word trong những lá được chọn thay vì toàn bộ K word.
+#
+# Dựng sẵn cây cho một index:  python -m my_utils.vocab_tree bovw_index
+import os
+import math
+import argparse
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+TREE_FILE = 'vocab_tree.npz'
+
+
+def _squared_distances(x, centers):
+  # x: (N, D), centers: (N, M, D) -> (N, M)
+  d = np.einsum('nmd,nmd->nm', centers, centers)
+  d -= 2 * np.einsum('nd,nmd->nm', x, centers)
+  d += np.einsum('nd,nd->n', x, x)[:, None]
+  return np.maximum(d, 0)
+
+
+class VocabularyTree:
+  def __init__(self, vocabulary, branching=10, depth=None, random_state=42, _arrays=None):
+    self.vocabulary = np.ascontiguousarray(vocabulary, dtype=np.float32)
+    self.n_words, self.dim = self.vocabulary.shape
+    self.branching = branching
+    if _arrays is not None:
+      self.depth = len(_arrays['level_centers'])
+      self.level_centers = _arrays['level_centers']
+      self.level_valid = _arrays['level_valid']
+      self.leaf_words = _arrays['leaf_words']
+      return
+
+    if depth is None:
+      # Trung bình mỗi lá giữ khoảng `branching` word
+      depth = max(1, math.ceil(math.log(max(self.n_words / branching, 1)) / math.log(branching)))
+    self.depth = depth
+    self.random_state = random_state
+    self._build()
+
+  def _split(self, words):
+    b = self.branching
+    if len(words) <= b:
+      return [words[i:i + 1] for i in range(len(words))]
+    kmeans = MiniBatchKMeans(n_clusters=b, random_state=self.random_state,
+                             batch_size=max(1024, b * 16), n_init=3)
+    labels = kmeans.fit_predict(self.vocabulary[words])
+    return [words[labels == c] for c in range(b) if np.any(labels == c)]
+
+  def _build(self):
+    b, D = self.branching, self.dim
+    # Mỗi level l có b^l slot; slot con thứ c của slot j ở level l là j * b + c ở level l + 1
+    nodes = [np.arange(self.n_words)]
+    self.level_centers, self.level_valid = [], []
+    for _ in range(self.depth):
+      centers = np.zeros((len(nodes) * b, D), dtype=np.float32)
+      valid = np.zeros(len(nodes) * b, dtype=bool)
+      children = [np.empty(0, dtype=np.int64)] * (len(nodes) * b)
+      for j, words in enumerate(nodes):
+        if len(words) == 0:
+          continue
+        for c, child in enumerate(self._split(words)):
+          centers[j * b + c] = self.vocabulary[child].mean(axis=0)
+          valid[j * b + c] = True
+          children[j * b + c] = child
+      self.level_centers.append(centers)
+      self.level_valid.append(valid)
+      nodes = children
+
+    max_leaf = max(1, max(len(words) for words in nodes))
+    self.leaf_words = np.full((len(nodes), max_leaf), -1, dtype=np.int32)
+    for j, words in enumerate(nodes):
+      self.leaf_words[j, :len(words)] = words
+
+  def query(self, descriptors, k=5, beam=3, chunk_size=1024):
+    # Trả về (word ids, khoảng cách Euclid), mỗi dòng sắp xếp tăng dần theo khoảng cách
+    descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+    n = len(descriptors)
+    k = min(k, self.n_words)
+    out_idx = np.empty((n, k), dtype=np.int64)
+    out_dist = np.empty((n, k), dtype=np.float32)
+    b = self.branching
+
+    for start in range(0, n, chunk_size):
+      x = descriptors[start:start + chunk_size]
+      rows = np.arange(len(x))[:, None]
+      slots = np.zeros((len(x), 1), dtype=np.int64)
+      for level in range(self.depth):
+        cand = (slots[:, :, None] * b + np.arange(b)).reshape(len(x), -1)
+        d = _squared_distances(x, self.level_centers[level][cand])
+        d[~self.level_valid[level][cand]] = np.inf
+        width = min(beam, cand.shape[1])
+        best = np.argpartition(d, width - 1, axis=1)[:, :width]
+        slots = cand[rows, best]
+
+      words = self.leaf_words[slots].reshape(len(x), -1)
+      d = _squared_distances(x, self.vocabulary[np.maximum(words, 0)])
+      d[words < 0] = np.inf
+      kk = min(k, words.shape[1])
+      best = np.argpartition(d, kk - 1, axis=1)[:, :kk]
+      best = np.take_along_axis(best, np.argsort(np.take_along_axis(d, best, axis=1), axis=1), axis=1)
+      idx = words[rows, best]
+      dist = np.sqrt(d[rows, best])
+      if kk < k:
+        # Beam quá hẹp so với k: lấp phần thiếu bằng word gần nhất (trọng số gần như không đổi)
+        idx = np.concatenate([idx, np.repeat(idx[:, :1], k - kk, axis=1)], axis=1)
+        dist = np.concatenate([dist, np.full((len(x), k - kk), np.inf, dtype=np.float32)], axis=1)
+      out_idx[start:start + len(x)] = idx
+      out_dist[start:start + len(x)] = dist
+    return out_idx, out_dist
+
+  def save(self, path):
+    arrays = {'vocabulary': self.vocabulary, 'leaf_words': self.leaf_words,
+              'branching': np.int64(self.branching)}
+    for level in range(self.depth):
+      arrays[f'centers_{level}'] = self.level_centers[level]
+      arrays[f'valid_{level}'] = self.level_valid[level]
+    np.savez(path, **arrays)
+
+  @classmethod
+  def load(cls, path):
+    data = np.load(path)
+    depth = sum(1 for key in data.files if key.startswith('centers_'))
+    arrays = {
+      'level_centers': [data[f'centers_{level}'] for level in range(depth)],
+      'level_valid': [data[f'valid_{level}'] for level in range(depth)],
+      'leaf_words': data['leaf_words'],
+    }
+    return cls(data['vocabulary'], branching=int(data['branching']), _arrays=arrays)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Dựng cây từ vựng cho BOVW index.')
+  parser.add_argument('index_path', type=str, help='Thư mục BOVW index (có vocabulary.npy)')
+  parser.add_argument('--branching', type=int, default=10, help='Số nhánh mỗi node')
+  parser.add_argument('--depth', type=int, default=None, help='Độ sâu cây, mặc định tự tính theo số word')
+  args = parser.parse_args()
+
+  vocabulary = np.load(os.path.join(args.index_path, 'vocabulary.npy'))
+  if vocabulary.dtype == np.uint8:
+    raise SystemExit("Cây từ vựng chỉ hỗ trợ vocabulary SIFT (float), index này dùng descriptor nhị phân")
+  tree = VocabularyTree(vocabulary, branching=args.branching, depth=args.depth)
+  tree.save(os.path.join(args.index_path, TREE_FILE))
+  print(f"Đã dựng cây {tree.depth} tầng, {len(tree.leaf_words)} lá cho {tree.n_words} word")
@@ -1,3 +1,5 @@
+import io
+import base64
 import streamlit as st
 from google.cloud import firestore, storage
 import json
@@ -15,6 +17,7 @@ from miscs.face_models.sface import SFace
 from my_utils.card_verify import Verification
 import numpy as np
 from my_utils.face_controller import FaceController
+from my_utils.face_gallery import FaceGallery
 
 st.set_page_config(page_title="Face Verification", initial_sidebar_state="expanded", layout="wide")
 st.title("Face Verification")
@@ -81,24 +84,27 @@ def parse_data(doc: dict):
 
   for i, dat in doc.items():
     tb["id"].append(i)
-    # j = i.to_dict()
     tb["feature_chandung"].append(dat["feature_chandung"])
     tb["checkbox"].append(False)
     tb["msv"].append(dat["msv"])
     tb["name"].append(dat["name"])
-    path1 = dat["TheSV"].replace("gs://hchuong.appspot.com/","")
-    path2 = dat["ChanDung"].replace("gs://hchuong.appspot.com/","")
-
-    public_url = controller.db.bucket.blob(path1).generate_signed_url(expiration=timedelta(seconds=3300), method='GET')
-    tb["TheSV"].append(public_url)
     tb["feature"].append(dat["feature"])
-    public_url = controller.db.bucket.blob(path2).generate_signed_url(expiration=timedelta(seconds=3600), method='GET')
-    tb["ChanDung"].append(public_url)
+
+  # URL ảnh lấy từ cache (chỉ ký lại URL sắp hết hạn, song song) hoặc thumbnail local
+  thumbnails = st.session_state.get("local_thumbnails", False)
+  tb["TheSV"] = controller.urls.get_many([dat["TheSV"] for dat in doc.values()], thumbnails)
+  tb["ChanDung"] = controller.urls.get_many([dat["ChanDung"] for dat in doc.values()], thumbnails)
 
   return pd.DataFrame(tb)
   
 def get_all():
   return parse_data(controller.parse_data())
+
+def open_image(url):
+  # URL ảnh trong bảng là signed URL hoặc data URI (thumbnail local)
+  if url.startswith("data:"):
+    return Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1])))
+  return Image.open(requests.get(url, stream=True).raw)
   
 def display_table(tb):
   return st.data_editor(
@@ -183,6 +189,12 @@ with tab1:
           if st.button("Xóa", key="btn_delete", help="Xóa thông tin sinh viên"):
               callb("display_delete")
 
+      def reload_table():
+        st.session_state.ctr = 1
+
+      st.checkbox("Dùng thumbnail local", key="local_thumbnails", on_change=reload_table,
+                  help="Hiển thị ảnh thu nhỏ lưu trên máy thay vì signed URL tới ảnh gốc")
+
       # 11 for tools form 12 for table  
       sec11 = st.container()
       sec12 = st.container()
@@ -254,8 +266,8 @@ with tab1:
                 msv = cols[0].text_input("MSV", data.get("msv"))
                 name = cols[1].text_input("Name", data.get("name"))
 
-                img = Image.open(requests.get(data.get("TheSV"), stream=True).raw)
-                img2 = Image.open(requests.get(data.get("ChanDung"), stream=True).raw)
+                img = open_image(data.get("TheSV"))
+                img2 = open_image(data.get("ChanDung"))
                 #resize
                 img.thumbnail((200, 200))
                 img2.thumbnail((200, 200))
@@ -422,78 +434,58 @@ with tab3:
       with st.form('aa'):
       # print(features[0], y[0])
         file = st.file_uploader("Ảnh cần xác thực", type=["jpg", "png", "jpeg"], accept_multiple_files=False, help="Upload an image")
+        whole_db = st.checkbox("Nhận dạng trên toàn bộ CSDL", help="Tìm trong mọi sinh viên qua index embedding thay vì chỉ các sinh viên đang hiện trong bảng")
         if st.form_submit_button("Xác thực", use_container_width=True):
           p = []
-          features = []
           det = load_detector(0.7)
-          y = []
           regc = load_recognizer()
-          for sv in st.session_state.df_value.iterrows():
-            features.append(sv[1]["feature"])
-            y.append(sv[1]["msv"])    
-          features = np.asarray(features)
-          y = np.asarray(y)
           
           if file is not None:
             with st.spinner("Đang xác thực..."):
               img = Image.open(file)
               img = cv.cvtColor(np.array(img), cv.COLOR_RGB2BGR)
               
-              det.setInputSize((img.shape[1], img.shape[0]))
-              feature = det.infer(img)
-              features = []
-              _img = img.copy()
+              if whole_db:
+                # Mỗi khuôn mặt được nhận dạng độc lập trên index của cả CSDL
+                identified = controller.identify(img)
+                boxes = [bbox for bbox, _, _ in identified]
+                msvs = controller.snapshot.msvs(doc_id for _, doc_id, _ in identified if doc_id is not None)
+                matches = [(bbox, msvs[doc_id]) for bbox, doc_id, _ in identified if doc_id in msvs]
+              else:
+                # Embedding ảnh thẻ + chân dung của cả lớp trong một ma trận
+                gallery = FaceGallery.from_records(st.session_state.df_value.to_dict('records'))
+                det.setInputSize((img.shape[1], img.shape[0]))
+                feature = det.infer(img)
+                boxes = [dd[0:4] for dd in feature]
+                # Căn chỉnh mọi khuôn mặt rồi embed chung trong một lần forward
+                features = regc.inferBatch(img, feature[:, :-1])
+                # Ghép một-một khuôn mặt với sinh viên (một phép nhân ma trận + Hungary)
+                matches = [(feature[face_idx][0:4], gallery.labels[student_idx])
+                           for face_idx, student_idx, score in gallery.match(features)]
               
-              for dd in feature:
-                features.append(regc.infer(img, bbox=dd[:-1]))
-                face_box = dd[0:4].astype(np.int32)
+              _img = img.copy()
+              for face_box in boxes:
+                face_box = np.asarray(face_box).astype(np.int32)
                 _img = cv.rectangle(_img,
                                     (face_box[0], face_box[1]),
                                     (face_box[0] + face_box[2], face_box[1] + face_box[3]),
                                     (0, 0, 255),
                                     2)
-              features = np.asarray(features)
 
               st.write("Sinh viên có mặt trong lớp học")
               cols = st.columns(3)
               detected_faces = []
               detected_msvs = []
               
-              # Xử lý từng sinh viên trong database
-              for sv in st.session_state.df_value.iterrows():
-                sv = sv[1]
-                i = 0
-                max_score, bbox, msv = 0, None, None
-                
-                # So sánh với ảnh thẻ sinh viên
-                for det in features:
-                    mark, lb = regc.match_f(np.array([sv["feature"]], dtype=np.float32), det)
-                    if lb == 1:
-                        if mark > max_score:
-                            max_score = mark
-                            bbox = feature[i][0:4].astype(np.int32)
-                            msv = sv["msv"]
-                    i += 1
-
-                # So sánh với ảnh chân dung
-                i = 0
-                for det in features:
-                    mark, lb = regc.match_f(np.array([sv["feature_chandung"]], dtype=np.float32), det)
-                    if lb == 1:
-                        if mark > max_score:
-                            max_score = mark
-                            bbox = feature[i][0:4].astype(np.int32)
-                            msv = sv["msv"]
-                    i += 1
-                    
-                if bbox is not None:
-                    p.append(msv)
-                    face_crop = _img[bbox[1]:bbox[1]+bbox[3], bbox[0]:bbox[0]+bbox[2]]
-                    face_image = cv.resize(face_crop, (100, 100))
-                    face_image = cv.cvtColor(face_image, cv.COLOR_BGR2RGB)
-                    detected_faces.append(face_image)
-                    detected_msvs.append(msv)
-                    _img = cv.rectangle(_img, (bbox[0], bbox[1]), (bbox[0]+bbox[2], bbox[1]+bbox[3]), (0, 255, 0), 2)
+              for bbox, msv in matches:
+                bbox = np.asarray(bbox).astype(np.int32)
+                p.append(msv)
+                face_crop = _img[bbox[1]:bbox[1]+bbox[3], bbox[0]:bbox[0]+bbox[2]]
+                face_image = cv.resize(face_crop, (100, 100))
+                face_image = cv.cvtColor(face_image, cv.COLOR_BGR2RGB)
+                detected_faces.append(face_image)
+                detected_msvs.append(msv)
+                _img = cv.rectangle(_img, (bbox[0], bbox[1]), (bbox[0]+bbox[2], bbox[1]+bbox[3]), (0, 255, 0), 2)
               
               # Hiển thị 3 khuôn mặt đầu tiên trên cùng một hàng
               for i in range(min(3, len(detected_faces))):
@@ -1,90 +1,29 @@
+import os
 import streamlit as st
 import cv2
 import numpy as np
 from PIL import Image
-import pickle
-from scipy.spatial.distance import cosine
-from sklearn.cluster import MiniBatchKMeans
-from sklearn.preprocessing import normalize
+from my_utils.bovw_shards import open_searcher
+from my_utils.query_cache import QueryCache
+from my_utils.video_keyframes import format_timestamp, parse_keyframe_name
 
-class BOVWSearcher:
-    def __init__(self, database_path):
-        print("Đang load BOVW database...")
-        with open(database_path, 'rb') as f:
-            data = pickle.load(f)
-            self.database = data['database']
-            self.vocabulary = data['vocabulary']
-            self.n_clusters = data['n_clusters']
-            self.idf_weights = data.get('idf_weights', np.ones(self.n_clusters))
-        
-        self.sift = cv2.SIFT_create()
-        self.kmeans = MiniBatchKMeans(
-            n_clusters=self.n_clusters,
-            random_state=42,
-            batch_size=1000,
-            n_jobs=1,
-            verbose=0
-        )
-        self.kmeans.cluster_centers_ = self.vocabulary
-        self.kmeans.fit(self.vocabulary)
-        
-        print(f"Đã load database với {len(self.database)} ảnh")
+# Ưu tiên index memory-mapped (xem my_utils/bovw_store.py, có thể chia shard bằng my_utils/bovw_shards.py),
+# fallback về pickle cũ
+DATABASE_PATH = "bovw_index" if os.path.isdir("bovw_index") else "bovw_database_compressed.pkl"
 
-    def process_query_image(self, image):
-        try:
-            if len(image.shape) == 3:
-                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            else:
-                gray = image
-                
-            keypoints, descriptors = self.sift.detectAndCompute(gray, None)
-            
-            if descriptors is None:
-                return None
-                
-            # Tạo BOVW histogram tương tự như trong training
-            descriptors = normalize(descriptors, norm='l2', axis=1)
-            distances = self.kmeans.transform(descriptors)
-            
-            sigma = np.mean(distances) / 2
-            weights = np.exp(-distances / (2 * sigma**2))
-            weights = weights / weights.sum(axis=1, keepdims=True)
-            
-            histogram = np.zeros(self.n_clusters)
-            
-            if keypoints:
-                kp_weights = np.array([kp.size * kp.response for kp in keypoints])
-                kp_weights = kp_weights / np.sum(kp_weights)
-                for i in range(len(descriptors)):
-                    histogram += weights[i] * kp_weights[i]
-            else:
-                histogram = weights.sum(axis=0)
-            
-            histogram *= self.idf_weights
-            histogram = normalize(histogram.reshape(1, -1), norm='l2')[0]
-            
-            return histogram
-            
-        except Exception as e:
-            st.error(f"Lỗi khi xử lý ảnh: {str(e)}")
-            return None
+# Searcher dùng chung cho cả process: chỉ load lần đầu, dùng lại cho mọi query, rerun và session
+@st.cache_resource(show_spinner=False)
+def load_searcher(database_path=DATABASE_PATH):
+    return open_searcher(database_path)
 
-    def search_image(self, query_image, top_k=5):
-        query_features = self.process_query_image(query_image)
-        if query_features is None:
-            return []
-            
-        results = []
-        for image_name, features in self.database.items():
-            similarity = 1 - cosine(query_features, features['histogram'])
-            results.append({
-                'image_name': image_name,
-                'score': similarity,
-                'image': features['image']
-            })
-            
-        results.sort(key=lambda x: x['score'], reverse=True)
-        return results[:top_k]
+def to_bgr(image):
+    image = np.array(image)
+    if len(image.shape) == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_RGBA2BGR)
+    # PIL trả về RGB, index được build từ ảnh cv2.imread (BGR) nên phải đổi kênh cho khớp
+    return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
 
 def main():
     st.title("Image Search Demo")
@@ -222,6 +161,11 @@ def main():
     # Thêm sidebar cho các tùy chọn
     st.sidebar.title("Tùy chọn tìm kiếm")
     top_k = st.sidebar.slider("Số lượng kết quả", min_value=1, max_value=20, value=5)
+    n_query_words = st.sidebar.slider("Số visual words của query", min_value=0, max_value=200, value=0,
+                                      help="0: so khớp với toàn bộ database. Lớn hơn 0: chỉ dùng các visual word trội nhất của query qua inverted index (nhanh hơn, recall có thể giảm)")
+    verify_top = st.sidebar.slider("Số ứng viên xác minh hình học", min_value=0, max_value=50, value=0,
+                                   help="Khớp keypoint SIFT và đếm inlier RANSAC cho các ứng viên đầu rồi sắp xếp lại. 0: tắt")
+    budget_ms = st.sidebar.slider("Thời gian tối đa cho xác minh (ms)", min_value=50, max_value=1000, value=200, step=50)
     
     # Thêm thông tin về ứng dụng trong sidebar
     st.sidebar.markdown("---")
@@ -247,16 +191,35 @@ def main():
         
         # Xử lý ảnh và tìm kiếm
         try:
-            query_array = np.array(query_image)
-            if len(query_array.shape) == 2:
-                query_array = cv2.cvtColor(query_array, cv2.COLOR_GRAY2BGR)
-            elif query_array.shape[2] == 4:
-                query_array = cv2.cvtColor(query_array, cv2.COLOR_RGBA2BGR)
-            
+            # Cùng một ảnh (kể cả khi chỉ đổi slider) thì dùng lại keypoint/descriptor/histogram đã tính
+            cache_key = QueryCache.key_for(uploaded_file.getvalue())
+
             with st.spinner('Đang tìm kiếm...'):
-                searcher = BOVWSearcher("bovw_database_compressed.pkl")
-                results = searcher.search_image(query_array, top_k=top_k)
-            
+                searcher = load_searcher()
+                if searcher.is_stale():
+                    # Index vừa được thêm/xóa ảnh bằng my_utils.bovw_update: load lại
+                    # (searcher nhiều shard phải dừng process pool trước khi bị bỏ khỏi cache)
+                    if hasattr(searcher, 'close'):
+                        searcher.close()
+                    load_searcher.clear()
+                    searcher = load_searcher()
+                results = searcher.search_image(lambda: to_bgr(query_image), top_k=top_k,
+                                                n_query_words=n_query_words, verify_top=verify_top,
+                                                budget_ms=budget_ms, cache_key=cache_key)
+
+            st.sidebar.markdown("---")
+            st.sidebar.subheader("Thông tin database")
+            st.sidebar.write(f"""
+            - Số ảnh: {len(searcher)}
+            - Thời gian load: {searcher.load_time:.2f}s
+            - RAM của process (RSS): {searcher.memory_mb:.0f} MB
+            """)
+            cache_stats = searcher.query_cache.stats()
+            st.sidebar.write(f"""
+            - Cache query: {cache_stats['hits']} hit / {cache_stats['misses']} miss
+            - Dung lượng cache: {cache_stats['bytes'] / (1024 * 1024):.1f} / {cache_stats['max_bytes'] / (1024 * 1024):.0f} MB
+            """)
+
             # Hiển thị kết quả
             with col2:
                 st.subheader("Kết quả tìm kiếm")
@@ -265,9 +228,21 @@ def main():
                     for idx, result in enumerate(results):
                         col_idx = idx % 3
                         with cols[col_idx]:
+                            caption = f"Score: {result['score']:.3f}\n{result['image_name']}"
+                            if result.get('inliers') is not None:
+                                caption += f"\nInliers: {result['inliers']}"
                             st.image(result['image'],
-                                   caption=f"Score: {result['score']:.3f}\n{result['image_name']}",
+                                   caption=caption,
                                    use_container_width=True)
+                            # Keyframe của video: mở video tại đúng thời điểm
+                            keyframe = parse_keyframe_name(result['image_name'])
+                            if keyframe is not None:
+                                video_path, seconds = keyframe
+                                if os.path.isfile(video_path):
+                                    with st.expander(f"Video tại {format_timestamp(seconds)}"):
+                                        st.video(video_path, start_time=int(seconds))
+                                else:
+                                    st.caption(f"{video_path} - {format_timestamp(seconds)}")
                 else:
                     st.warning("Không tìm thấy ảnh tương tự!")
                     
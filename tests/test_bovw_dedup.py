@@ -0,0 +1,65 @@
+import json
+
+import numpy as np
+import pytest
+
+from my_utils.bovw_dedup import UnionFind, cluster_pairs, find_duplicates, iter_duplicate_pairs
+from my_utils.bovw_store import save_index
+
+
+def _reference_clusters(rows, cols, n):
+  labels = list(range(n))
+  for i, j in zip(rows, cols):
+    old, new = max(labels[i], labels[j]), min(labels[i], labels[j])
+    labels = [new if label == old else label for label in labels]
+  groups = {}
+  for i in sorted(set(rows) | set(cols)):
+    groups.setdefault(labels[i], []).append(i)
+  return sorted(map(sorted, groups.values()))
+
+
+def test_union_find_matches_reference():
+  rng = np.random.default_rng(0)
+  n = 200
+  rows, cols = rng.integers(0, n, 150), rng.integers(0, n, 150)
+  union_find = UnionFind(n)
+  # Gộp theo nhiều lô như khi các khối lần lượt xong
+  for part in np.array_split(np.arange(150), 7):
+    union_find.union(rows[part], cols[part])
+  clusters = union_find.clusters()
+  assert sorted(map(sorted, clusters)) == [c for c in _reference_clusters(rows, cols, n) if len(c) > 1]
+  assert [len(c) for c in clusters] == sorted((len(c) for c in clusters), reverse=True)
+  assert cluster_pairs(np.array([], dtype=np.int64), np.array([], dtype=np.int64), 5) == []
+
+
+def _make_index(path):
+  # 3 nhóm ảnh gần trùng (cùng vector gốc + nhiễu nhỏ), 1 ảnh lẻ, ảnh 7 bị xóa
+  rng = np.random.default_rng(1)
+  bases = rng.random((3, 32))
+  groups = [0, 0, 1, 2, 1, 0, 2, 0]
+  histograms = np.array([bases[g] + 0.01 * rng.random(32) for g in groups], dtype=np.float32)
+  histograms = np.vstack([histograms, rng.random((1, 32)).astype(np.float32)])
+  save_index(str(path), vocabulary=np.zeros((32, 8), np.float32), idf_weights=np.ones(32, np.float32),
+             histograms=histograms, names=[f'{i}.jpg' for i in range(len(histograms))])
+  deleted = np.zeros(len(histograms), dtype=bool)
+  deleted[7] = True
+  np.save(path / 'deleted.npy', deleted)
+  return str(path)
+
+
+def test_find_duplicates_blocked(tmp_path):
+  path = _make_index(tmp_path / 'index')
+  result = find_duplicates(path, str(tmp_path / 'dups.json'), threshold=0.99, block_size=3, workers=2)
+  clusters = sorted(sorted(item['id'] for item in cluster) for cluster in result['clusters'])
+  assert clusters == [[0, 1, 5], [2, 4], [3, 6]]
+  pairs = np.load(result['pairs_file'])
+  assert len(pairs['rows']) == result['n_pairs']
+  assert (pairs['rows'] < pairs['cols']).all()
+  assert json.load(open(tmp_path / 'dups.json'))['n_pairs'] == result['n_pairs']
+  assert sorted(p.name for p in tmp_path.iterdir()) == ['dups.json', 'dups_pairs.npz', 'index']
+
+
+def test_threshold_must_be_positive(tmp_path):
+  path = _make_index(tmp_path / 'index')
+  with pytest.raises(ValueError):
+    next(iter_duplicate_pairs(path, threshold=0))
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from my_utils.bovw_encoder import SoftAssignEncoder
+from my_utils.bovw_searcher import query_knn_words
+
+
+def _data(n_clusters=32, n=200, dim=16, seed=0):
+  rng = np.random.default_rng(seed)
+  vocabulary = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+  descriptors = rng.normal(size=(n, dim)).astype(np.float32)
+  return vocabulary, descriptors
+
+
+def test_dense_matches_reference_kernel():
+  vocabulary, descriptors = _data()
+  distances = np.linalg.norm(descriptors[:, None] - vocabulary[None], axis=2)
+  sigma = distances.mean() / 2
+  weights = np.exp(-distances / (2 * sigma**2))
+  weights /= weights.sum(axis=1, keepdims=True)
+  expected = np.full(len(descriptors), 1 / len(descriptors)) @ weights
+  tf = SoftAssignEncoder(vocabulary, knn=None).encode_tf(descriptors)
+  np.testing.assert_allclose(tf, expected, rtol=1e-4, atol=1e-6)
+
+
+def test_knn_equal_to_vocabulary_size_is_dense():
+  vocabulary, descriptors = _data()
+  dense = SoftAssignEncoder(vocabulary, knn=None).encode(descriptors)
+  full = SoftAssignEncoder(vocabulary, knn=len(vocabulary)).encode(descriptors)
+  np.testing.assert_allclose(full, dense, rtol=1e-4, atol=1e-6)
+
+
+def test_knn_keeps_k_words_per_descriptor():
+  vocabulary, descriptors = _data()
+  encoder = SoftAssignEncoder(vocabulary, knn=3)
+  words, distances = encoder.assign(descriptors)
+  assert words.shape == (len(descriptors), 3)
+  exact = np.sort(np.linalg.norm(descriptors[:, None] - vocabulary[None], axis=2), axis=1)[:, :3]
+  np.testing.assert_allclose(np.sort(distances, axis=1), exact, rtol=1e-4, atol=1e-4)
+  assert encoder.encode_tf(descriptors).sum() == pytest.approx(1.0, rel=1e-5)
+
+
+def test_query_knn_words_must_match_index():
+  assert query_knn_words(5) == 5
+  assert query_knn_words(5, 5, 'tree') == 5
+  assert query_knn_words(None) is None
+  with pytest.raises(ValueError):
+    query_knn_words(5, 3)
+  with pytest.raises(ValueError):
+    query_knn_words(None, 5)
+  with pytest.raises(ValueError):
+    query_knn_words(None, None, 'tree')
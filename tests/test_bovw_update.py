@@ -0,0 +1,73 @@
+import numpy as np
+
+from my_utils.bovw_encoder import create_encoder
+from my_utils.bovw_store import load_index, save_index
+from my_utils.bovw_update import BOVWIndexUpdater
+
+N_CLUSTERS = 16
+
+
+def _image(seed):
+  rng = np.random.default_rng(seed)
+  return (rng.random((128, 128, 3)) * 255).astype(np.uint8)
+
+
+def _make_index(path, n_images=6, seed=0):
+  rng = np.random.default_rng(seed)
+  vocabulary = rng.random((N_CLUSTERS, 128)).astype(np.float32)
+  vocabulary /= np.linalg.norm(vocabulary, axis=1, keepdims=True)
+  tf = rng.random((n_images, N_CLUSTERS)).astype(np.float32)
+  tf[tf < 0.3] = 0
+  df = np.count_nonzero(tf, axis=0)
+  idf = np.log(n_images / np.maximum(df, 1)).astype(np.float32)
+  encoder = create_encoder('sift', vocabulary, idf, knn=5)
+  save_index(str(path), vocabulary=vocabulary, idf_weights=idf, histograms=encoder.apply_idf(tf),
+             names=[f'{i}.jpg' for i in range(n_images)], tf=tf, df=df,
+             meta={'knn_words': 5, 'descriptor': 'sift'})
+  return str(path)
+
+
+def _check_consistent(path):
+  # df và histogram sau cập nhật phải giống như build lại từ tf của các ảnh còn sống
+  index = load_index(path)
+  live = ~index.deleted
+  tf = np.asarray(index.tf)
+  np.testing.assert_array_equal(index.df, np.count_nonzero(tf[live], axis=0))
+  return index, tf, live
+
+
+def test_add_then_refresh_matches_full_idf(tmp_path):
+  path = _make_index(tmp_path / 'index')
+  updater = BOVWIndexUpdater(path)
+  ids = updater.add_images([('new_a.jpg', _image(1)), ('new_b.jpg', _image(2)), ('0.jpg', _image(3))])
+  assert ids == [6, 7]
+  assert updater.index.meta['pending_idf_updates'] == 2
+
+  updater.refresh_idf()
+  index, tf, live = _check_consistent(path)
+  assert index.meta['pending_idf_updates'] == 0
+  idf = np.log(live.sum() / np.maximum(index.df, 1))
+  np.testing.assert_allclose(index.idf_weights, idf, rtol=1e-5)
+  expected = create_encoder('sift', index.vocabulary, idf, knn=5).apply_idf(tf)
+  np.testing.assert_allclose(np.asarray(index.histograms), expected, rtol=1e-4, atol=1e-6)
+
+
+def test_remove_updates_df_and_skips_unknown(tmp_path):
+  path = _make_index(tmp_path / 'index')
+  updater = BOVWIndexUpdater(path)
+  assert updater.remove(['1.jpg', 3, 99, -1, 'missing.jpg']) == [1, 3]
+  assert updater.remove([1]) == []
+  index, _, live = _check_consistent(path)
+  assert index.n_live == 4 and not live[1] and not live[3]
+  assert index.meta['pending_idf_updates'] == 2
+
+
+def test_refresh_idf_if_needed_batches_updates(tmp_path):
+  path = _make_index(tmp_path / 'index', n_images=40)
+  updater = BOVWIndexUpdater(path)
+  updater.remove([0])
+  # 1 / 39 ảnh < 5%: chưa tính lại
+  assert updater.refresh_idf_if_needed() is None
+  updater.remove([1])
+  assert updater.refresh_idf_if_needed() is not None
+  assert updater.index.meta['pending_idf_updates'] == 0
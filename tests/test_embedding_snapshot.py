@@ -0,0 +1,120 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from my_utils.embedding_snapshot import EmbeddingSnapshot
+
+
+class _Doc:
+  def __init__(self, doc_id, data):
+    self.id = doc_id
+    self._data = data
+
+  def to_dict(self):
+    return dict(self._data)
+
+
+class FakeDB:
+  # Cùng giao diện với DBHandle: list document, hoặc False khi đọc Firestore lỗi
+  def __init__(self):
+    self.docs, self.changes, self.clock, self.fail = {}, [], 100.0, False
+
+  def put(self, doc_id, msv, seed):
+    rng = np.random.default_rng(seed)
+    self.clock += 1
+    self.docs[doc_id] = {'msv': msv, 'name': msv, 'TheSV': 'a.jpg', 'ChanDung': 'b.jpg',
+                         'feature': rng.normal(size=128).tolist(), 'feature_chandung': rng.normal(size=128).tolist(),
+                         'updated_at': datetime.fromtimestamp(self.clock, tz=timezone.utc)}
+
+  def delete(self, doc_id):
+    self.clock += 1
+    del self.docs[doc_id]
+    self.changes.append(_Doc('c', {'id': doc_id, 'updated_at': self.clock}))
+
+  def get_all(self):
+    return False if self.fail else [_Doc(i, d) for i, d in self.docs.items()]
+
+  def get_updated_since(self, since):
+    return False if self.fail else [_Doc(i, d) for i, d in self.docs.items() if d['updated_at'] >= since]
+
+  def get_changes_since(self, since):
+    return False if self.fail else [c for c in self.changes if c.to_dict()['updated_at'] >= since.timestamp()]
+
+
+def _state(snapshot):
+  rows = snapshot.conn.execute("SELECT * FROM students ORDER BY id").fetchall()
+  return rows, snapshot.last_sync, open(snapshot.embeddings_path, 'rb').read()
+
+
+def _expected(db, doc_id):
+  return np.array([db.docs[doc_id]['feature'], db.docs[doc_id]['feature_chandung']], dtype=np.float32)
+
+
+def test_incremental_sync_matches_collection(tmp_path):
+  db = FakeDB()
+  for i in range(3):
+    db.put(f'id{i}', f'sv{i}', i)
+  snapshot = EmbeddingSnapshot(str(tmp_path / 'snap'))
+  assert snapshot.sync(db) == (3, 0)
+  db.put('id1', 'sv1-new', 10)
+  db.put('id3', 'sv3', 3)
+  db.delete('id0')
+  upserts, deleted = snapshot.sync(db)
+  assert deleted == 1 and upserts >= 2
+
+  records = snapshot.records()
+  assert sorted(records) == sorted(db.docs)
+  assert records['id1']['msv'] == 'sv1-new'
+  ids, msvs, embeddings = snapshot.matrix()
+  for n, doc_id in enumerate(ids):
+    np.testing.assert_allclose(embeddings[:, n], _expected(db, doc_id))
+
+  snapshot.compact()
+  ids, _, embeddings = snapshot.matrix()
+  assert len(snapshot.embeddings) == len(ids) == 3
+  for n, doc_id in enumerate(ids):
+    np.testing.assert_allclose(embeddings[:, n], _expected(db, doc_id))
+
+
+@pytest.mark.parametrize('full', [True, False])
+def test_failed_read_leaves_snapshot_unchanged(tmp_path, full):
+  db = FakeDB()
+  for i in range(3):
+    db.put(f'id{i}', f'sv{i}', i)
+  snapshot = EmbeddingSnapshot(str(tmp_path / 'snap'))
+  snapshot.sync(db)
+  before = _state(snapshot)
+  db.fail = True
+  assert snapshot.sync(db, full=full) == (0, 0)
+  assert _state(snapshot) == before
+  assert len(snapshot) == 3
+
+
+def test_db_handle_catches_errors_raised_while_streaming():
+  pytest.importorskip('google.cloud.firestore')
+  pytest.importorskip('firebase_admin')
+  pytest.importorskip('streamlit')
+  from my_utils.db_handle import DBHandle
+
+  def stream():
+    yield _Doc('id0', {})
+    raise RuntimeError('deadline exceeded')
+
+  class Query:
+    def where(self, filter=None):
+      return self
+
+    def stream(self):
+      return stream()
+
+  class Client:
+    def collection(self, name):
+      return Query()
+
+  handle = DBHandle.__new__(DBHandle)
+  handle.dbName, handle.changesName, handle.db = 'students', 'students_changes', Client()
+  since = datetime.now(tz=timezone.utc)
+  assert handle.get_all() is False
+  assert handle.get_updated_since(since) is False
+  assert handle.get_changes_since(since) is False
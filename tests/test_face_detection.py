@@ -0,0 +1,31 @@
+import glob
+import os
+
+import cv2
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+YUNET = os.path.join(ROOT, 'miscs', 'face_models', 'face_detection_yunet_2023mar.onnx')
+SAMPLES = sorted(glob.glob(os.path.join(ROOT, 'UIUX', 'FaceDetection', 'output_face', '*.jpg')))
+
+# face_controller kéo theo PIL / streamlit / Firestore
+for module in ('PIL', 'streamlit', 'google.cloud.firestore'):
+  pytest.importorskip(module)
+
+
+@pytest.fixture(scope='module')
+def detector():
+  from miscs.face_models.yunet import YuNet
+  return YuNet(modelPath=YUNET, confThreshold=0.85)
+
+
+@pytest.mark.skipif(not SAMPLES, reason='không có ảnh mẫu')
+@pytest.mark.parametrize('path', SAMPLES, ids=os.path.basename)
+def test_every_sample_has_a_face(detector, path):
+  from my_utils.face_controller import detect_faces
+  img = cv2.imread(path)
+  bboxs, out = detect_faces(detector, img)
+  assert out is img
+  assert len(bboxs) >= 1
+  x, y, w, h = bboxs[0][:4]
+  assert 0 <= x + w / 2 <= img.shape[1] and 0 <= y + h / 2 <= img.shape[0]
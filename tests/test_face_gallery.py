@@ -0,0 +1,59 @@
+import itertools
+
+import numpy as np
+
+from my_utils.face_gallery import FaceGallery, l2_normalize
+
+
+def _brute_force(scores, threshold):
+  # Tổng cosine lớn nhất trên mọi phép ghép một-một, chỉ tính các cặp đạt ngưỡng
+  n_faces, n = scores.shape
+  best = 0.0
+  for students in itertools.permutations(range(n), min(n_faces, n)):
+    for faces in itertools.permutations(range(n_faces), len(students)):
+      total = sum(scores[f, s] for f, s in zip(faces, students) if scores[f, s] >= threshold)
+      best = max(best, total)
+  return best
+
+
+def test_match_is_one_to_one_and_optimal():
+  rng = np.random.default_rng(0)
+  for _ in range(20):
+    gallery = FaceGallery([f'sv{i}' for i in range(5)], rng.normal(size=(2, 5, 16)), threshold=0.2)
+    queries = rng.normal(size=(4, 16))
+    matches = gallery.match(queries)
+    faces = [f for f, _, _ in matches]
+    students = [s for _, s, _ in matches]
+    assert len(set(faces)) == len(faces) and len(set(students)) == len(students)
+    scores = gallery.scores(queries)
+    for f, s, score in matches:
+      assert score >= gallery.threshold
+      assert score == np.float32(scores[f, s])
+    assert abs(sum(score for _, _, score in matches) - _brute_force(scores, gallery.threshold)) < 1e-5
+
+
+def test_student_score_is_best_view_and_empty_view_never_matches():
+  card, portrait, other = np.eye(4, dtype=np.float32)[:3]
+  # (n_views, n, D): 'a' chỉ có ảnh thẻ, 'b' chỉ có ảnh chân dung
+  embeddings = np.stack([[card, np.zeros(4)], [np.zeros(4), portrait]])
+  gallery = FaceGallery(['a', 'b'], embeddings)
+  query = portrait + 0.1 * card
+  np.testing.assert_allclose(gallery.scores(query), l2_normalize(query) @ np.stack([card, portrait]).T)
+  assert [(face, label) for face, label, _ in gallery.match_labels(query)] == [(0, 'b')]
+  assert gallery.match(other) == []
+
+
+def test_two_faces_cannot_share_a_student():
+  embeddings = l2_normalize(np.array([[1, 0, 0], [0.8, 0.6, 0]], dtype=np.float32))
+  gallery = FaceGallery(['a', 'b'], embeddings)
+  # Cả hai khuôn mặt gần 'a' nhất; Hungary cho khuôn mặt thứ hai sang 'b'
+  queries = np.array([[1, 0.05, 0], [0.95, 0.3, 0]], dtype=np.float32)
+  assert sorted((f, label) for f, label, _ in gallery.match_labels(queries)) == [(0, 'a'), (1, 'b')]
+
+
+def test_from_records_skips_missing_features():
+  records = [{'msv': '1', 'feature': [1.0, 0.0], 'feature_chandung': None},
+             {'msv': '2', 'feature': [], 'feature_chandung': [0.0, 1.0]}]
+  gallery = FaceGallery.from_records(records)
+  assert gallery.labels == ['1', '2'] and gallery.matrix.shape == (4, 2)
+  assert [label for _, label, _ in gallery.match_labels([[0.0, 1.0]])] == ['2']
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from my_utils.face_index import ExactFaceIndex, create_face_index, synthetic_gallery
+
+
+@pytest.mark.parametrize('kind', ['exact', 'ivf'])
+def test_add_replace_remove(kind):
+  index = create_face_index(kind)
+  labels, gallery = synthetic_gallery(50, dim=128)
+  for label, vector in zip(labels, gallery):
+    index.add([label, label], np.stack([vector, vector]))
+  assert len(index) == 100
+  # Insert lại cùng nhãn thay thế các hàng cũ
+  index.add(['person_3'], gallery[4][None])
+  assert len(index) == 99
+  assert index.identify(gallery[[4]])[0][0] in ('person_3', 'person_4')
+  assert index.remove({'person_4', 'missing'}) == 2
+  assert index.identify(gallery[[4]])[0][0] == 'person_3'
+  assert index.remove('person_4') == 0
+
+
+@pytest.mark.parametrize('kind', ['exact', 'ivf'])
+def test_save_load_and_compact(kind, tmp_path):
+  index = create_face_index(kind, min_train_size=64) if kind == 'ivf' else create_face_index(kind)
+  labels, gallery = synthetic_gallery(200, dim=128)
+  index.add(labels, gallery)
+  index.remove({f'person_{i}' for i in range(0, 200, 3)})
+  index.synced_at = 12.5
+  path = str(tmp_path / 'index.npz')
+  index.save(path)
+  loaded = ExactFaceIndex.load(path)
+  assert loaded.kind == kind and loaded.synced_at == 12.5 and len(loaded) == len(index)
+  queries = gallery[[1, 2, 3]]
+  assert loaded.identify(queries) == index.identify(queries)
+
+  assert loaded.compact_if_needed(max_fraction=0.5) is False
+  assert loaded.compact_if_needed(max_fraction=0.2) is True
+  assert loaded.deleted_fraction == 0 and len(loaded.vectors) == len(loaded)
+  assert loaded.identify(queries) == index.identify(queries)
+  # Vẫn thêm / xóa được sau compact
+  loaded.add(['person_0'], gallery[[0]])
+  assert loaded.identify(gallery[[0]])[0][0] == 'person_0'
+
+
+def test_ivf_matches_exact_when_probing_every_list():
+  labels, gallery = synthetic_gallery(2000, dim=32)
+  index = create_face_index('ivf', dim=32, min_train_size=500)
+  for start in range(0, len(labels), 100):
+    index.add(labels[start:start + 100], gallery[start:start + 100])
+  assert index.trained
+  rng = np.random.default_rng(1)
+  queries = gallery[:50] + rng.normal(scale=0.05, size=(50, 32))
+  approx = index.search(queries, k=5, n_probe=index.n_lists)
+  exact = index.search_exact(queries, k=5)
+  for (_, a), (_, e) in zip(approx, exact):
+    np.testing.assert_array_equal(np.sort(a), np.sort(e))
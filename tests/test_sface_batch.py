@@ -0,0 +1,51 @@
+import glob
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from miscs.face_models.sface import SFace
+from miscs.face_models.yunet import YuNet
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODELS = os.path.join(ROOT, 'miscs', 'face_models')
+# File ONNX của SFace không nằm trong repo (tải từ OpenCV Zoo), có thể trỏ tới bằng biến môi trường
+SFACE = os.environ.get('SFACE_MODEL', os.path.join(MODELS, 'face_recognition_sface_2021dec.onnx'))
+YUNET = os.path.join(MODELS, 'face_detection_yunet_2023mar.onnx')
+SAMPLES = sorted(glob.glob(os.path.join(ROOT, 'UIUX', 'FaceDetection', 'output_face', 'input_*.jpg')))
+
+pytestmark = pytest.mark.skipif(not (os.path.isfile(SFACE) and os.path.isfile(YUNET) and SAMPLES),
+                                reason='thiếu model SFace / YuNet hoặc ảnh mẫu')
+
+
+def _faces():
+  detector = YuNet(modelPath=YUNET, confThreshold=0.85)
+  faces = []
+  for path in SAMPLES:
+    img = cv2.imread(path)
+    detector.setInputSize((img.shape[1], img.shape[0]))
+    bboxs = detector.infer(img)
+    if len(bboxs):
+      faces.append((img, bboxs[0][:-1]))
+  return faces
+
+
+def test_batched_embeddings_match_per_face():
+  recognizer = SFace(modelPath=SFACE, batchSize=4)
+  faces = _faces()
+  assert len(faces) > 1
+  crops = [recognizer.alignCrops(img, [bbox])[0] for img, bbox in faces]
+  # Batch nhiều mặt (kể cả lô lẻ cuối) so với FaceRecognizerSF::feature từng mặt
+  batched = recognizer.inferCrops(crops)
+  single = np.concatenate([recognizer.infer(img, bbox).reshape(1, -1) for img, bbox in faces])
+  assert batched.shape == single.shape == (len(faces), 128)
+  np.testing.assert_allclose(batched, single, rtol=1e-4, atol=1e-5)
+
+  img, bbox = faces[0]
+  shifted = bbox.copy()
+  # Dịch khung và landmark 3 px theo trục x
+  shifted[[0, 4, 6, 8, 10, 12]] += 3
+  np.testing.assert_allclose(recognizer.inferBatch(img, np.stack([bbox, shifted])),
+                             np.concatenate([recognizer.infer(img, b).reshape(1, -1) for b in (bbox, shifted)]),
+                             rtol=1e-4, atol=1e-5)